@@ -0,0 +1,51 @@
+"""
+Tests for admission control in the chat UI.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+from typing import Any, Dict, List, cast
+
+import pytest
+
+from tj.scripts.api.openai import OpenAIClient
+from tj.scripts.models.chat import ChatSession
+from tj.scripts.ui import ChatUI
+from tj.scripts.utils.admission import AdmissionController
+
+class _SlowClient:
+    """Client answering once released"""
+
+    def __init__(self) -> None:
+        self.release = asyncio.Event()
+        self.usage = None
+
+    async def chat_completion(self, messages: List[Dict[str, Any]], **kwargs: Any) -> Dict[str, Any]:
+        await self.release.wait()
+        return {"choices": [{"message": {"role": "assistant", "content": "done"}}]}
+
+def test_flood_past_max_queue_is_rejected(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(ChatUI, "_new_session", lambda self: ChatSession())
+
+    async def flood() -> List[str]:
+        chat_ui = ChatUI(AdmissionController(max_concurrency=1, max_queue=2, max_wait=60))
+        client = _SlowClient()
+        chat_ui.client = cast(OpenAIClient, client)
+        chat_ui.is_initialized = True
+        tasks = [
+            asyncio.create_task(chat_ui.send_message("hi", [], session_id=f"session-{i}"))
+            for i in range(6)
+        ]
+        # Requests beyond one in flight and two queued are answered without waiting
+        done, _ = await asyncio.wait(tasks, timeout=0.5)
+        assert len(done) == 3
+        client.release.set()
+        results = await asyncio.gather(*tasks)
+        return [history[-1][1] for history, _, _ in results]
+
+    answers = asyncio.run(flood())
+    assert answers.count("done") == 3
+    assert sum("busy" in answer for answer in answers) == 3
@@ -0,0 +1,46 @@
+"""
+Tests for request micro-batching.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+from array import array
+from typing import List, Tuple
+
+import pytest
+
+from tj.scripts.api.batching import MicroBatcher
+
+def test_short_upstream_result_fails_every_caller() -> None:
+    async def fetch(items: List[str]) -> List[int]:
+        return [1]
+
+    async def run() -> list:
+        batcher = MicroBatcher(fetch, max_wait=0.001)
+        return await asyncio.wait_for(
+            asyncio.gather(*(batcher.submit(str(i)) for i in range(3)), return_exceptions=True),
+            timeout=1
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+
+def test_duplicate_inputs_get_separate_results() -> None:
+    calls: List[List[str]] = []
+
+    async def fetch(items: List[str]) -> List[array]:
+        calls.append(items)
+        return [array("f", [1.0]) for _ in items]
+
+    async def run() -> Tuple[array, array]:
+        batcher: MicroBatcher[array] = MicroBatcher(fetch, max_wait=0.001)
+        return await asyncio.gather(batcher.submit("a"), batcher.submit("a"))
+
+    first, second = asyncio.run(run())
+    assert calls == [["a"]]
+    assert first == second and first is not second
+    first[0] = 2.0
+    assert second[0] == pytest.approx(1.0)
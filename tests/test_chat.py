@@ -0,0 +1,44 @@
+"""
+Tests for chat session history trimming.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+from typing import List
+
+from tj.scripts.models.chat import ChatSession
+
+def _turns(session: ChatSession, count: int) -> List[List[str]]:
+    """Add question/answer turns and return the history after each question."""
+    histories = []
+    for i in range(count):
+        session.add_message("user", f"q{i}")
+        histories.append([msg.content for msg in session.messages])
+        session.add_message("assistant", f"a{i}")
+    return histories
+
+def test_history_is_trimmed_in_chunks() -> None:
+    session = ChatSession(max_history=8, trim_chunk=4)
+    histories = _turns(session, 8)
+    firsts = [history[0] for history in histories]
+    # The prefix only changes when a whole chunk is dropped
+    assert firsts == ["q0", "q0", "q0", "q0", "q2", "q2", "q4", "q4"]
+    assert all(len(history) <= 8 for history in histories)
+    assert all(history[-1] == f"q{i}" for i, history in enumerate(histories))
+
+def test_trim_keeps_a_user_turn_first() -> None:
+    session = ChatSession(max_history=4, trim_chunk=1)
+    session.add_message("user", "q0")
+    session.add_message("assistant", "", tool_calls=[{"id": "1"}])
+    session.add_message("tool", "result", tool_call_id="1")
+    session.add_message("assistant", "a0")
+    session.add_message("user", "q1")
+    assert [msg.content for msg in session.messages] == ["q1"]
+
+def test_small_history_keeps_context() -> None:
+    session = ChatSession(max_history=4)
+    histories = _turns(session, 4)
+    assert histories[2] == ["q1", "a1", "q2"]
+    assert histories[3] == ["q2", "a2", "q3"]
@@ -0,0 +1,112 @@
+"""
+Tests for request compression and response size limits.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import gzip
+import json
+import zlib
+from typing import Awaitable, Callable, List
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from tj.scripts.api.openai import OpenAIClient
+from tj.scripts.api.transport import HTTPTransport, ResponseTooLarge
+
+_PAYLOAD = {"model": "model", "messages": [{"role": "user", "content": "hello " * 400}]}
+
+def _client(compression: str) -> OpenAIClient:
+    return OpenAIClient({
+        "base_url": "http://test",
+        "api_key": "key",
+        "model": "model",
+        "request_compression": compression,
+        "compression_min_size": 1024,
+    }, "provider")
+
+def test_gzip_request_body_is_deterministic() -> None:
+    client = _client("gzip")
+    body, headers = client._encode(_PAYLOAD)
+    again, _ = client._encode(_PAYLOAD)
+    assert body == again
+    # Bytes 4-7 of the gzip header hold the modification time
+    assert body[4:8] == b"\0\0\0\0"
+    assert headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(body)) == _PAYLOAD
+
+def test_deflate_request_body_and_small_bodies() -> None:
+    client = _client("deflate")
+    body, headers = client._encode(_PAYLOAD)
+    assert headers["Content-Encoding"] == "deflate"
+    assert json.loads(zlib.decompress(body)) == _PAYLOAD
+
+    small, headers = client._encode({"model": "model"})
+    assert json.loads(small) == {"model": "model"}
+    assert "Content-Encoding" not in headers
+
+async def _serve(
+    handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+    check: Callable[[str], Awaitable[None]]
+) -> None:
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handler)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        await check(str(server.make_url("/")))
+    finally:
+        await server.close()
+
+def test_oversized_responses_are_rejected() -> None:
+    requests: List[str] = []
+
+    async def handler(request: web.Request) -> web.StreamResponse:
+        requests.append(request.path)
+        if request.path == "/gzip":
+            # Small on the wire, large once decoded
+            body = gzip.compress(b"x" * 5000)
+            return web.Response(body=body, headers={"Content-Encoding": "gzip"})
+        if request.path == "/stream":
+            response = web.StreamResponse()
+            await response.prepare(request)
+            for _ in range(50):
+                await response.write(b"data: " + b"x" * 100 + b"\n")
+            return response
+        return web.Response(body=b"x" * 5000)
+
+    async def check(base: str) -> None:
+        transport = HTTPTransport(max_response_size=1000)
+        try:
+            with pytest.raises(ResponseTooLarge):
+                await transport.post(base + "plain", {}, b"{}", 5)
+            with pytest.raises(ResponseTooLarge):
+                await transport.post(base + "gzip", {}, b"{}", 5)
+            with pytest.raises(ResponseTooLarge):
+                async for _ in transport.stream(base + "stream", {}, b"{}", 5):
+                    pass
+            assert (await HTTPTransport().post(base + "plain", {}, b"{}", 5)).body == b"x" * 5000
+
+            client = OpenAIClient({
+                "base_url": base.rstrip("/"),
+                "api_key": "key",
+                "model": "model",
+                "max_response_size": 1000,
+                "retry_count": 3,
+                "retry_delay": 0,
+            }, "provider")
+            requests.clear()
+            with pytest.raises(ResponseTooLarge):
+                await client.chat_completion([{"role": "user", "content": "hi"}])
+            # Retrying cannot shrink the response
+            assert requests == ["/chat/completions"]
+            await client.close()
+        finally:
+            await transport.close()
+
+    asyncio.run(_serve(handler, check))
@@ -0,0 +1,73 @@
+"""
+Tests for configuration loading and hot reload.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import os
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from tj.scripts.config import Changes, Config, ConfigLoadError, _diff, format_changes
+
+_BASE = """
+[api.openai]
+base_url = "https://api.openai.com/v1"
+api_key = "sk-OLD"
+model = "gpt-4o"
+
+[logging]
+level = "INFO"
+"""
+
+def _write(path: Path, text: str) -> None:
+    path.write_text(text, encoding="utf-8")
+    # Make sure the change is visible even on coarse mtime filesystems
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+def test_reload_rejects_invalid_file(tmp_path: Path) -> None:
+    path = tmp_path / "config.toml"
+    _write(path, _BASE)
+    config = Config(path)
+    _write(path, _BASE.replace('model = "gpt-4o"', "model = 4"))
+
+    with pytest.raises(ConfigLoadError):
+        config.reload()
+    assert config.get_section("api")["openai"]["model"] == "gpt-4o"
+    assert asyncio.run(config.poll()) == {}
+
+def test_poll_notifies_subscribers(tmp_path: Path) -> None:
+    path = tmp_path / "config.toml"
+    _write(path, _BASE)
+    config = Config(path)
+    received: List[Changes] = []
+
+    async def listener(changes: Changes) -> None:
+        received.append(changes)
+
+    config.subscribe(listener)
+    assert asyncio.run(config.poll()) == {}
+    _write(path, _BASE.replace('level = "INFO"', 'level = "DEBUG"'))
+
+    asyncio.run(config.poll())
+    assert received == [{"logging.level": ("INFO", "DEBUG")}]
+
+def test_added_table_masks_each_secret() -> None:
+    old = {"api": {"openai": {"api_key": "sk-OLD"}}}
+    new = {
+        "api": {"openai": {"api_key": "sk-OLD"}, "other": {"api_key": "sk-SECRET", "model": "m"}},
+        "session_store": {"url": "redis://:pw@cache:6379/0"},
+    }
+    changes = _diff(old, new)
+    assert set(changes) == {"api.other.api_key", "api.other.model", "session_store.url"}
+
+    report = format_changes(changes)
+    assert "sk-SECRET" not in report
+    assert "pw" not in report
+    assert "redis://***@cache:6379/0" in report
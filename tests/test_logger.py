@@ -0,0 +1,90 @@
+"""
+Tests for logging utilities.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from tj.scripts.utils import logger as logger_module
+from tj.scripts.utils.logger import JsonFormatter, _DroppingQueueHandler, setup_logger, shutdown_logger
+
+def test_queued_exception_keeps_structured_field(tmp_path: Path) -> None:
+    path = tmp_path / "app.log"
+    log = setup_logger("test.exc", file=str(path), async_mode=True, json_format=True)
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        log.exception("failed %s", "hard")
+    shutdown_logger("test.exc")
+
+    data = json.loads(path.read_text(encoding="utf-8").splitlines()[-1])
+    assert data["message"] == "failed hard"
+    assert "ValueError: boom" in data["exc_info"]
+
+def test_dropped_records_are_reported() -> None:
+    log_queue: "queue.Queue[Optional[logging.LogRecord]]" = queue.Queue(maxsize=2)
+    handler = _DroppingQueueHandler(log_queue)
+    log = logging.getLogger("test.drop")
+    log.propagate = False
+    log.handlers = [handler]
+    try:
+        for i in range(4):
+            log.warning("record %d", i)
+        assert handler.dropped == 2
+        log_queue.get_nowait()
+        log_queue.get_nowait()
+        log.warning("after")
+        log_queue.get_nowait()
+        report = log_queue.get_nowait()
+        assert report is not None
+        assert "Dropped 2 log records" in report.getMessage()
+        assert handler.unreported == 0
+    finally:
+        log.handlers = []
+
+def test_shutdown_reports_unreported_drops(tmp_path: Path) -> None:
+    path = tmp_path / "app.log"
+    log = setup_logger("test.shutdown", file=str(path), async_mode=True, json_format=True)
+    handler = next(h for h in log.handlers if isinstance(h, _DroppingQueueHandler))
+    handler.dropped = handler.unreported = 5
+    shutdown_logger("test.shutdown")
+
+    assert "Dropped 5 log records" in path.read_text(encoding="utf-8")
+    assert "test.shutdown" not in logger_module._listeners
+
+def test_shutdown_with_full_queue_stops_listener(tmp_path: Path) -> None:
+    log = setup_logger("test.full", file=str(tmp_path / "app.log"), async_mode=True, queue_size=2)
+    listener = logger_module._listeners["test.full"]
+    console = listener.handlers[0]
+    errors: List[BaseException] = []
+
+    def shutdown() -> None:
+        try:
+            shutdown_logger("test.full")
+        except BaseException as e:
+            errors.append(e)
+
+    # Block the listener thread so the queue fills up
+    console.acquire()
+    try:
+        log.info("taken by the listener")
+        time.sleep(0.05)
+        for i in range(5):
+            log.info("record %d", i)
+        thread = threading.Thread(target=shutdown)
+        thread.start()
+        time.sleep(0.1)
+    finally:
+        console.release()
+    thread.join(5)
+    assert errors == []
+    assert listener._thread is None
@@ -0,0 +1,60 @@
+"""
+Tests for the request path profiler.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import contextlib
+import time
+from pathlib import Path
+from typing import AsyncGenerator, Iterator, List
+
+import pytest
+
+from tj.scripts.utils.profiling import profiled, profiler
+
+@pytest.fixture
+def window(tmp_path: Path) -> Iterator[None]:
+    profiler.configure({"output_dir": str(tmp_path), "interval": 0.002, "allocations": False})
+    assert profiler.start(5)
+    yield
+    profiler.stop()
+    while profiler.active:
+        time.sleep(0.01)
+
+@profiled("test.busy")
+def _busy(seconds: float) -> None:
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+def test_samples_only_while_a_hook_runs(window: None) -> None:
+    # The first call is sampled although the thread was never seen before
+    _busy(0.2)
+    samples = sum(profiler._stacks.values())
+    assert any("_busy" in stack[-1] for stack in profiler._stacks)
+    # The thread is idle now and no longer sampled
+    time.sleep(0.1)
+    assert sum(profiler._stacks.values()) == samples
+
+def test_async_generator_hook_closes_early(window: None) -> None:
+    closed: List[bool] = []
+
+    @profiled("test.stream")
+    async def stream() -> AsyncGenerator[int, None]:
+        try:
+            for i in range(10):
+                yield i
+        finally:
+            closed.append(True)
+
+    async def consume() -> None:
+        async with contextlib.aclosing(stream()) as items:
+            async for _ in items:
+                break
+        assert closed == [True]
+
+    asyncio.run(consume())
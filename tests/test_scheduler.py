@@ -0,0 +1,66 @@
+"""
+Tests for priority-aware request scheduling.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+from typing import List, Tuple
+
+from tj.scripts.api.scheduler import RequestScheduler
+
+async def _drain(scheduler: RequestScheduler, requests: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """Queue the requests behind a held slot and return the order they were granted in."""
+    order: List[Tuple[str, str]] = []
+
+    async def request(priority: str, user: str) -> None:
+        async with scheduler.slot(priority, user):
+            order.append((priority, user))
+
+    await scheduler.acquire()
+    tasks = [asyncio.create_task(request(priority, user)) for priority, user in requests]
+    await asyncio.sleep(0)
+    assert scheduler.queued == len(requests)
+    scheduler.release()
+    await asyncio.gather(*tasks)
+    return order
+
+def test_classes_share_slots_by_weight() -> None:
+    scheduler = RequestScheduler(max_concurrency=1)
+    requests = [("interactive", "u")] * 40 + [("bulk", "u")] * 40
+    order = asyncio.run(_drain(scheduler, requests))
+    # Interactive requests weigh 8, bulk requests 1
+    first = [priority for priority, _ in order[:27]]
+    assert first.count("bulk") == 3
+    assert first.count("interactive") == 24
+    assert scheduler.metrics()["active"] == 0
+
+def test_users_alternate_within_a_class() -> None:
+    scheduler = RequestScheduler(max_concurrency=1)
+    requests = [("background", "a")] * 3 + [("background", "b")] * 3
+    order = asyncio.run(_drain(scheduler, requests))
+    assert [user for _, user in order] == ["a", "b", "a", "b", "a", "b"]
+
+def test_cancelled_waiters_do_not_leak_slots() -> None:
+    async def run() -> None:
+        scheduler = RequestScheduler(max_concurrency=1)
+        await scheduler.acquire()
+        queued = asyncio.create_task(scheduler.acquire())
+        granted = asyncio.create_task(scheduler.acquire())
+        await asyncio.sleep(0)
+        # Cancelled while queued
+        queued.cancel()
+        await asyncio.sleep(0)
+        # Cancelled after being granted the slot, before it could run
+        scheduler.release()
+        granted.cancel()
+        await asyncio.gather(queued, granted, return_exceptions=True)
+        assert scheduler.metrics()["active"] == 0
+        await asyncio.wait_for(scheduler.acquire(), 1)
+        scheduler.release()
+        assert scheduler.metrics()["active"] == 0
+        assert scheduler.queued == 0
+
+    asyncio.run(run())
@@ -0,0 +1,129 @@
+"""
+Tests for the semantic response cache.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import json
+from array import array
+from pathlib import Path
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from tj.scripts.api.openai import OpenAIClient
+from tj.scripts.api.transport import Response, Transport
+from tj.scripts.cache.semantic import SemanticCache, VectorIndex
+from tj.scripts.config import ConfigError
+
+def _response(content: str) -> dict:
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+async def _embed(text: str) -> array:
+    # Texts sharing a first word embed close together
+    rng = np.random.default_rng(sum(map(ord, text.split()[0])))
+    base = rng.standard_normal(16)
+    noise = np.random.default_rng(sum(map(ord, text))).standard_normal(16) * 0.01
+    return array("f", (base + noise).astype(np.float32))
+
+async def _failing_embed(text: str) -> array:
+    raise RuntimeError("embeddings not supported")
+
+class _ChatTransport(Transport):
+    """Transport answering every post with a fixed chat response"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.urls: List[str] = []
+
+    async def post(self, url: str, headers: Dict[str, str], body: bytes, timeout: float) -> Response:
+        self.urls.append(url)
+        return Response(200, json.dumps(_response("live answer")).encode())
+
+    async def stream(
+        self, url: str, headers: Dict[str, str], body: bytes, timeout: float
+    ) -> AsyncGenerator[bytes, None]:
+        raise AssertionError("unexpected stream")
+        yield b""
+
+def _messages(system: str, question: str) -> list:
+    return [{"role": "system", "content": system}, {"role": "user", "content": question}]
+
+def _fill(cache: SemanticCache) -> None:
+    async def fill() -> None:
+        for i in range(20):
+            _, key = await cache.lookup(_messages(f"context {i}", "weather today?"), "model")
+            cache.store(key, _response(f"answer {i}"))
+    asyncio.run(fill())
+
+def test_save_load_save_keeps_index(tmp_path: Path) -> None:
+    cache = SemanticCache(_embed, index_path=tmp_path / "cache")
+    _fill(cache)
+    cache.save()
+
+    restored = SemanticCache(_embed, index_path=tmp_path / "cache")
+    assert len(restored) == 20
+    # Saving over the memory-mapped file must not truncate it
+    restored.save()
+
+    again = SemanticCache(_embed, index_path=tmp_path / "cache")
+    assert len(again) == 20
+    response, _ = asyncio.run(again.lookup(_messages("context 3", "weather today?"), "model"))
+    assert response is not None
+    assert response["choices"][0]["message"]["content"] == "answer 3"
+
+def test_lookup_finds_match_ranked_below_other_contexts() -> None:
+    cache = SemanticCache(_embed)
+    _fill(cache)
+
+    async def store_and_lookup() -> Optional[Dict[str, Any]]:
+        _, key = await cache.lookup(_messages("other context", "weather today, please?"), "model")
+        cache.store(key, _response("other answer"))
+        # The paraphrase ranks behind 20 identical questions asked in other contexts
+        response, _ = await cache.lookup(_messages("other context", "weather today?"), "model")
+        return response
+
+    response = asyncio.run(store_and_lookup())
+    assert response is not None
+    assert response["choices"][0]["message"]["content"] == "other answer"
+
+def test_search_applies_filters_before_top_k() -> None:
+    index = VectorIndex()
+    vector = VectorIndex.normalize(np.ones(4))
+    slots = [index.add(vector) for _ in range(10)]
+    results = index.search(vector, k=2, accept=lambda slot: slot == slots[-1])
+    assert [slot for slot, _ in results] == [slots[-1]]
+    assert index.search(vector, min_score=1.5) == []
+
+def test_corrupt_slot_metadata_is_ignored(tmp_path: Path) -> None:
+    cache = SemanticCache(_embed, index_path=tmp_path / "cache")
+    _fill(cache)
+    cache.save()
+    metadata = tmp_path / "cache.json"
+    metadata.write_text(metadata.read_text().replace('"slot":19', '"slot":500'))
+
+    restored = SemanticCache(_embed, index_path=tmp_path / "cache")
+    assert len(restored) == 0
+
+def test_embeddings_failure_sends_request_uncached() -> None:
+    client = OpenAIClient({"base_url": "http://test", "api_key": "key", "model": "model"}, "provider")
+    client.transport = _ChatTransport()
+    client.semantic_cache = SemanticCache(_failing_embed)
+
+    response = asyncio.run(client.chat_completion([{"role": "user", "content": "hi"}]))
+    assert response["choices"][0]["message"]["content"] == "live answer"
+    assert client.transport.urls == ["http://test/chat/completions"]
+
+def test_cache_requires_explicit_embedding_model() -> None:
+    config: Dict[str, Any] = {"base_url": "http://test", "api_key": "key", "model": "model"}
+    with pytest.raises(ConfigError):
+        OpenAIClient(config, "provider").enable_semantic_cache({"index_path": None})
+
+    client = OpenAIClient({**config, "embedding_model": "embed"}, "provider")
+    client.enable_semantic_cache({"index_path": None})
+    assert client.semantic_cache is not None
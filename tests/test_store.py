@@ -0,0 +1,99 @@
+"""
+Tests for the shared session stores.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+from pathlib import Path
+from typing import Optional, Union
+
+import pytest
+
+from tj.scripts.models.chat import ChatSession
+from tj.scripts.models.store import (
+    LocalKeyValueClient,
+    NetworkSessionStore,
+    SessionLockLost,
+    SessionLockTimeout,
+    SQLiteSessionStore,
+)
+
+def test_unlock_keeps_lock_taken_over_by_another_worker() -> None:
+    async def run() -> None:
+        client = LocalKeyValueClient()
+        first = NetworkSessionStore(client, lock_ttl=60)
+        second = NetworkSessionStore(client, lock_ttl=60)
+        assert await first._try_lock("s", "first")
+        # The first lease expired and the second worker took the lock
+        await client.delete("tj:session:lock:s")
+        assert await second._try_lock("s", "second")
+        await first._unlock("s", "first")
+        assert not await first._try_lock("s", "first")
+
+    asyncio.run(run())
+
+def test_lock_is_renewed_while_held() -> None:
+    async def run() -> None:
+        client = LocalKeyValueClient()
+        first = NetworkSessionStore(client, lock_ttl=0.2)
+        second = NetworkSessionStore(client, lock_ttl=0.2, lock_timeout=0.1)
+        async with first.lock("s"):
+            await asyncio.sleep(0.5)
+            with pytest.raises(SessionLockTimeout):
+                async with second.lock("s"):
+                    pass
+            await first.save("s", ChatSession())
+        async with second.lock("s"):
+            pass
+
+    asyncio.run(run())
+
+def test_save_fails_after_losing_the_lock() -> None:
+    async def run() -> None:
+        client = LocalKeyValueClient()
+        store = NetworkSessionStore(client, lock_ttl=0.15)
+        async with store.lock("s"):
+            # Another worker takes over the lock
+            await client.set("tj:session:lock:s", "other")
+            await asyncio.sleep(0.2)
+            with pytest.raises(SessionLockLost):
+                await store.save("s", ChatSession())
+        assert await store.load("s") is None
+
+    asyncio.run(run())
+
+def test_sqlite_sessions_expire(tmp_path: Path) -> None:
+    async def run() -> None:
+        store = SQLiteSessionStore(tmp_path / "sessions.db", ttl=0.1)
+        try:
+            await store.save("old", ChatSession())
+            assert await store.load("old") is not None
+            await asyncio.sleep(0.15)
+            assert await store.load("old") is None
+            store._next_purge = 0.0
+            await store.save("new", ChatSession())
+            row, _ = store._execute("SELECT COUNT(*) FROM sessions")
+            assert row == (1,)
+        finally:
+            store.close()
+
+    asyncio.run(run())
+
+def test_network_store_without_ttl_never_expires() -> None:
+    class StrictClient(LocalKeyValueClient):
+        # Redis rejects a zero or negative expiry
+        async def set(self, name: str, value: Union[bytes, str], px: Optional[int] = None, nx: bool = False) -> Optional[bool]:
+            if px is not None and px <= 0:
+                raise ValueError("invalid expire time in 'set' command")
+            return await super().set(name, value, px=px, nx=nx)
+
+    async def run() -> None:
+        store = NetworkSessionStore(StrictClient(), ttl=0)
+        async with store.lock("s"):
+            await store.save("s", ChatSession())
+        assert await store.load("s") is not None
+
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+"""
+Tests for tool loading and execution.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import sys
+import threading
+from pathlib import Path
+from typing import Any, Dict, Tuple, cast
+
+import pytest
+
+from tj.scripts.api.base import BaseAPIClient
+from tj.scripts.config import ConfigError
+from tj.scripts.models.chat import ChatSession
+from tj.scripts.tools import ROUND_LIMIT_MESSAGE, ToolEngine, ToolRegistry, load_modules, registry
+
+def test_load_modules_registers_tools(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (tmp_path / "sample_tools.py").write_text(
+        "from tj.scripts.tools import tool\n"
+        "\n"
+        "@tool\n"
+        "def echo(text: str) -> str:\n"
+        "    \"\"\"Echo the text.\"\"\"\n"
+        "    return text\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    try:
+        load_modules(["sample_tools"])
+        assert registry.get("echo") is not None
+    finally:
+        registry._tools.pop("echo", None)
+        sys.modules.pop("sample_tools", None)
+
+def test_load_modules_rejects_missing_module() -> None:
+    with pytest.raises(ConfigError):
+        load_modules(["no_such_tool_module"])
+
+def test_timed_out_blocking_tools_do_not_exhaust_threads() -> None:
+    release = threading.Event()
+    tools = ToolRegistry()
+
+    @tools.register(timeout=0.05)
+    def stuck() -> str:
+        """Block until released."""
+        release.wait()
+        return "done"
+
+    engine = ToolEngine(tools, max_workers=1)
+
+    async def scenario() -> Tuple[str, str]:
+        first = await engine.execute("stuck", None)
+        second = await engine.execute("stuck", None)
+        return first, second
+
+    try:
+        first, second = asyncio.run(scenario())
+        assert "timed out" in first
+        assert "timed-out tools" in second
+        release.set()
+        engine._executor.submit(lambda: None).result(timeout=1)
+        assert engine._abandoned == 0
+    finally:
+        release.set()
+        engine.close()
+
+def test_load_modules_wraps_import_time_errors(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (tmp_path / "broken_tools.py").write_text("raise RuntimeError('no credentials')\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    try:
+        with pytest.raises(ConfigError, match="no credentials"):
+            load_modules(["broken_tools"])
+    finally:
+        sys.modules.pop("broken_tools", None)
+
+def test_round_limit_answers_with_fallback() -> None:
+    tools = ToolRegistry()
+
+    @tools.register
+    def lookup() -> str:
+        """Look something up."""
+        return "nothing"
+
+    class LoopingClient:
+        calls = 0
+
+        async def chat_completion(self, **kwargs: Any) -> Dict[str, Any]:
+            self.calls += 1
+            call = {"id": f"call{self.calls}", "type": "function", "function": {"name": "lookup", "arguments": "{}"}}
+            return {"choices": [{"message": {"role": "assistant", "content": None, "tool_calls": [call]}}]}
+
+    engine = ToolEngine(tools, max_rounds=2)
+    client = LoopingClient()
+    try:
+        response = asyncio.run(engine.run(cast(BaseAPIClient, client), ChatSession()))
+    finally:
+        engine.close()
+    assert client.calls == 3
+    assert response["choices"][0]["message"]["content"] == ROUND_LIMIT_MESSAGE
@@ -0,0 +1,83 @@
+"""
+Tests for the recording and replay transports.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+from pathlib import Path
+from typing import AsyncGenerator, Dict, List
+
+import pytest
+
+from tj.scripts.api.transport import CassetteMiss, RecordingTransport, ReplayTransport, Response, Transport
+
+class _FakeTransport(Transport):
+    """Transport answering with fixed lines, optionally stalling after them"""
+
+    def __init__(self, lines: List[bytes], stall: bool = False) -> None:
+        super().__init__()
+        self.lines = lines
+        self.stall = stall
+
+    async def post(self, url: str, headers: Dict[str, str], body: bytes, timeout: float) -> Response:
+        return Response(200, b'{"ok": true}')
+
+    async def stream(
+        self, url: str, headers: Dict[str, str], body: bytes, timeout: float
+    ) -> AsyncGenerator[bytes, None]:
+        for line in self.lines:
+            yield line
+        if self.stall:
+            await asyncio.sleep(60)
+
+async def _read(transport: Transport, body: bytes = b"{}") -> List[bytes]:
+    return [line async for line in transport.stream("http://test/chat", {}, body, 1.0)]
+
+def test_record_replay_round_trip(tmp_path: Path) -> None:
+    cassette = tmp_path / "session.jsonl.gz"
+
+    async def record() -> None:
+        transport = RecordingTransport(_FakeTransport([b"data: 1\n", b"\n", b"data: 2\n"]), cassette)
+        await transport.post("http://test/models", {}, b"{}", 1.0)
+        assert await _read(transport) == [b"data: 1\n", b"\n", b"data: 2\n"]
+        await transport.close()
+
+    async def replay() -> None:
+        transport = ReplayTransport(cassette, speed=0)
+        assert await _read(transport) == [b"data: 1\n", b"data: 2\n"]
+        response = await transport.post("http://test/models", {}, b"{}", 1.0)
+        assert response == Response(200, b'{"ok": true}')
+        with pytest.raises(CassetteMiss):
+            await _read(transport)
+        with pytest.raises(CassetteMiss):
+            await _read(transport, b'{"other": 1}')
+
+    asyncio.run(record())
+    asyncio.run(replay())
+
+def test_cancelled_stream_is_not_recorded(tmp_path: Path) -> None:
+    cassette = tmp_path / "session.jsonl"
+
+    async def run() -> None:
+        transport = RecordingTransport(_FakeTransport([b"data: 1\n"], stall=True), cassette)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(_read(transport), 0.1)
+        await transport.close()
+
+    asyncio.run(run())
+    assert cassette.read_text(encoding="utf-8") == ""
+
+def test_sequence_replay_of_post_as_stream_is_a_miss(tmp_path: Path) -> None:
+    cassette = tmp_path / "session.jsonl"
+
+    async def run() -> None:
+        recording = RecordingTransport(_FakeTransport([]), cassette)
+        await recording.post("http://test/models", {}, b"{}", 1.0)
+        await recording.close()
+        with pytest.raises(CassetteMiss):
+            await _read(ReplayTransport(cassette, speed=0, match="sequence"))
+
+    asyncio.run(run())
@@ -0,0 +1,75 @@
+"""
+Tests for token usage accounting.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import json
+from typing import Any, AsyncGenerator, Dict, List, Tuple
+
+import pytest
+
+from tj.scripts.api.openai import OpenAIClient
+from tj.scripts.api.transport import Response, Transport
+from tj.scripts.utils.usage import BudgetExceeded, UsageTracker, attribute
+
+class _StreamTransport(Transport):
+    """Transport answering streams with fixed chunks"""
+
+    def __init__(self, lines: List[bytes]) -> None:
+        super().__init__()
+        self.lines = lines
+        self.bodies: List[Dict[str, Any]] = []
+
+    async def post(self, url: str, headers: Dict[str, str], body: bytes, timeout: float) -> Response:
+        raise AssertionError("unexpected post")
+
+    async def stream(
+        self, url: str, headers: Dict[str, str], body: bytes, timeout: float
+    ) -> AsyncGenerator[bytes, None]:
+        self.bodies.append(json.loads(body))
+        for line in self.lines:
+            yield line
+
+def _client(lines: List[bytes]) -> Tuple[OpenAIClient, _StreamTransport, UsageTracker]:
+    client = OpenAIClient({"base_url": "http://test", "api_key": "key", "model": "model"}, "provider")
+    transport = _StreamTransport(lines)
+    usage = UsageTracker()
+    client.transport = transport
+    client.usage = usage
+    return client, transport, usage
+
+async def _consume(client: OpenAIClient) -> None:
+    with attribute("session", "user"):
+        async for _ in client.stream_chat_completion([{"role": "user", "content": "x" * 40}]):
+            pass
+
+def test_stream_requests_and_records_usage() -> None:
+    client, transport, usage = _client([
+        b'data: {"choices":[{"delta":{"content":"a"}}]}',
+        b'data: {"choices":[],"usage":{"prompt_tokens":12,"completion_tokens":3}}',
+        b"data: [DONE]",
+    ])
+    asyncio.run(_consume(client))
+    assert transport.bodies[0]["stream_options"] == {"include_usage": True}
+    metrics = usage.metrics("session", "user")
+    assert metrics["user"]["total_tokens"] == 15
+    assert metrics["providers"]["provider"]["requests"] == 1
+
+def test_stream_without_usage_is_estimated() -> None:
+    client, _, usage = _client([b'data: {"choices":[{"delta":{"content":"a"}}]}'] * 5 + [b"data: [DONE]"])
+    asyncio.run(_consume(client))
+    totals = usage.metrics(session="session")["session"]
+    assert totals["prompt_tokens"] == 10
+    assert totals["completion_tokens"] == 5
+
+def test_budget_window_change_keeps_usage() -> None:
+    tracker = UsageTracker(user_token_budget=100)
+    tracker.record({"prompt_tokens": 80, "completion_tokens": 40}, "provider", "user")
+    tracker.configure({"user_token_budget": 100, "budget_window": 7200, "path": ""})
+    # The tokens already counted still apply under the new window length
+    with pytest.raises(BudgetExceeded):
+        tracker.check("user")
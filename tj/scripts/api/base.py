@@ -7,6 +7,7 @@ Date: 2024-03-21
 """
 
 from abc import ABC, abstractmethod
+from array import array
 from typing import Dict, Any, Optional, List, Union
 
 class BaseAPIClient(ABC):
@@ -16,6 +17,15 @@ class BaseAPIClient(ABC):
         """
         Initialize the API client.
         
+        Args:
+            config: Configuration dictionary containing API settings
+        """
+        self._configure(config)
+    
+    def _configure(self, config: Dict[str, Any]) -> None:
+        """
+        Read the settings from the configuration.
+        
         Args:
             config: Configuration dictionary containing API settings
         """
@@ -73,4 +83,24 @@ class BaseAPIClient(ABC):
         Returns:
             API response dictionary
         """
-        pass 
\ No newline at end of file
+        pass
+    
+    @abstractmethod
+    async def embeddings(
+        self,
+        inputs: List[str],
+        model: Optional[str] = None,
+        **kwargs
+    ) -> List[array]:
+        """
+        Embeddings API endpoint.
+        
+        Args:
+            inputs: Texts to embed
+            model: Embedding model, defaults to the configured one
+            **kwargs: Additional arguments to pass to the API
+            
+        Returns:
+            One float32 vector per input, in input order
+        """
+        pass
\ No newline at end of file
@@ -0,0 +1,100 @@
+"""
+Request micro-batching.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import copy
+from typing import Awaitable, Callable, Dict, Generic, List, Optional, Set, Tuple, TypeVar
+
+T = TypeVar("T")
+
+class MicroBatcher(Generic[T]):
+    """Coalesce concurrent single-item calls into batched upstream calls"""
+
+    def __init__(
+        self,
+        fetch: Callable[[List[str]], Awaitable[List[T]]],
+        max_batch_size: int = 64,
+        max_wait: float = 0.005
+    ) -> None:
+        """
+        Initialize the batcher.
+
+        Args:
+            fetch: Coroutine function mapping a list of inputs to results in the same order
+            max_batch_size: Maximum number of inputs per upstream call
+            max_wait: Maximum seconds an input waits for its batch to fill
+        """
+        self.fetch = fetch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending: List[Tuple[str, "asyncio.Future[T]"]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    async def submit(self, item: str) -> T:
+        """
+        Submit one input and wait for its result.
+
+        Args:
+            item: Input to process
+
+        Returns:
+            Result for the input
+
+        Raises:
+            Exception: If the batched upstream call fails
+        """
+        loop = asyncio.get_running_loop()
+        future: "asyncio.Future[T]" = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        """Dispatch all pending inputs in batches of at most ``max_batch_size``."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:self.max_batch_size]
+            task = asyncio.create_task(self._run(batch))
+            # Keep a reference so the task is not garbage collected mid-flight
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[str, "asyncio.Future[T]"]]) -> None:
+        """
+        Run one upstream call and resolve the futures of its inputs.
+
+        Args:
+            batch: Pending (input, future) pairs
+        """
+        # Identical inputs within a batch are sent upstream only once
+        unique: Dict[str, int] = {}
+        for item, _ in batch:
+            unique.setdefault(item, len(unique))
+        try:
+            results = await self.fetch(list(unique))
+            if len(results) != len(unique):
+                raise ValueError(f"Upstream returned {len(results)} results for {len(unique)} inputs")
+            delivered: Set[str] = set()
+            for item, future in batch:
+                if future.done():
+                    continue
+                result = results[unique[item]]
+                # Callers of a duplicate input each get their own (possibly mutable) result
+                future.set_result(copy.copy(result) if item in delivered else result)
+                delivered.add(item)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
@@ -7,31 +7,280 @@ Date: 2024-03-21
 """
 
 import asyncio
+import base64
+import gzip
+import logging
+import sys
+import zlib
 import aiohttp
-from typing import Dict, Any, Optional, List, Union
+from array import array
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, AsyncContextManager, AsyncIterator, Dict, Any, Optional, List, Set, Tuple, Union
 from .base import BaseAPIClient
+from .batching import MicroBatcher
+from .scheduler import RequestScheduler
+from .transport import CassetteMiss, HTTPStatusError, ResponseTooLarge, Transport, create_transport
+from ..config import ConfigError
+from ..utils import json_codec
+from ..utils.profiling import profiled
+from ..utils.usage import current_user
+
+if TYPE_CHECKING:
+    from ..cache.semantic import SemanticCache
+    from ..utils.usage import UsageTracker
+
+logger = logging.getLogger(__name__)
+
+# Settings of the connection pool; changing any of them replaces the transport
+_TRANSPORT_KEYS = (
+    "base_url",
+    "pool_size",
+    "keepalive_timeout",
+    "transport",
+    "cassette",
+    "replay_speed",
+    "replay_match",
+    "max_response_size",
+)
 
 class OpenAIClient(BaseAPIClient):
     """OpenAI API client implementation"""
     
-    def __init__(self, config: Dict[str, Any]) -> None:
+    def __init__(self, config: Dict[str, Any], provider: Optional[str] = None) -> None:
         """
         Initialize the OpenAI API client.
         
         Args:
             config: Configuration dictionary containing API settings
+            provider: Provider name the token usage is accounted under, defaults to the model
         """
         super().__init__(config)
+        self.provider = provider or self.model
+        # Network by default; record/replay cassettes for deterministic runs
+        self.transport: Transport = create_transport(config)
+        self._keepalive_task: Optional[asyncio.Task] = None
+        self._last_activity = 0.0
+        self._draining: Set[asyncio.Task] = set()
+        self._embedding_batcher: MicroBatcher[array] = MicroBatcher(
+            self.embeddings,
+            max_batch_size=config.get("embedding_batch_size", 64),
+            max_wait=config.get("embedding_max_wait", 0.005)
+        )
+        self.scheduler = self._create_scheduler(config)
+        # Optional semantic response cache consulted by chat_completion
+        self.semantic_cache: Optional["SemanticCache"] = None
+        # Optional token usage accounting and per-user budgets
+        self.usage: Optional["UsageTracker"] = None
+    
+    def _configure(self, config: Dict[str, Any]) -> None:
+        """
+        Read the settings from the configuration.
+        
+        Args:
+            config: Configuration dictionary containing API settings
+        """
+        super()._configure(config)
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "Accept-Encoding": config.get("accept_encoding", "gzip, deflate")
         }
+        self.request_compression = config.get("request_compression", "none")
+        self.compression_min_size = config.get("compression_min_size", 1024)
+        self.compression_level = config.get("compression_level", 6)
+        self.pool_size = config.get("pool_size", 10)
+        self.warmup_connections = config.get("warmup_connections", 0)
+        self.warmup_path = config.get("warmup_path", "/models")
+        self.keepalive_interval = config.get("keepalive_interval", 0)
+        self.embedding_model = config.get("embedding_model", self.model)
+        self.embedding_encoding = config.get("embedding_encoding", "base64")
+    
+    def enable_semantic_cache(self, settings: Dict[str, Any]) -> None:
+        """
+        Answer paraphrased questions from a semantic cache.
+        
+        Args:
+            settings: Semantic cache configuration section
+            
+        Raises:
+            ConfigError: If the provider has no ``embedding_model``
+        """
+        # Chat models usually cannot serve /embeddings, so never fall back to ``model``
+        if not self.config.get("embedding_model"):
+            raise ConfigError(
+                f"[semantic_cache] requires embedding_model in [api.{self.provider}]"
+            )
+        from ..cache.semantic import SemanticCache
+        self.semantic_cache = SemanticCache.from_config(settings, self.embed)
+    
+    @staticmethod
+    def _create_scheduler(config: Dict[str, Any]) -> Optional[RequestScheduler]:
+        """
+        Create the request scheduler, if enabled.
+        
+        Args:
+            config: Configuration dictionary containing API settings
+            
+        Returns:
+            Scheduler, or ``None`` when ``max_concurrency`` is 0
+        """
+        # Requests beyond max_concurrency wait in a priority-aware queue
+        max_concurrency = config.get("max_concurrency", 0)
+        if max_concurrency <= 0:
+            return None
+        return RequestScheduler(max_concurrency, config.get("priority_weights"))
+    
+    async def update_config(self, config: Dict[str, Any], grace: float = 30.0) -> None:
+        """
+        Switch to new settings without dropping requests in flight.
+        
+        Plain settings (model, API key, timeouts, retries) apply to the next
+        request. When connection settings change, new requests go through a
+        new transport while the old one is closed once its requests finish.
+        A new scheduler only governs requests started after the switch.
+        
+        Args:
+            config: New configuration dictionary containing API settings
+            grace: Maximum seconds to wait for requests on the old transport
+        """
+        old = self.config
+        self._configure(config)
+        self._embedding_batcher.max_batch_size = config.get("embedding_batch_size", 64)
+        self._embedding_batcher.max_wait = config.get("embedding_max_wait", 0.005)
+        
+        if any(old.get(key) != config.get(key) for key in ("max_concurrency", "priority_weights")):
+            self.scheduler = self._create_scheduler(config)
+        
+        if any(old.get(key) != config.get(key) for key in _TRANSPORT_KEYS):
+            previous, self.transport = self.transport, create_transport(config)
+            task = asyncio.create_task(previous.drain(grace))
+            self._draining.add(task)
+            task.add_done_callback(self._draining.discard)
+            logger.info(f"Switched to a new connection pool for {self.base_url}, draining the old one")
+        
+        if old.get("keepalive_interval") != config.get("keepalive_interval") and self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+        await self.prewarm()
+    
+    async def __aenter__(self) -> "OpenAIClient":
+        """Enter the async context."""
+        return self
+    
+    async def __aexit__(self, *exc_info: Any) -> None:
+        """Close pooled connections on exit."""
+        await self.close()
+    
+    async def _probe(self) -> None:
+        """Send a lightweight request that leaves a live connection in the pool."""
+        try:
+            await self.transport.head(f"{self.base_url}{self.warmup_path}", self.headers, self.timeout)
+        except Exception as e:
+            logger.debug(f"Warm-up probe to {self.base_url} failed: {e}")
+    
+    async def warmup(self, connections: Optional[int] = None) -> None:
+        """
+        Pre-open pooled connections to ``base_url``.
+        
+        Concurrent probes force DNS resolution, TCP connect and TLS handshake
+        up front so that the first real requests reuse established connections.
+        
+        Args:
+            connections: Number of connections to open, defaults to ``warmup_connections``
+        """
+        count = min(connections if connections is not None else self.warmup_connections, self.pool_size)
+        if count <= 0:
+            return
+        await asyncio.gather(*(self._probe() for _ in range(count)))
+        self._last_activity = asyncio.get_running_loop().time()
+        logger.debug(f"Warmed up {count} connection(s) to {self.base_url}")
+    
+    async def _keepalive(self) -> None:
+        """Re-warm the pool whenever it has been idle for ``keepalive_interval`` seconds."""
+        loop = asyncio.get_running_loop()
+        while True:
+            idle = loop.time() - self._last_activity
+            if idle >= self.keepalive_interval:
+                await self.warmup()
+                idle = 0.0
+            await asyncio.sleep(self.keepalive_interval - idle)
+    
+    async def prewarm(self) -> None:
+        """
+        Warm up the connection pool and keep it warm while idle, as configured.
+        
+        Does nothing unless ``warmup_connections`` is set.
+        """
+        if self.warmup_connections <= 0:
+            return
+        await self.warmup()
+        if self.keepalive_interval > 0 and self._keepalive_task is None:
+            self._keepalive_task = asyncio.create_task(self._keepalive())
+    
+    async def close(self, grace: float = 0.0) -> None:
+        """
+        Stop idle probes, persist the semantic cache and close the transport.
+        
+        Args:
+            grace: Maximum seconds to wait for requests in flight before closing
+        """
+        if self.semantic_cache is not None:
+            try:
+                self.semantic_cache.save()
+            except Exception as e:
+                # Losing the cache must not keep the connections open
+                logger.error(f"Failed to save the semantic cache: {e}")
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+        for task in self._draining:
+            task.cancel()
+        await asyncio.gather(*self._draining, return_exceptions=True)
+        if grace > 0:
+            await self.transport.drain(grace)
+        else:
+            await self.transport.close()
+    
+    def _admit(self, priority: str, user: Optional[str]) -> str:
+        """
+        Apply the user's token budgets to a request.
+        
+        Args:
+            priority: Requested priority class
+            user: End-user identifier
+            
+        Returns:
+            Priority class to schedule the request with, lower for a heavy user
+            
+        Raises:
+            BudgetExceeded: If the user has used up their token budget
+        """
+        if self.usage is None:
+            return priority
+        self.usage.check(user)
+        return self.usage.priority_for(priority, user)
+    
+    def _slot(self, priority: str, user: Optional[str]) -> AsyncContextManager[Any]:
+        """
+        Get the scheduler slot a request must hold while in flight.
+        
+        Args:
+            priority: Priority class (interactive, background or bulk)
+            user: End-user identifier, for fairness within the class
+            
+        Returns:
+            Async context manager holding the slot
+        """
+        if self.scheduler is None:
+            return nullcontext()
+        return self.scheduler.slot(priority, user)
     
     async def _make_request(
         self,
         url: str,
         payload: Dict[str, Any],
-        retry_count: Optional[int] = None
+        retry_count: Optional[int] = None,
+        priority: str = "interactive"
     ) -> Dict[str, Any]:
         """
         Make an API request with retry logic.
@@ -40,48 +289,219 @@ class OpenAIClient(BaseAPIClient):
             url: API endpoint URL
             payload: Request payload
             retry_count: Number of retries remaining
+            priority: Priority class (interactive, background or bulk)
             
         Returns:
             API response dictionary
             
         Raises:
+            BudgetExceeded: If the user has used up their token budget
             Exception: If the API request fails after all retries
         """
         retry_count = retry_count if retry_count is not None else self.retry_count
         
+        user = payload.get("user") or current_user()
+        priority = self._admit(priority, user)
+        
+        # Encode (and compress) once; retries resend the same bytes
+        body, headers = self._encode(payload)
+        async with self._slot(priority, user):
+            response = await self._post(url, body, retry_count, headers)
+        if self.usage is not None:
+            self.usage.record(response.get("usage"), self.provider, user)
+        return response
+    
+    def _encode(self, payload: Dict[str, Any]) -> Tuple[bytes, Dict[str, str]]:
+        """
+        Encode a request payload, compressed if configured and large enough.
+        
+        Args:
+            payload: Request payload
+            
+        Returns:
+            Tuple of the request body and the headers to send it with
+        """
+        body = json_codec.dumps(payload)
+        if self.request_compression == "none" or len(body) < self.compression_min_size:
+            return body, self.headers
+        if self.request_compression == "gzip":
+            # Fixed mtime keeps the body deterministic (e.g. for cassette matching)
+            body = gzip.compress(body, self.compression_level, mtime=0)
+        else:
+            body = zlib.compress(body, self.compression_level)
+        return body, {**self.headers, "Content-Encoding": self.request_compression}
+    
+    @staticmethod
+    def _error_message(body: bytes) -> str:
+        """
+        Extract the error message from an error response body.
+        
+        Args:
+            body: Raw response body
+            
+        Returns:
+            Error message
+        """
+        try:
+            return json_codec.loads(body).get('error', {}).get('message', 'Unknown error')
+        except (ValueError, AttributeError):
+            return 'Unknown error'
+    
+    async def _post(
+        self,
+        url: str,
+        body: bytes,
+        retry_count: int,
+        headers: Optional[Dict[str, str]] = None
+    ) -> Dict[str, Any]:
+        """
+        Post an encoded JSON body with retry logic.
+        
+        Args:
+            url: API endpoint URL
+            body: Encoded request payload
+            retry_count: Number of retries remaining
+            headers: Request headers, defaults to ``headers``
+            
+        Returns:
+            API response dictionary
+            
+        Raises:
+            Exception: If the API request fails after all retries
+        """
+        self._last_activity = asyncio.get_running_loop().time()
+        
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    headers=self.headers,
-                    json=payload,
-                    timeout=self.timeout
-                ) as response:
-                    if response.status != 200:
-                        error_data = await response.json()
-                        error_msg = error_data.get('error', {}).get('message', 'Unknown error')
-                        if retry_count > 0:
-                            await asyncio.sleep(self.retry_delay)
-                            return await self._make_request(url, payload, retry_count - 1)
-                        raise Exception(f"API request failed: {error_msg}")
-                    return await response.json()
+            transport = self.transport
+            async with transport.in_use():
+                response = await transport.post(url, headers or self.headers, body, self.timeout)
+            if response.status != 200:
+                error_msg = self._error_message(response.body)
+                if retry_count > 0:
+                    await asyncio.sleep(self.retry_delay)
+                    return await self._post(url, body, retry_count - 1, headers)
+                raise Exception(f"API request failed: {error_msg}")
+            # Decode the raw bytes once with the active JSON backend
+            return json_codec.loads(response.body)
+        except (CassetteMiss, ResponseTooLarge):
+            # Retrying cannot produce a missing recording or shrink the response
+            raise
         except aiohttp.ClientError as e:
             if retry_count > 0:
                 await asyncio.sleep(self.retry_delay)
-                return await self._make_request(url, payload, retry_count - 1)
+                return await self._post(url, body, retry_count - 1, headers)
             raise Exception(f"Network error: {str(e)}")
         except Exception as e:
             if retry_count > 0:
                 await asyncio.sleep(self.retry_delay)
-                return await self._make_request(url, payload, retry_count - 1)
+                return await self._post(url, body, retry_count - 1, headers)
             raise Exception(f"Unexpected error: {str(e)}")
     
+    async def _stream(
+        self,
+        url: str,
+        payload: Dict[str, Any],
+        priority: str = "interactive"
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Make a streaming API request and yield server-sent event chunks.
+        
+        Args:
+            url: API endpoint URL
+            payload: Request payload
+            priority: Priority class (interactive, background or bulk)
+            
+        Yields:
+            Decoded chunk dictionaries
+            
+        Raises:
+            BudgetExceeded: If the user has used up their token budget
+            Exception: If the API request fails
+        """
+        user = payload.get("user") or current_user()
+        priority = self._admit(priority, user)
+        body, headers = self._encode(payload)
+        chunks = 0
+        usage: Optional[Dict[str, Any]] = None
+        async with self._slot(priority, user):
+            self._last_activity = asyncio.get_running_loop().time()
+            transport = self.transport
+            lines = transport.stream(url, headers, body, self.timeout)
+            async with transport.in_use():
+                try:
+                    async for line in lines:
+                        line = line.strip()
+                        if not line.startswith(b"data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == b"[DONE]":
+                            break
+                        chunk = json_codec.loads(data)
+                        chunks += 1
+                        # Usage arrives in the last chunk (see stream_options in stream_chat_completion)
+                        usage = chunk.get("usage") or usage
+                        yield chunk
+                except HTTPStatusError as e:
+                    raise Exception(f"API request failed: {self._error_message(e.body)}")
+                finally:
+                    # Release the connection (and finish a recording) without waiting for garbage collection
+                    await lines.aclose()
+                    if self.usage is not None and chunks:
+                        self.usage.record(usage or self._estimate_usage(payload, chunks), self.provider, user)
+    
+    @staticmethod
+    def _estimate_usage(payload: Dict[str, Any], chunks: int) -> Dict[str, Any]:
+        """
+        Estimate the usage of a stream whose provider did not report it.
+        
+        Args:
+            payload: Request payload
+            chunks: Chunks received, roughly one token each
+            
+        Returns:
+            Usage dictionary with about four characters per prompt token
+        """
+        characters = sum(len(str(message.get("content") or "")) for message in payload.get("messages", []))
+        return {"prompt_tokens": characters // 4, "completion_tokens": chunks}
+    
+    def _chat_payload(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: Optional[float],
+        max_tokens: Optional[int],
+        stream: bool,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Build a chat completion request payload.
+        
+        Args:
+            messages: List of message dictionaries
+            temperature: Controls randomness (0.0 to 1.0)
+            max_tokens: Maximum tokens to generate
+            stream: Whether to stream the response
+            **kwargs: Additional arguments to pass to the API
+            
+        Returns:
+            Request payload
+        """
+        return {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature or self.config.get("temperature", 0.7),
+            "max_tokens": max_tokens or self.config.get("max_tokens", 2000),
+            "stream": stream,
+            **kwargs
+        }
+    
+    @profiled("OpenAIClient.chat_completion")
     async def chat_completion(
         self,
         messages: List[Dict[str, str]],
         temperature: Optional[float] = None,
         max_tokens: Optional[int] = None,
         stream: bool = False,
+        priority: str = "interactive",
         **kwargs
     ) -> Dict[str, Any]:
         """
@@ -92,23 +512,62 @@ class OpenAIClient(BaseAPIClient):
             temperature: Controls randomness (0.0 to 1.0)
             max_tokens: Maximum tokens to generate
             stream: Whether to stream the response
+            priority: Scheduling priority class (interactive, background or bulk)
             **kwargs: Additional arguments to pass to the API
             
         Returns:
             API response dictionary
         """
         url = f"{self.base_url}/chat/completions"
+        payload = self._chat_payload(messages, temperature, max_tokens, stream, **kwargs)
         
-        payload = {
-            "model": self.model,
-            "messages": messages,
-            "temperature": temperature or self.config.get("temperature", 0.7),
-            "max_tokens": max_tokens or self.config.get("max_tokens", 2000),
-            "stream": stream,
-            **kwargs
-        }
+        # Only plain, non-streaming requests are answered from the semantic cache
+        if self.semantic_cache is None or stream or kwargs:
+            return await self._make_request(url, payload, priority=priority)
         
-        return await self._make_request(url, payload)
+        # The cache is an optimization: an embeddings failure must not fail the turn
+        try:
+            cached, key = await self.semantic_cache.lookup(messages, self.model)
+        except Exception as e:
+            logger.error(f"Semantic cache lookup failed, sending uncached: {e}")
+            return await self._make_request(url, payload, priority=priority)
+        if cached is not None:
+            return cached
+        response = await self._make_request(url, payload, priority=priority)
+        try:
+            self.semantic_cache.store(key, response)
+        except Exception as e:
+            logger.error(f"Failed to store the response in the semantic cache: {e}")
+        return response
+    
+    @profiled("OpenAIClient.stream_chat_completion")
+    async def stream_chat_completion(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        priority: str = "interactive",
+        **kwargs
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streaming chat completion API endpoint.
+        
+        Args:
+            messages: List of message dictionaries
+            temperature: Controls randomness (0.0 to 1.0)
+            max_tokens: Maximum tokens to generate
+            priority: Scheduling priority class (interactive, background or bulk)
+            **kwargs: Additional arguments to pass to the API
+            
+        Yields:
+            Chat completion chunk dictionaries
+        """
+        url = f"{self.base_url}/chat/completions"
+        # Without include_usage, OpenAI-compatible servers do not report the usage of a stream
+        kwargs.setdefault("stream_options", {"include_usage": True})
+        payload = self._chat_payload(messages, temperature, max_tokens, True, **kwargs)
+        async for chunk in self._stream(url, payload, priority):
+            yield chunk
     
     async def completion(
         self,
@@ -116,6 +575,7 @@ class OpenAIClient(BaseAPIClient):
         temperature: Optional[float] = None,
         max_tokens: Optional[int] = None,
         stream: bool = False,
+        priority: str = "interactive",
         **kwargs
     ) -> Dict[str, Any]:
         """
@@ -126,6 +586,7 @@ class OpenAIClient(BaseAPIClient):
             temperature: Controls randomness (0.0 to 1.0)
             max_tokens: Maximum tokens to generate
             stream: Whether to stream the response
+            priority: Scheduling priority class (interactive, background or bulk)
             **kwargs: Additional arguments to pass to the API
             
         Returns:
@@ -142,4 +603,75 @@ class OpenAIClient(BaseAPIClient):
             **kwargs
         }
         
-        return await self._make_request(url, payload) 
\ No newline at end of file
+        return await self._make_request(url, payload, priority=priority)
+    
+    @staticmethod
+    def _decode_embedding(embedding: Union[str, List[float]]) -> array:
+        """
+        Convert an embedding from the API into a float32 array.
+        
+        Args:
+            embedding: Base64 encoded little-endian float32 data or list of floats
+            
+        Returns:
+            Embedding vector
+        """
+        if isinstance(embedding, str):
+            vector = array("f")
+            vector.frombytes(base64.b64decode(embedding))
+            if sys.byteorder != "little":
+                vector.byteswap()
+            return vector
+        return array("f", embedding)
+    
+    async def embeddings(
+        self,
+        inputs: List[str],
+        model: Optional[str] = None,
+        priority: str = "interactive",
+        **kwargs
+    ) -> List[array]:
+        """
+        Embeddings API endpoint.
+        
+        Requests base64 encoded vectors by default (``embedding_encoding``), which
+        avoids parsing one JSON number per dimension.
+        
+        Args:
+            inputs: Texts to embed
+            model: Embedding model, defaults to ``embedding_model``
+            priority: Scheduling priority class (interactive, background or bulk)
+            **kwargs: Additional arguments to pass to the API
+            
+        Returns:
+            One float32 vector per input, in input order
+        """
+        url = f"{self.base_url}/embeddings"
+        
+        payload = {
+            "model": model or self.embedding_model,
+            "input": inputs,
+            **kwargs
+        }
+        if self.embedding_encoding == "base64":
+            payload.setdefault("encoding_format", "base64")
+        
+        response = await self._make_request(url, payload, priority=priority)
+        data = sorted(response["data"], key=lambda item: item["index"])
+        return [self._decode_embedding(item["embedding"]) for item in data]
+    
+    async def embed(self, text: str) -> array:
+        """
+        Embed a single text.
+        
+        Concurrent calls are coalesced into batched ``embeddings`` requests of up
+        to ``embedding_batch_size`` texts, waiting at most ``embedding_max_wait``
+        seconds for a batch to fill.
+        
+        Args:
+            text: Text to embed
+            
+        Returns:
+            Embedding vector
+        """
+        return await self._embedding_batcher.submit(text)
\ No newline at end of file
@@ -0,0 +1,192 @@
+"""
+Priority-aware request scheduling.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+
+from ..utils.metrics import LatencyStats
+
+# Priority classes, most latency sensitive first
+PRIORITIES = ("interactive", "background", "bulk")
+
+DEFAULT_WEIGHTS: Dict[str, float] = {"interactive": 8, "background": 2, "bulk": 1}
+
+@dataclass
+class _Waiter:
+    """Request waiting for a slot"""
+    future: "asyncio.Future[None]"
+    enqueued: float
+
+class _PriorityClass:
+    """Queue of one priority class, round-robin across users"""
+
+    def __init__(self, weight: float) -> None:
+        """
+        Initialize the class queue.
+
+        Args:
+            weight: Share of slots relative to the other classes
+        """
+        self.weight = weight
+        self.virtual_time = 0.0
+        self.pending = 0
+        self.wait_stats = LatencyStats()
+        self._users: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+
+    def push(self, user: str, waiter: _Waiter) -> None:
+        """
+        Queue a waiter behind the user's earlier requests.
+
+        Args:
+            user: User the request belongs to
+            waiter: Waiting request
+        """
+        self._users.setdefault(user, deque()).append(waiter)
+        self.pending += 1
+
+    def pop(self) -> _Waiter:
+        """
+        Take the next waiter, rotating across users.
+
+        Returns:
+            Oldest waiter of the user at the head of the rotation
+        """
+        user, waiters = next(iter(self._users.items()))
+        waiter = waiters.popleft()
+        if waiters:
+            self._users.move_to_end(user)
+        else:
+            del self._users[user]
+        self.pending -= 1
+        return waiter
+
+class RequestScheduler:
+    """Weighted fair queuing of requests across priority classes and users"""
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        weights: Optional[Dict[str, float]] = None
+    ) -> None:
+        """
+        Initialize the scheduler.
+
+        When all slots are busy, the next slot goes to the non-empty class with
+        the lowest virtual time, which advances by ``1 / weight`` per grant, so
+        contending classes share slots in proportion to their weights. Within
+        a class, users are served round-robin.
+
+        Args:
+            max_concurrency: Maximum number of requests in flight
+            weights: Relative weight per priority class
+        """
+        self.max_concurrency = max_concurrency
+        self._classes = {
+            name: _PriorityClass(weight)
+            for name, weight in {**DEFAULT_WEIGHTS, **(weights or {})}.items()
+        }
+        self._active = 0
+        self._virtual_clock = 0.0
+
+    @property
+    def queued(self) -> int:
+        """Number of requests waiting for a slot."""
+        return sum(cls.pending for cls in self._classes.values())
+
+    @asynccontextmanager
+    async def slot(self, priority: str = "interactive", user: Optional[str] = None) -> AsyncIterator[None]:
+        """
+        Hold a request slot for the duration of the context.
+
+        Args:
+            priority: Priority class of the request
+            user: User the request belongs to, for fairness within the class
+
+        Yields:
+            None once a slot has been granted
+        """
+        await self.acquire(priority, user)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority: str = "interactive", user: Optional[str] = None) -> None:
+        """
+        Wait for a request slot.
+
+        Args:
+            priority: Priority class of the request
+            user: User the request belongs to, for fairness within the class
+
+        Raises:
+            ValueError: If the priority class is unknown
+        """
+        cls = self._classes.get(priority)
+        if cls is None:
+            raise ValueError(f"Unknown priority class: {priority}")
+
+        if self._active < self.max_concurrency and not self.queued:
+            self._active += 1
+            cls.wait_stats.observe(0.0)
+            return
+
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(future=loop.create_future(), enqueued=loop.time())
+        cls.push(user or "", waiter)
+        # Slots may be free if the queue only held cancelled waiters
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            # Hand a slot granted in the meantime on to the next waiter
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """Release a request slot and grant it to the next waiter."""
+        self._active -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Grant free slots to waiters in weighted fair order."""
+        loop = asyncio.get_running_loop()
+        while self._active < self.max_concurrency:
+            candidates = [cls for cls in self._classes.values() if cls.pending]
+            if not candidates:
+                return
+            # Classes returning from idle start at the current clock instead of
+            # spending credit accumulated while they had nothing queued
+            cls = min(candidates, key=lambda c: max(c.virtual_time, self._virtual_clock))
+            waiter = cls.pop()
+            if waiter.future.done():
+                continue  # Cancelled while queued
+            start = max(cls.virtual_time, self._virtual_clock)
+            self._virtual_clock = start
+            cls.virtual_time = start + 1 / cls.weight
+            self._active += 1
+            cls.wait_stats.observe(loop.time() - waiter.enqueued)
+            waiter.future.set_result(None)
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Get queue-time metrics.
+
+        Returns:
+            Dictionary with in-flight count, queue depth and wait-time
+            statistics (seconds) per priority class
+        """
+        return {
+            "active": self._active,
+            "queued": {name: cls.pending for name, cls in self._classes.items()},
+            "wait": {name: cls.wait_stats.snapshot() for name, cls in self._classes.items()},
+        }
@@ -0,0 +1,513 @@
+"""
+HTTP transports used by the API clients.
+
+``HTTPTransport`` talks to the network. ``RecordingTransport`` wraps it and
+appends every exchange, including the arrival time of each streamed line, to
+a cassette file; ``ReplayTransport`` serves those exchanges back from the
+cassette with the original or scaled timing, without any network access.
+
+A cassette is a JSON Lines file with one exchange per line, gzip compressed
+when its name ends in ``.gz``. Request headers are never recorded.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import gzip
+import hashlib
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, Any, AsyncGenerator, AsyncIterator, Deque, Dict, List, Optional, Union
+
+import aiohttp
+
+from ..utils import json_codec
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Response:
+    """Buffered HTTP response"""
+    status: int
+    body: bytes
+
+class HTTPStatusError(Exception):
+    """Streaming request answered with a non-200 status"""
+
+    def __init__(self, status: int, body: bytes) -> None:
+        """
+        Initialize the error.
+
+        Args:
+            status: HTTP status code
+            body: Raw response body
+        """
+        self.status = status
+        self.body = body
+        super().__init__(f"HTTP {status}")
+
+class CassetteMiss(Exception):
+    """No recorded exchange matches a replayed request"""
+
+class ResponseTooLarge(Exception):
+    """Response exceeded the configured maximum size"""
+
+    def __init__(self, limit: int) -> None:
+        """
+        Initialize the error.
+
+        Args:
+            limit: Maximum response size in bytes
+        """
+        self.limit = limit
+        super().__init__(f"Response exceeded the maximum size of {limit} bytes")
+
+class Transport(ABC):
+    """Sends encoded requests and returns raw responses"""
+
+    active = 0
+
+    @asynccontextmanager
+    async def in_use(self) -> AsyncIterator[None]:
+        """
+        Count a request as in flight for the duration of the context.
+
+        Yields:
+            None
+        """
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+
+    async def drain(self, grace: float) -> None:
+        """
+        Wait for in-flight requests to finish, then close the transport.
+
+        Args:
+            grace: Maximum seconds to wait before closing anyway
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + grace
+        try:
+            while self.active and loop.time() < deadline:
+                await asyncio.sleep(0.1)
+            if self.active:
+                logger.warning(f"Closing transport with {self.active} request(s) still in flight")
+        finally:
+            await self.close()
+
+    @abstractmethod
+    async def post(self, url: str, headers: Dict[str, str], body: bytes, timeout: float) -> Response:
+        """
+        Post a request and read the whole response.
+
+        Args:
+            url: Request URL
+            headers: Request headers
+            body: Encoded request body
+            timeout: Total timeout in seconds
+
+        Returns:
+            Buffered response
+        """
+        pass
+
+    @abstractmethod
+    def stream(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        body: bytes,
+        timeout: float
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Post a request and yield the response line by line.
+
+        Args:
+            url: Request URL
+            headers: Request headers
+            body: Encoded request body
+            timeout: Maximum gap between lines in seconds
+
+        Yields:
+            Response lines
+
+        Raises:
+            HTTPStatusError: If the response status is not 200
+        """
+        pass
+
+    async def head(self, url: str, headers: Dict[str, str], timeout: float) -> None:
+        """
+        Send a HEAD request, used to warm up connections.
+
+        Args:
+            url: Request URL
+            headers: Request headers
+            timeout: Total timeout in seconds
+        """
+
+    async def close(self) -> None:
+        """Release the resources held by the transport."""
+
+class HTTPTransport(Transport):
+    """Transport over a pooled aiohttp session"""
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        keepalive_timeout: float = 60,
+        max_response_size: int = 0
+    ) -> None:
+        """
+        Initialize the transport.
+
+        Args:
+            pool_size: Maximum number of pooled connections
+            keepalive_timeout: Seconds an idle pooled connection is kept open
+            max_response_size: Maximum decoded response size in bytes, 0 for no limit
+        """
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.max_response_size = max_response_size
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Get the pooled HTTP session, creating it on first use.
+
+        Returns:
+            Shared client session
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                ttl_dns_cache=300,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def post(self, url: str, headers: Dict[str, str], body: bytes, timeout: float) -> Response:
+        """Post a request and read the whole response."""
+        async with self._get_session().post(url, headers=headers, data=body, timeout=timeout) as response:
+            return Response(response.status, await self._read(response))
+
+    async def _read(self, response: aiohttp.ClientResponse) -> bytes:
+        """
+        Read a response body, at most ``max_response_size`` bytes.
+
+        Reads incrementally, so an oversized (or decompressing) body is
+        abandoned as soon as it crosses the limit instead of being buffered.
+
+        Args:
+            response: Response to read
+
+        Returns:
+            Decoded response body
+
+        Raises:
+            ResponseTooLarge: If the body exceeds the limit
+        """
+        limit = self.max_response_size
+        if not limit:
+            return await response.read()
+        # Compressed bodies only grow when decoded, so the declared length is a lower bound
+        if response.content_length is not None and response.content_length > limit:
+            raise ResponseTooLarge(limit)
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(65536):
+            body += chunk
+            if len(body) > limit:
+                raise ResponseTooLarge(limit)
+        return bytes(body)
+
+    async def stream(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        body: bytes,
+        timeout: float
+    ) -> AsyncGenerator[bytes, None]:
+        """Post a request and yield the response line by line."""
+        # Bound the gap between lines rather than the whole stream
+        client_timeout = aiohttp.ClientTimeout(total=None, sock_read=timeout)
+        async with self._get_session().post(url, headers=headers, data=body, timeout=client_timeout) as response:
+            if response.status != 200:
+                raise HTTPStatusError(response.status, await self._read(response))
+            received = 0
+            async for line in response.content:
+                received += len(line)
+                if self.max_response_size and received > self.max_response_size:
+                    raise ResponseTooLarge(self.max_response_size)
+                yield line
+
+    async def head(self, url: str, headers: Dict[str, str], timeout: float) -> None:
+        """Send a HEAD request, used to warm up connections."""
+        async with self._get_session().head(url, headers=headers, timeout=timeout) as response:
+            await response.read()
+
+    async def close(self) -> None:
+        """Close pooled connections."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+def _open_cassette(path: Path, mode: str) -> IO[str]:
+    """
+    Open a cassette file, gzip compressed if its name ends in ``.gz``.
+
+    Args:
+        path: Cassette path
+        mode: ``"r"`` or ``"a"``
+
+    Returns:
+        Text file object
+    """
+    if path.suffix == ".gz":
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def request_key(url: str, body: bytes) -> str:
+    """
+    Get the key matching a replayed request to its recording.
+
+    Args:
+        url: Request URL
+        body: Encoded request body
+
+    Returns:
+        Hex digest of the URL and body
+    """
+    return hashlib.sha1(url.encode("utf-8") + b"\n" + body).hexdigest()
+
+class RecordingTransport(Transport):
+    """Transport that appends every exchange of an inner transport to a cassette"""
+
+    def __init__(self, inner: Transport, path: Union[str, Path]) -> None:
+        """
+        Initialize the transport.
+
+        Args:
+            inner: Transport performing the requests
+            path: Cassette path, appended to if it exists
+        """
+        self.inner = inner
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = _open_cassette(self.path, "a")
+
+    def _write(self, exchange: Dict[str, Any]) -> None:
+        """
+        Append one exchange to the cassette.
+
+        Args:
+            exchange: Exchange record
+        """
+        self._file.write(json_codec.dumps(exchange).decode("utf-8") + "\n")
+        self._file.flush()
+
+    async def post(self, url: str, headers: Dict[str, str], body: bytes, timeout: float) -> Response:
+        """Post a request through the inner transport and record the exchange."""
+        started = time.perf_counter()
+        response = await self.inner.post(url, headers, body, timeout)
+        self._write({
+            "key": request_key(url, body),
+            "url": url,
+            "status": response.status,
+            "latency": round(time.perf_counter() - started, 6),
+            "body": response.body.decode("utf-8", "replace"),
+        })
+        return response
+
+    async def stream(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        body: bytes,
+        timeout: float
+    ) -> AsyncGenerator[bytes, None]:
+        """Stream a request through the inner transport and record each line with its delay."""
+        exchange: Dict[str, Any] = {"key": request_key(url, body), "url": url, "status": 200}
+        chunks: List[List[Any]] = []
+        failed = False
+        last = time.perf_counter()
+        try:
+            async for line in self.inner.stream(url, headers, body, timeout):
+                now = time.perf_counter()
+                # Blank separator lines carry no data; their delay is folded into the next line
+                if line.strip():
+                    chunks.append([round(now - last, 6), line.decode("utf-8", "replace")])
+                    last = now
+                yield line
+        except HTTPStatusError as e:
+            exchange.update(status=e.status, body=e.body.decode("utf-8", "replace"))
+            raise
+        except GeneratorExit:
+            # Streams the caller stopped reading early are recorded as far as they were read
+            raise
+        except BaseException:
+            # A stream cut short by an error or a cancellation would replay as a complete one
+            failed = True
+            raise
+        finally:
+            if not failed:
+                exchange["chunks"] = chunks
+                self._write(exchange)
+
+    async def head(self, url: str, headers: Dict[str, str], timeout: float) -> None:
+        """Send a HEAD request through the inner transport without recording it."""
+        await self.inner.head(url, headers, timeout)
+
+    async def close(self) -> None:
+        """Close the cassette and the inner transport."""
+        self._file.close()
+        await self.inner.close()
+
+class ReplayTransport(Transport):
+    """Transport serving recorded exchanges from a cassette"""
+
+    def __init__(self, path: Union[str, Path], speed: float = 1.0, match: str = "body") -> None:
+        """
+        Initialize the transport.
+
+        Args:
+            path: Cassette path
+            speed: Timing scale; 2.0 replays twice as fast, 0 without any delay
+            match: ``"body"`` to serve the exchange recorded for the same URL and
+                body, ``"sequence"`` to serve exchanges in recorded order
+                regardless of the request
+
+        Raises:
+            ValueError: If the match mode is unknown
+        """
+        if match not in ("body", "sequence"):
+            raise ValueError(f"Unknown replay match mode: {match}")
+        self.path = Path(path)
+        self.speed = speed
+        self.match = match
+        self.replayed = 0
+        self.simulated = 0.0
+        self._sequence: Deque[Dict[str, Any]] = deque()
+        self._by_key: Dict[str, Deque[Dict[str, Any]]] = defaultdict(deque)
+        with _open_cassette(self.path, "r") as cassette:
+            for line in cassette:
+                if line.strip():
+                    exchange = json_codec.loads(line)
+                    self._sequence.append(exchange)
+                    # Repeated identical requests (e.g. retries) replay in recorded order
+                    self._by_key[exchange["key"]].append(exchange)
+        logger.debug(f"Loaded {len(self._sequence)} exchange(s) from {self.path}")
+
+    def _next(self, url: str, body: bytes) -> Dict[str, Any]:
+        """
+        Take the recorded exchange answering a request.
+
+        Args:
+            url: Request URL
+            body: Encoded request body
+
+        Returns:
+            Exchange record
+
+        Raises:
+            CassetteMiss: If no recorded exchange is left for the request
+        """
+        queue = self._sequence if self.match == "sequence" else self._by_key.get(request_key(url, body))
+        if not queue:
+            raise CassetteMiss(f"No recorded exchange left for {url} in {self.path}")
+        self.replayed += 1
+        return queue.popleft()
+
+    async def _wait(self, seconds: float) -> None:
+        """
+        Sleep for a recorded delay, scaled by ``speed``.
+
+        Args:
+            seconds: Recorded delay in seconds
+        """
+        self.simulated += seconds
+        if self.speed > 0 and seconds > 0:
+            await asyncio.sleep(seconds / self.speed)
+
+    async def post(self, url: str, headers: Dict[str, str], body: bytes, timeout: float) -> Response:
+        """Serve the recorded response after its recorded latency."""
+        exchange = self._next(url, body)
+        if "chunks" in exchange:
+            raise CassetteMiss(f"Exchange recorded for {exchange['url']} is a stream, not a post")
+        await self._wait(exchange.get("latency", 0.0))
+        return Response(exchange["status"], exchange.get("body", "").encode("utf-8"))
+
+    async def stream(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        body: bytes,
+        timeout: float
+    ) -> AsyncGenerator[bytes, None]:
+        """Serve the recorded lines with their recorded delays."""
+        exchange = self._next(url, body)
+        if exchange["status"] != 200:
+            raise HTTPStatusError(exchange["status"], exchange.get("body", "").encode("utf-8"))
+        if "chunks" not in exchange:
+            raise CassetteMiss(f"Exchange recorded for {exchange['url']} is a post, not a stream")
+        for delay, line in exchange["chunks"]:
+            await self._wait(delay)
+            yield line.encode("utf-8")
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Get replay counters.
+
+        Wall-clock time of a replay minus ``simulated`` (divided by ``speed``)
+        is the time spent in client code.
+
+        Returns:
+            Dictionary with replayed and remaining exchange counts and the
+            total recorded delay in seconds
+        """
+        remaining = (
+            len(self._sequence) if self.match == "sequence"
+            else sum(len(queue) for queue in self._by_key.values())
+        )
+        return {"replayed": self.replayed, "remaining": remaining, "simulated": self.simulated}
+
+def create_transport(config: Dict[str, Any]) -> Transport:
+    """
+    Create the transport configured for an API.
+
+    Args:
+        config: API configuration section
+
+    Returns:
+        Transport instance
+
+    Raises:
+        ValueError: If the transport mode is unknown
+    """
+    mode = config.get("transport", "http")
+    if mode == "replay":
+        return ReplayTransport(
+            config.get("cassette", "cassettes/session.jsonl"),
+            speed=config.get("replay_speed", 1.0),
+            match=config.get("replay_match", "body")
+        )
+    http = HTTPTransport(
+        config.get("pool_size", 10),
+        config.get("keepalive_timeout", 60),
+        config.get("max_response_size", 10 * 1024 * 1024)
+    )
+    if mode == "record":
+        return RecordingTransport(http, config.get("cassette", "cassettes/session.jsonl"))
+    if mode != "http":
+        raise ValueError(f"Unknown transport: {mode}")
+    return http
@@ -0,0 +1,492 @@
+"""
+Semantic response cache backed by a local vector index.
+
+Requires NumPy (``pip install -e ".[semantic]"``).
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import hashlib
+import logging
+import os
+import time
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from ..utils import json_codec
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depends on the environment
+    np = None
+
+logger = logging.getLogger(__name__)
+
+class VectorIndex:
+    """In-process cosine similarity index with exact and approximate search"""
+
+    def __init__(
+        self,
+        exact_threshold: int = 2048,
+        n_tables: int = 4,
+        n_bits: int = 12,
+        seed: int = 0
+    ) -> None:
+        """
+        Initialize the index.
+
+        Search is brute force up to ``exact_threshold`` vectors. Beyond that,
+        random-hyperplane LSH tables narrow the search to candidate vectors
+        sharing a bucket with the query in any table.
+
+        Args:
+            exact_threshold: Maximum size searched by brute force
+            n_tables: Number of LSH tables
+            n_bits: Hyperplanes (signature bits) per table
+            seed: Random seed for the hyperplanes
+
+        Raises:
+            ImportError: If NumPy is not installed
+        """
+        if np is None:
+            raise ImportError('The semantic cache requires NumPy: pip install -e ".[semantic]"')
+        self.exact_threshold = exact_threshold
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.seed = seed
+        self.vectors: Optional["np.ndarray"] = None
+        self.valid: Optional["np.ndarray"] = None
+        self._planes: Optional["np.ndarray"] = None
+        self._buckets: List[Dict[int, Set[int]]] = [{} for _ in range(n_tables)]
+        self._signatures: Dict[int, "np.ndarray"] = {}
+        self._free: List[int] = []
+        self._used = 0
+
+    def __len__(self) -> int:
+        """Number of vectors in the index."""
+        return self._used - len(self._free)
+
+    def _allocate(self, dim: int, capacity: int = 256) -> None:
+        """
+        Allocate storage and hyperplanes for vectors of a given dimension.
+
+        Args:
+            dim: Vector dimension
+            capacity: Initial number of slots
+        """
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.valid = np.zeros(capacity, dtype=bool)
+        rng = np.random.default_rng(self.seed)
+        self._planes = rng.standard_normal((self.n_tables, self.n_bits, dim)).astype(np.float32)
+
+    def _grow(self) -> None:
+        """Double the slot capacity."""
+        capacity = len(self.vectors) * 2
+        vectors = np.zeros((capacity, self.vectors.shape[1]), dtype=np.float32)
+        vectors[:len(self.vectors)] = self.vectors
+        valid = np.zeros(capacity, dtype=bool)
+        valid[:len(self.valid)] = self.valid
+        self.vectors, self.valid = vectors, valid
+
+    def _signature(self, vectors: "np.ndarray") -> "np.ndarray":
+        """
+        Compute LSH bucket keys.
+
+        Args:
+            vectors: Array of shape (n, dim)
+
+        Returns:
+            Integer array of shape (n, n_tables)
+        """
+        bits = np.einsum("tbd,nd->ntb", self._planes, vectors) > 0
+        weights = 1 << np.arange(self.n_bits, dtype=np.int64)
+        return (bits * weights).sum(axis=2)
+
+    @staticmethod
+    def normalize(vector: Union[array, "np.ndarray"]) -> "np.ndarray":
+        """
+        Convert a vector to a unit-length float32 array.
+
+        Args:
+            vector: Input vector
+
+        Returns:
+            Normalized vector
+        """
+        data = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(data))
+        return data / norm if norm else data
+
+    def add(self, vector: "np.ndarray") -> int:
+        """
+        Add a normalized vector.
+
+        Args:
+            vector: Normalized vector
+
+        Returns:
+            Slot of the stored vector
+        """
+        if self.vectors is None:
+            self._allocate(len(vector))
+        if self._free:
+            slot = self._free.pop()
+        else:
+            if self._used == len(self.vectors):
+                self._grow()
+            slot = self._used
+            self._used += 1
+        self.vectors[slot] = vector
+        self.valid[slot] = True
+        signature = self._signature(vector[None, :])[0]
+        self._signatures[slot] = signature
+        for table, key in enumerate(signature.tolist()):
+            self._buckets[table].setdefault(key, set()).add(slot)
+        return slot
+
+    def remove(self, slot: int) -> None:
+        """
+        Remove the vector stored in a slot.
+
+        Args:
+            slot: Slot to free
+        """
+        if self.valid is None or not self.valid[slot]:
+            return
+        self.valid[slot] = False
+        for table, key in enumerate(self._signatures.pop(slot).tolist()):
+            bucket = self._buckets[table].get(key)
+            if bucket is not None:
+                bucket.discard(slot)
+                if not bucket:
+                    del self._buckets[table][key]
+        self._free.append(slot)
+
+    def search(
+        self,
+        vector: "np.ndarray",
+        k: int = 8,
+        min_score: Optional[float] = None,
+        accept: Optional[Callable[[int], bool]] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        Find the most similar stored vectors.
+
+        Filters apply before the top ``k`` are taken, so a matching vector is
+        found however many non-matching vectors are more similar.
+
+        Args:
+            vector: Normalized query vector
+            k: Maximum number of results
+            min_score: Minimum cosine similarity of a result
+            accept: Predicate a result's slot must satisfy
+
+        Returns:
+            List of (slot, cosine similarity) pairs, most similar first
+        """
+        if self.vectors is None or len(self) == 0:
+            return []
+        if len(self) <= self.exact_threshold:
+            candidates = np.flatnonzero(self.valid[:self._used])
+        else:
+            signature = self._signature(vector[None, :])[0]
+            slots: Set[int] = set()
+            for table, key in enumerate(signature.tolist()):
+                slots |= self._buckets[table].get(key, set())
+            if not slots:
+                return []
+            candidates = np.fromiter(slots, dtype=np.int64, count=len(slots))
+        scores = self.vectors[candidates] @ vector
+        if min_score is not None:
+            keep = scores >= min_score
+            candidates, scores = candidates[keep], scores[keep]
+        if accept is not None and len(candidates):
+            keep = np.fromiter((accept(int(slot)) for slot in candidates), dtype=bool, count=len(candidates))
+            candidates, scores = candidates[keep], scores[keep]
+        if len(candidates) > k:
+            top = np.argpartition(scores, -k)[-k:]
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(candidates[i]), float(scores[i])) for i in top]
+
+    def save(self, path: Path) -> None:
+        """
+        Write the stored vectors to a ``.npy`` file.
+
+        The vectors are written to a temporary file that then replaces the
+        target, so a file mapped by ``load`` is never truncated underneath the map.
+
+        Args:
+            path: Target file path
+        """
+        vectors = self.vectors[:self._used] if self.vectors is not None else np.zeros((0, 0), np.float32)
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            with open(temp_path, "wb") as f:
+                np.save(f, vectors)
+            os.replace(temp_path, path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+    def load(self, path: Path, slots: List[int]) -> None:
+        """
+        Load vectors from a ``.npy`` file via memory mapping.
+
+        The file is mapped copy-on-write, so loading a large index does not read
+        it eagerly and later writes never modify the file on disk.
+
+        Args:
+            path: Source file path
+            slots: Slots holding live vectors
+
+        Raises:
+            ValueError: If a slot points past the stored vectors
+        """
+        vectors = np.load(path, mmap_mode="c")
+        if vectors.size == 0:
+            if slots:
+                raise ValueError(f"{len(slots)} slots but no stored vectors")
+            return
+        if any(slot < 0 or slot >= len(vectors) for slot in slots):
+            raise ValueError(f"Slot out of range of the {len(vectors)} stored vectors")
+        self._allocate(vectors.shape[1], capacity=0)
+        self.vectors = vectors
+        self.valid = np.zeros(len(vectors), dtype=bool)
+        self._used = len(vectors)
+        live = set(slots)
+        self._free = [slot for slot in range(self._used) if slot not in live]
+        if not slots:
+            return
+        self.valid[slots] = True
+        for slot, signature in zip(slots, self._signature(vectors[slots])):
+            self._signatures[slot] = signature
+            for table, key in enumerate(signature.tolist()):
+                self._buckets[table].setdefault(key, set()).add(slot)
+
+@dataclass
+class CacheKey:
+    """Lookup key reused to store the response of a cache miss"""
+    vector: "np.ndarray"
+    fingerprint: str
+
+@dataclass
+class _Entry:
+    """Cached response"""
+    fingerprint: str
+    response: Dict[str, Any]
+    created: float
+
+class SemanticCache:
+    """Cache chat responses by meaning of the latest user turn"""
+
+    def __init__(
+        self,
+        embed: Callable[[str], Awaitable[array]],
+        threshold: float = 0.92,
+        max_entries: int = 10000,
+        ttl: float = 86400,
+        exact_threshold: int = 2048,
+        context_messages: Optional[int] = None,
+        index_path: Optional[Union[str, Path]] = None
+    ) -> None:
+        """
+        Initialize the semantic cache.
+
+        Args:
+            embed: Coroutine function embedding one text
+            threshold: Minimum cosine similarity for a cache hit
+            max_entries: Maximum number of cached responses (LRU eviction)
+            ttl: Seconds a cached response stays valid, 0 for no expiry
+            exact_threshold: Maximum index size searched by brute force
+            context_messages: Preceding non-system messages included in the
+                context fingerprint, ``None`` for the whole history
+            index_path: Base path of the persisted index, ``None`` to disable persistence
+        """
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.context_messages = context_messages
+        self.index_path = Path(index_path) if index_path else None
+        self.index = VectorIndex(exact_threshold=exact_threshold)
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.index_path is not None:
+            self.load()
+
+    @classmethod
+    def from_config(
+        cls,
+        settings: Dict[str, Any],
+        embed: Callable[[str], Awaitable[array]]
+    ) -> "SemanticCache":
+        """
+        Create a cache from a ``[semantic_cache]`` configuration section.
+
+        Args:
+            settings: Semantic cache configuration section
+            embed: Coroutine function embedding one text
+
+        Returns:
+            Semantic cache instance
+        """
+        context_messages = settings.get("context_messages", -1)
+        return cls(
+            embed,
+            threshold=settings.get("threshold", 0.92),
+            max_entries=settings.get("max_entries", 10000),
+            ttl=settings.get("ttl", 86400),
+            exact_threshold=settings.get("exact_threshold", 2048),
+            context_messages=None if context_messages < 0 else context_messages,
+            index_path=settings.get("index_path", "semantic_cache")
+        )
+
+    def __len__(self) -> int:
+        """Number of cached responses."""
+        return len(self._entries)
+
+    def fingerprint(self, messages: List[Dict[str, Any]], model: str) -> str:
+        """
+        Hash the model and the context preceding the latest user turn.
+
+        Args:
+            messages: Request messages, ending with the latest user turn
+            model: Model name
+
+        Returns:
+            Context fingerprint
+        """
+        system = [msg for msg in messages[:-1] if msg.get("role") == "system"]
+        history = [msg for msg in messages[:-1] if msg.get("role") != "system"]
+        if self.context_messages is not None:
+            history = history[-self.context_messages:] if self.context_messages else []
+        return hashlib.sha1(json_codec.dumps([model, system, history])).hexdigest()
+
+    def _expired(self, entry: _Entry, now: float) -> bool:
+        """
+        Check whether an entry has outlived the TTL.
+
+        Args:
+            entry: Cached entry
+            now: Current time
+
+        Returns:
+            Whether the entry is expired
+        """
+        return bool(self.ttl) and now - entry.created > self.ttl
+
+    def _evict(self, slot: int) -> None:
+        """
+        Remove a cached response and its vector.
+
+        Args:
+            slot: Index slot of the entry
+        """
+        self._entries.pop(slot, None)
+        self.index.remove(slot)
+
+    async def lookup(
+        self,
+        messages: List[Dict[str, Any]],
+        model: str
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[CacheKey]]:
+        """
+        Look up a cached response for a request.
+
+        Args:
+            messages: Request messages
+            model: Model name
+
+        Returns:
+            Tuple of the cached response (``None`` on a miss) and the key to
+            pass to ``store`` (``None`` if the request is not cacheable)
+        """
+        if not messages or messages[-1].get("role") != "user" or not messages[-1].get("content"):
+            return None, None
+
+        key = CacheKey(
+            vector=VectorIndex.normalize(await self.embed(messages[-1]["content"])),
+            fingerprint=self.fingerprint(messages, model)
+        )
+        now = time.time()
+
+        def same_context(slot: int) -> bool:
+            entry = self._entries.get(slot)
+            return entry is not None and entry.fingerprint == key.fingerprint
+
+        for slot, score in self.index.search(key.vector, min_score=self.threshold, accept=same_context):
+            entry = self._entries[slot]
+            if self._expired(entry, now):
+                self._evict(slot)
+                continue
+            self._entries.move_to_end(slot)
+            self.hits += 1
+            logger.debug(f"Semantic cache hit (similarity {score:.3f})")
+            return {**entry.response, "semantic_cache": {"similarity": score}}, key
+
+        self.misses += 1
+        return None, key
+
+    def store(self, key: Optional[CacheKey], response: Dict[str, Any]) -> None:
+        """
+        Store the response of a cache miss.
+
+        Args:
+            key: Key returned by ``lookup``
+            response: API response dictionary
+        """
+        if key is None:
+            return
+        now = time.time()
+        # Drop expired entries from the cold end before evicting live ones
+        while self._entries:
+            slot, entry = next(iter(self._entries.items()))
+            if len(self._entries) < self.max_entries and not self._expired(entry, now):
+                break
+            self._evict(slot)
+        slot = self.index.add(key.vector)
+        self._entries[slot] = _Entry(fingerprint=key.fingerprint, response=response, created=now)
+
+    def save(self) -> None:
+        """Persist the index to ``<index_path>.npy`` and ``<index_path>.json``."""
+        if self.index_path is None:
+            return
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        self.index.save(self.index_path.with_suffix(".npy"))
+        metadata = [
+            {"slot": slot, "fingerprint": entry.fingerprint, "response": entry.response, "created": entry.created}
+            for slot, entry in self._entries.items()
+        ]
+        self.index_path.with_suffix(".json").write_bytes(json_codec.dumps(metadata))
+        logger.info(f"Saved {len(metadata)} semantic cache entries to {self.index_path}")
+
+    def load(self) -> None:
+        """Load a persisted index if one exists."""
+        if self.index_path is None:
+            return
+        vectors_path = self.index_path.with_suffix(".npy")
+        metadata_path = self.index_path.with_suffix(".json")
+        if not vectors_path.exists() or not metadata_path.exists():
+            return
+        try:
+            metadata = json_codec.loads(metadata_path.read_bytes())
+            self.index.load(vectors_path, [item["slot"] for item in metadata])
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            logger.warning(f"Ignoring unreadable semantic cache at {self.index_path}: {e}")
+            self.index = VectorIndex(exact_threshold=self.index.exact_threshold)
+            return
+        # Metadata is saved in LRU order, so insertion order restores recency
+        for item in metadata:
+            self._entries[item["slot"]] = _Entry(
+                fingerprint=item["fingerprint"],
+                response=item["response"],
+                created=item["created"]
+            )
+        logger.info(f"Loaded {len(self._entries)} semantic cache entries from {self.index_path}")
@@ -0,0 +1,169 @@
+"""
+Side-by-side comparison of several providers.
+
+Sends one prompt to several configured ``[api.*]`` providers at once, each
+through its own client, and streams all answers together with the time to
+first token, total latency and generation speed of each.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, List, Optional
+
+from .config import ConfigError
+from .utils.usage import attribute
+
+if TYPE_CHECKING:
+    from .api.openai import OpenAIClient
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class ModelResult:
+    """Answer and timing of one provider"""
+    provider: str
+    model: str
+    content: str = ""
+    ttft: Optional[float] = None
+    latency: Optional[float] = None
+    completion_tokens: int = 0
+    error: Optional[str] = None
+    done: bool = False
+
+    @property
+    def tokens_per_second(self) -> float:
+        """Generation speed after the first token."""
+        if self.ttft is None or self.latency is None or self.latency <= self.ttft:
+            return 0.0
+        return self.completion_tokens / (self.latency - self.ttft)
+
+    def summary(self) -> str:
+        """
+        Get a one-line summary of the timing.
+
+        Returns:
+            Summary text
+        """
+        if self.error:
+            return f"failed after {self.latency or 0:.2f} s"
+        ttft = f"{self.ttft:.2f} s" if self.ttft is not None else "-"
+        latency = f"{self.latency:.2f} s" if self.latency is not None else "..."
+        return (
+            f"TTFT {ttft} · total {latency} · "
+            f"{self.tokens_per_second:.1f} tok/s · {self.completion_tokens} tokens"
+        )
+
+def create_clients(
+    api_settings: Dict[str, Dict[str, Any]],
+    providers: Optional[List[str]] = None
+) -> Dict[str, "OpenAIClient"]:
+    """
+    Create one client per compared provider.
+
+    Args:
+        api_settings: ``[api]`` configuration section
+        providers: Provider names, defaults to all configured providers
+
+    Returns:
+        Clients by provider name
+
+    Raises:
+        ConfigError: If a provider is not configured
+    """
+    from .api.openai import OpenAIClient
+
+    names = providers or list(api_settings)
+    missing = [name for name in names if name not in api_settings]
+    if missing:
+        raise ConfigError(f"API configuration not found: {', '.join(missing)}")
+    if not names:
+        raise ConfigError("No API providers configured")
+    return {name: OpenAIClient(api_settings[name], name) for name in names}
+
+async def _stream_one(
+    client: "OpenAIClient",
+    result: ModelResult,
+    messages: List[Dict[str, Any]],
+    updates: "asyncio.Queue[str]",
+    user: Optional[str] = None,
+    **kwargs
+) -> None:
+    """
+    Stream one provider's answer into its result.
+
+    Args:
+        client: Provider client
+        result: Result updated as chunks arrive
+        messages: List of message dictionaries
+        updates: Queue notified of every change to the result
+        user: User the request's token usage is accounted to
+        **kwargs: Additional arguments to pass to the API
+    """
+    started = time.perf_counter()
+    chunks = 0
+    usage: Optional[Dict[str, Any]] = None
+    try:
+        with attribute(user=user):
+            async for chunk in client.stream_chat_completion(messages, **kwargs):
+                usage = chunk.get("usage") or usage
+                choices = chunk.get("choices") or []
+                delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                if not delta:
+                    continue
+                if result.ttft is None:
+                    result.ttft = time.perf_counter() - started
+                result.content += delta
+                chunks += 1
+                # Roughly one token per chunk until the final usage arrives
+                result.completion_tokens = chunks
+                updates.put_nowait(result.provider)
+    except Exception as e:
+        logger.warning(f"Comparison request to {result.provider} failed: {e}")
+        result.error = str(e)
+    finally:
+        result.latency = time.perf_counter() - started
+        if usage and usage.get("completion_tokens"):
+            result.completion_tokens = usage["completion_tokens"]
+        result.done = True
+        updates.put_nowait(result.provider)
+
+async def compare(
+    clients: Dict[str, "OpenAIClient"],
+    messages: List[Dict[str, Any]],
+    user: Optional[str] = None,
+    **kwargs
+) -> AsyncIterator[List[ModelResult]]:
+    """
+    Stream the answers of several providers to the same messages.
+
+    Args:
+        clients: Clients by provider name
+        messages: List of message dictionaries
+        user: User the requests' token usage is accounted to
+        **kwargs: Additional arguments to pass to the API (e.g. temperature)
+
+    Yields:
+        Results of all providers, in ``clients`` order, whenever any of them changed
+    """
+    results = [ModelResult(name, client.model) for name, client in clients.items()]
+    updates: "asyncio.Queue[str]" = asyncio.Queue()
+    tasks = [
+        asyncio.create_task(_stream_one(client, result, messages, updates, user, **kwargs))
+        for client, result in zip(clients.values(), results)
+    ]
+    try:
+        while not all(result.done for result in results):
+            await updates.get()
+            # Coalesce the chunks that arrived meanwhile into one update
+            while not updates.empty():
+                updates.get_nowait()
+            yield results
+    finally:
+        for task in tasks:
+            task.cancel()
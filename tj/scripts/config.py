@@ -6,9 +6,43 @@ Email: tangj1984@gmail.com
 Date: 2024-03-21
 """
 
-import tomli
+import asyncio
+import logging
 from pathlib import Path
-from typing import Dict, Any, Optional, Union
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit, urlunsplit
+
+logger = logging.getLogger(__name__)
+
+# Changed settings by dotted key, as (old value, new value)
+Changes = Dict[str, Tuple[Any, Any]]
+
+# Settings only read at startup; changing them has no effect until a restart
+RESTART_REQUIRED = (
+    "logging",
+    "session_store",
+    "semantic_cache",
+    "tools",
+    "ui.host",
+    "ui.port",
+    "ui.workers",
+    "ui.max_concurrency",
+    "usage.enabled",
+)
+
+# Numeric [api.*] settings that must not be negative
+_API_NUMBERS = (
+    "timeout",
+    "retry_count",
+    "retry_delay",
+    "pool_size",
+    "keepalive_timeout",
+    "warmup_connections",
+    "keepalive_interval",
+    "max_concurrency",
+    "compression_min_size",
+    "max_response_size",
+)
 
 class ConfigError(Exception):
     """Configuration error base class"""
@@ -38,6 +72,8 @@ class Config:
         """
         self.config: Dict[str, Any] = {}
         self.config_path = Path(config_path) if config_path else Path("config.toml")
+        self._listeners: List[Callable[[Changes], Any]] = []
+        self._stamp: Optional[Tuple[int, int]] = None
         self._load_config()
     
     def _load_config(self) -> None:
@@ -48,6 +84,36 @@ class Config:
             ConfigFileNotFoundError: If config file is not found
             ConfigLoadError: If config file cannot be loaded
         """
+        self._stamp = self._file_stamp()
+        self.config = self._read()
+    
+    def _file_stamp(self) -> Optional[Tuple[int, int]]:
+        """
+        Get the modification time and size of the configuration file.
+        
+        Returns:
+            (mtime in ns, size), or ``None`` if the file cannot be read
+        """
+        try:
+            stat = self.config_path.stat()
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+    
+    def _read(self) -> Dict[str, Any]:
+        """
+        Read and validate the configuration file.
+        
+        Returns:
+            Configuration dictionary
+            
+        Raises:
+            ConfigFileNotFoundError: If config file is not found
+            ConfigLoadError: If config file cannot be loaded
+        """
+        # Deferred so that importing this module does not pull in the TOML parser
+        import tomli
+        
         if not self.config_path.exists():
             raise ConfigFileNotFoundError(
                 f"Config file not found at {self.config_path}. "
@@ -56,19 +122,34 @@ class Config:
         
         try:
             with open(self.config_path, "rb") as f:
-                self.config = tomli.load(f)
+                config = tomli.load(f)
         except tomli.TOMLDecodeError as e:
             raise ConfigLoadError(f"Failed to parse config file: {str(e)}")
         except Exception as e:
             raise ConfigLoadError(f"Failed to load config file: {str(e)}")
         
         # Validate required sections
-        if "api" not in self.config:
+        if "api" not in config:
             raise ConfigLoadError("Missing required section: [api]")
-        if "openai" not in self.config["api"]:
+        if "openai" not in config["api"]:
             raise ConfigLoadError("Missing required section: [api.openai]")
-        if "logging" not in self.config:
+        if "logging" not in config:
             raise ConfigLoadError("Missing required section: [logging]")
+        
+        # Validate API settings
+        for name, settings in config["api"].items():
+            if not isinstance(settings, dict):
+                raise ConfigLoadError(f"[api.{name}] must be a table")
+            for key in ("base_url", "api_key", "model"):
+                if not isinstance(settings.get(key, ""), str):
+                    raise ConfigLoadError(f"[api.{name}] {key} must be a string")
+            if settings.get("request_compression", "none") not in ("none", "gzip", "deflate"):
+                raise ConfigLoadError(f"[api.{name}] request_compression must be none, gzip or deflate")
+            for key in _API_NUMBERS:
+                value = settings.get(key, 0)
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                    raise ConfigLoadError(f"[api.{name}] {key} must be a non-negative number")
+        return config
     
     def get(self, section: str, key: str, default: Any = None) -> Any:
         """
@@ -95,6 +176,208 @@ class Config:
             Configuration section dictionary
         """
         return self.config.get(section, {})
+    
+    def reload(self) -> Changes:
+        """
+        Re-read the configuration file and swap in the new settings.
+        
+        The new file is validated first; if it is invalid the current settings
+        stay in place. Sections handed out earlier by ``get_section`` are not
+        modified, so readers never see a half-applied configuration.
+        
+        Returns:
+            Changed settings by dotted key, as (old value, new value)
+            
+        Raises:
+            ConfigFileNotFoundError: If config file is not found
+            ConfigLoadError: If config file cannot be loaded
+        """
+        self._stamp = self._file_stamp()
+        config = self._read()
+        changes = _diff(self.config, config)
+        self.config = config
+        return changes
+    
+    def subscribe(self, listener: Callable[[Changes], Union[None, Awaitable[None]]]) -> None:
+        """
+        Register a function called by ``poll`` after each reload that changed settings.
+        
+        Args:
+            listener: Sync or async function receiving the changes
+        """
+        self._listeners.append(listener)
+    
+    def unsubscribe(self, listener: Callable[[Changes], Union[None, Awaitable[None]]]) -> None:
+        """
+        Remove a listener registered with ``subscribe``.
+        
+        Args:
+            listener: Registered function
+        """
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+    
+    async def poll(self) -> Changes:
+        """
+        Reload the configuration if the file changed and notify the listeners.
+        
+        Invalid files are logged and ignored; the current settings stay in
+        place until the file is fixed.
+        
+        Returns:
+            Changed settings by dotted key, empty if nothing changed
+        """
+        stamp = self._file_stamp()
+        if stamp is None or stamp == self._stamp:
+            return {}
+        try:
+            changes = self.reload()
+        except ConfigError as e:
+            logger.error(f"Ignoring invalid configuration, keeping current settings: {e}")
+            return {}
+        if not changes:
+            return {}
+        
+        logger.info(f"Configuration reloaded from {self.config_path}:\n{format_changes(changes)}")
+        for listener in list(self._listeners):
+            try:
+                result = listener(changes)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Failed to apply configuration change: {e}", exc_info=True)
+        return changes
+    
+    async def watch(self, interval: float = 2.0) -> None:
+        """
+        Poll the configuration file for changes until cancelled.
+        
+        Args:
+            interval: Seconds between checks
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await self.poll()
 
-# Create global config instance
-config = Config() 
\ No newline at end of file
+def _diff(old: Dict[str, Any], new: Dict[str, Any], prefix: str = "") -> Changes:
+    """
+    Compare two configuration tables.
+    
+    Args:
+        old: Current table
+        new: New table
+        prefix: Dotted key of the tables
+        
+    Returns:
+        Changed settings by dotted key, as (old value, new value); ``None``
+        stands for a missing setting
+    """
+    changes: Changes = {}
+    for key in old.keys() | new.keys():
+        name = f"{prefix}{key}"
+        before, after = old.get(key), new.get(key)
+        if isinstance(before, dict) or isinstance(after, dict):
+            # Added or removed tables are reported key by key so secrets get masked
+            changes.update(_diff(
+                before if isinstance(before, dict) else {},
+                after if isinstance(after, dict) else {},
+                f"{name}."
+            ))
+            if not isinstance(before, dict) and before is not None:
+                changes[name] = (before, None)
+            elif not isinstance(after, dict) and after is not None:
+                changes[name] = (None, after)
+        elif before != after:
+            changes[name] = (before, after)
+    return dict(sorted(changes.items()))
+
+def requires_restart(key: str) -> bool:
+    """
+    Check whether a setting only takes effect after a restart.
+    
+    Args:
+        key: Dotted setting key
+        
+    Returns:
+        True if the setting is only read at startup
+    """
+    return any(key == prefix or key.startswith(f"{prefix}.") for prefix in RESTART_REQUIRED)
+
+def _mask(key: str, value: Any) -> Any:
+    """
+    Hide a secret setting value.
+    
+    Args:
+        key: Dotted setting key
+        value: Setting value
+        
+    Returns:
+        ``"***"`` for secret settings, URLs with their credentials masked,
+        otherwise the value itself
+    """
+    if not value:
+        return value
+    if key.endswith(("api_key", "password", "secret")):
+        return "***"
+    if isinstance(value, str) and "://" in value:
+        try:
+            parts = urlsplit(value)
+        except ValueError:
+            return value
+        if "@" in parts.netloc:
+            host = parts.netloc.rpartition("@")[2]
+            return urlunsplit(parts._replace(netloc=f"***@{host}"))
+    return value
+
+def format_changes(changes: Changes) -> str:
+    """
+    Describe configuration changes, one setting per line, with secrets masked.
+    
+    Args:
+        changes: Changed settings by dotted key
+        
+    Returns:
+        Human readable report
+    """
+    lines = []
+    for key, (before, after) in changes.items():
+        before, after = _mask(key, before), _mask(key, after)
+        note = " (restart required)" if requires_restart(key) else ""
+        lines.append(f"  {key}: {before!r} -> {after!r}{note}")
+    return "\n".join(lines)
+
+# Global config instance, loaded on first use
+_config: Optional[Config] = None
+
+def get_config() -> Config:
+    """
+    Get the global configuration, loading it on first use.
+    
+    Returns:
+        Global configuration instance
+        
+    Raises:
+        ConfigFileNotFoundError: If config file is not found
+        ConfigLoadError: If config file cannot be loaded
+    """
+    global _config
+    if _config is None:
+        _config = Config()
+    return _config
+
+def __getattr__(name: str) -> Any:
+    """
+    Resolve the legacy ``config`` module attribute lazily.
+    
+    Args:
+        name: Attribute name
+        
+    Returns:
+        Global configuration instance for ``config``
+        
+    Raises:
+        AttributeError: For any other attribute
+    """
+    if name == "config":
+        return get_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
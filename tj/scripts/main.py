@@ -6,23 +6,26 @@ Email: tangj1984@gmail.com
 Date: 2024-03-21
 """
 
+import argparse
 import asyncio
+import getpass
+import logging
 import sys
-from typing import Optional, List
-from .config import config, ConfigError
-from .api.openai import OpenAIClient
+import threading
+import uuid
+from typing import TYPE_CHECKING, Any, Dict, Optional, List
+from .config import Changes, get_config, ConfigError
 from .models.chat import ChatSession
-from .utils.logger import setup_logger
+from .utils.logger import setup_logger_from_config, log_content
+from .utils.profiling import profiler, start_from_env
+from .utils.usage import UsageTracker, attribute
 
-# Set up logging
-logger = setup_logger(
-    "tj.scripts",
-    level=config.get("logging", "level", "INFO"),
-    format=config.get("logging", "format", "%(asctime)s - %(name)s - %(levelname)s - %(message)s"),
-    file=config.get("logging", "file", "app.log"),
-    max_size=config.get("logging", "max_size", 10 * 1024 * 1024),  # 10MB
-    backup_count=config.get("logging", "backup_count", 5)
-)
+if TYPE_CHECKING:
+    from .api.openai import OpenAIClient
+    from .tools import ToolEngine
+
+# Handlers are attached in main() once the configuration has been loaded
+logger = logging.getLogger("tj.scripts")
 
 def print_history(session: ChatSession) -> None:
     """
@@ -37,13 +40,57 @@ def print_history(session: ChatSession) -> None:
         print(f"\n{role}: {msg.content}")
     print("\n===================")
 
-async def chat_loop(client: OpenAIClient, session: ChatSession) -> None:
+async def read_input(prompt: str) -> str:
+    """
+    Read a line from standard input without blocking the event loop.
+    
+    The read runs in a daemon thread, so keep-alive probes and the configuration
+    watcher keep running while waiting for the user, and an interrupted read
+    does not hold up the exit.
+    
+    Args:
+        prompt: Prompt to print
+        
+    Returns:
+        The line read, without the trailing newline
+        
+    Raises:
+        EOFError: If standard input is closed
+    """
+    loop = asyncio.get_running_loop()
+    future: "asyncio.Future[str]" = loop.create_future()
+    
+    def resolve(line: Optional[str], error: Optional[BaseException]) -> None:
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(line or "")
+    
+    def read() -> None:
+        try:
+            line = input(prompt)
+        except BaseException as e:
+            loop.call_soon_threadsafe(resolve, None, e)
+        else:
+            loop.call_soon_threadsafe(resolve, line, None)
+    
+    threading.Thread(target=read, name="input", daemon=True).start()
+    return await future
+
+async def chat_loop(
+    client: "OpenAIClient",
+    session: ChatSession,
+    tools: Optional["ToolEngine"] = None
+) -> None:
     """
     Run an interactive chat loop.
     
     Args:
         client: OpenAI API client
         session: Chat session instance
+        tools: Optional tool engine running model-requested tool calls
         
     Raises:
         Exception: If the API request fails
@@ -53,12 +100,14 @@ async def chat_loop(client: OpenAIClient, session: ChatSession) -> None:
     print("  - 'quit': Exit the chat")
     print("  - 'clear': Clear chat history")
     print("  - 'history': Show chat history")
+    print("  - 'stats': Show prompt-cache and token usage statistics")
+    print("  - 'profile [seconds]': Profile the next requests (default 30 s)")
     print("  - 'help': Show this help message")
     
     while True:
         try:
             # Get user input
-            user_input = input("\nYou: ").strip()
+            user_input = (await read_input("\nYou: ")).strip()
             
             # Handle special commands
             if user_input.lower() == 'quit':
@@ -71,11 +120,32 @@ async def chat_loop(client: OpenAIClient, session: ChatSession) -> None:
             elif user_input.lower() == 'history':
                 print_history(session)
                 continue
+            elif user_input.lower() == 'profile' or user_input.lower().startswith('profile '):
+                parts = user_input.split()
+                seconds = float(parts[1]) if len(parts) > 1 else 30.0
+                if profiler.start(seconds):
+                    print(f"\nProfiling the next {min(seconds, profiler.max_duration):.0f}s, "
+                          f"report in {profiler.output_dir}/")
+                else:
+                    print("\nProfiling already in progress.")
+                continue
+            elif user_input.lower() == 'stats':
+                stats = session.prefix_stats
+                print(f"\nRequests: {stats.requests}")
+                print(f"Prefix hit ratio: {stats.prefix_hit_ratio:.0%}")
+                print(f"Cached prompt tokens: {stats.cached_tokens}/{stats.prompt_tokens} ({stats.cached_ratio:.0%})")
+                if client.usage is not None:
+                    for provider, totals in client.usage.metrics()["providers"].items():
+                        print(f"Tokens used with {provider}: {totals['total_tokens']} "
+                              f"({totals['prompt_tokens']} prompt, {totals['completion_tokens']} completion)")
+                continue
             elif user_input.lower() == 'help':
                 print("\nAvailable commands:")
                 print("  - 'quit': Exit the chat")
                 print("  - 'clear': Clear chat history")
                 print("  - 'history': Show chat history")
+                print("  - 'stats': Show prompt-cache and token usage statistics")
+                print("  - 'profile [seconds]': Profile the next requests (default 30 s)")
                 print("  - 'help': Show this help message")
                 continue
             elif not user_input:
@@ -89,12 +159,16 @@ async def chat_loop(client: OpenAIClient, session: ChatSession) -> None:
             
             # Send request
             print("\nAssistant is thinking...")
-            response = await client.chat_completion(
-                messages=session.get_messages(),
-                temperature=session.temperature,
-                max_tokens=session.max_tokens,
-                stream=False
-            )
+            if tools is not None:
+                response = await tools.run(client, session)
+            else:
+                response = await client.chat_completion(
+                    messages=session.get_messages(),
+                    temperature=session.temperature,
+                    max_tokens=session.max_tokens,
+                    stream=False
+                )
+                session.record_response(response)
             
             # Get and display assistant response
             assistant_message = response["choices"][0]["message"]["content"]
@@ -107,8 +181,8 @@ async def chat_loop(client: OpenAIClient, session: ChatSession) -> None:
             )
             
             # Log the exchange
-            logger.info(f"User: {user_input}")
-            logger.info(f"Assistant: {assistant_message}")
+            log_content(logger, "User", user_input)
+            log_content(logger, "Assistant", assistant_message)
             
         except KeyboardInterrupt:
             print("\n\nGoodbye!")
@@ -118,37 +192,178 @@ async def chat_loop(client: OpenAIClient, session: ChatSession) -> None:
             print(f"\nError: {str(e)}")
             print("Please try again or type 'quit' to exit.")
 
-async def chat_example() -> None:
+async def compare_loop(
+    clients: Dict[str, "OpenAIClient"],
+    chat_settings: Dict[str, Any],
+    user: Optional[str] = None
+) -> None:
+    """
+    Run an interactive loop sending each prompt to several providers.
+    
+    Args:
+        clients: Clients by provider name
+        chat_settings: Chat configuration section
+        user: User the token usage is accounted to
+    """
+    from .compare import compare
+    
+    print(f"\nComparing {', '.join(clients)}. Type a prompt and press Enter, 'quit' to exit.")
+    
+    while True:
+        try:
+            user_input = (await read_input("\nYou: ")).strip()
+            if user_input.lower() == 'quit':
+                print("\nGoodbye!")
+                break
+            elif not user_input:
+                continue
+            
+            # Every provider answers the same single-turn prompt
+            session = ChatSession.from_config(chat_settings)
+            session.add_message(role="user", content=user_input)
+            
+            # Print each answer as soon as it is complete
+            printed = set()
+            results = []
+            async for results in compare(clients, session.get_messages(), user):
+                for result in results:
+                    if result.done and result.provider not in printed:
+                        printed.add(result.provider)
+                        answer = f"Error: {result.error}" if result.error else result.content
+                        print(f"\n[{result.provider} · {result.model}] {result.summary()}\n{answer}")
+            
+            print("\n=== Latency ===")
+            for result in sorted(results, key=lambda r: (r.error is not None, r.latency or 0)):
+                print(f"{result.provider:<16} {result.summary()}")
+            log_content(logger, "User", user_input)
+            
+        except KeyboardInterrupt:
+            print("\n\nGoodbye!")
+            break
+        except Exception as e:
+            logger.error(f"Error in compare loop: {str(e)}", exc_info=True)
+            print(f"\nError: {str(e)}")
+
+def create_usage_tracker() -> Optional[UsageTracker]:
+    """
+    Create the token usage tracker if ``[usage]`` is enabled.
+    
+    Returns:
+        Usage tracker, or ``None`` if usage accounting is disabled
+    """
+    settings = get_config().get_section("usage")
+    return UsageTracker.from_config(settings) if settings.get("enabled", False) else None
+
+async def compare_example(providers: List[str]) -> None:
+    """
+    Compare several providers side by side.
+    
+    Args:
+        providers: Provider names, empty for ``[compare] providers`` or all configured providers
+        
+    Raises:
+        ConfigError: If a provider is not configured
+    """
+    from .compare import create_clients
+    
+    config = get_config()
+    clients = create_clients(
+        config.get_section("api"),
+        providers or config.get("compare", "providers")
+    )
+    usage = create_usage_tracker()
+    for client in clients.values():
+        client.usage = usage
+    try:
+        # Connect to all providers up front so that TTFT does not include connection setup
+        await asyncio.gather(*(client.prewarm() for client in clients.values()))
+        await compare_loop(clients, config.get_section("chat"), getpass.getuser())
+    finally:
+        await asyncio.gather(*(client.close() for client in clients.values()))
+        if usage is not None:
+            usage.flush()
+
+async def chat_example(provider: Optional[str] = None) -> None:
     """
     Run a chat completion example.
     
+    Args:
+        provider: ``[api.*]`` provider to chat with, defaults to ``[chat] provider``
+    
     Raises:
         ConfigError: If configuration is invalid
         Exception: If the API request fails
     """
+    # Deferred so that aiohttp is only imported when a client is needed
+    from .api.openai import OpenAIClient
+    
     try:
         # Get OpenAI API configuration
-        api_config = config.get_section("api").get("siliconflow", {})
+        provider_arg = provider
+        provider = provider or get_config().get("chat", "provider", "siliconflow")
+        api_config = get_config().get_section("api").get(provider, {})
         if not api_config:
-            raise ConfigError("SiliconFlow API configuration not found")
+            raise ConfigError(f"API configuration not found: {provider}")
+        
+        # Create OpenAI client and warm up its connection pool
+        client = OpenAIClient(api_config, provider)
+        await client.prewarm()
+        
+        # Account token usage per session, user and provider
+        client.usage = create_usage_tracker()
         
-        # Create OpenAI client
-        client = OpenAIClient(api_config)
+        # Answer paraphrased questions from the semantic cache if enabled
+        cache_config = get_config().get_section("semantic_cache")
+        if cache_config.get("enabled", False):
+            client.enable_semantic_cache(cache_config)
         
-        # Create chat session
-        session = ChatSession(
+        # Create chat session with a fixed system prompt
+        session = ChatSession.from_config(
+            get_config().get_section("chat"),
             temperature=api_config.get("temperature", 0.7),
             max_tokens=api_config.get("max_tokens", 2000)
         )
         
-        # Add system message
-        session.add_message(
-            role="system",
-            content="You are a helpful AI assistant."
+        # Run registered tools when the model asks for them
+        from .tools import ToolEngine, load_modules, registry
+        load_modules(get_config().get("tools", "modules", []))
+        tool_engine = (
+            ToolEngine.from_config(registry, get_config().get_section("tools"))
+            if len(registry) else None
         )
         
-        # Run interactive chat loop
-        await chat_loop(client, session)
+        # Apply configuration file changes without restarting
+        watch_task: Optional[asyncio.Task] = None
+        reload_config = get_config().get_section("hot_reload")
+        if reload_config.get("enabled", False):
+            
+            async def apply_config(changes: Changes) -> None:
+                # An explicit --provider sticks; otherwise follow [chat] provider
+                name = provider if provider_arg else get_config().get("chat", "provider", "siliconflow")
+                settings = get_config().get_section("api").get(name)
+                if not settings:
+                    logger.warning(f"API configuration not found: {name}, keeping the current client settings")
+                elif settings != client.config:
+                    await client.update_config(settings, get_config().get("hot_reload", "grace", 30.0))
+                    client.provider = name
+                if client.usage is not None:
+                    client.usage.configure(get_config().get_section("usage"))
+            
+            get_config().subscribe(apply_config)
+            watch_task = asyncio.create_task(get_config().watch(reload_config.get("interval", 2.0)))
+        
+        # Run interactive chat loop, accounting its usage to this session and the OS user
+        try:
+            with attribute(uuid.uuid4().hex, getpass.getuser()):
+                await chat_loop(client, session, tool_engine)
+        finally:
+            if watch_task is not None:
+                watch_task.cancel()
+            if tool_engine is not None:
+                tool_engine.close()
+            await client.close()
+            if client.usage is not None:
+                client.usage.flush()
         
     except ConfigError as e:
         logger.error(f"Configuration error: {str(e)}")
@@ -157,16 +372,80 @@ async def chat_example() -> None:
         logger.error(f"Error in chat example: {str(e)}", exc_info=True)
         raise
 
-def main() -> Optional[int]:
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command line arguments.
+    
+    Args:
+        argv: Argument list, defaults to ``sys.argv[1:]``
+        
+    Returns:
+        Parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="OpenAI API compatibility demo")
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="Report import time of each entry point against its startup budget and exit"
+    )
+    parser.add_argument(
+        "--profile",
+        type=float,
+        metavar="SECONDS",
+        help="Profile the request path for SECONDS from startup (also: TJ_PROFILE=SECONDS)"
+    )
+    parser.add_argument(
+        "--provider",
+        help="API provider to chat with (default: [chat] provider)"
+    )
+    parser.add_argument(
+        "--compare",
+        nargs="*",
+        metavar="PROVIDER",
+        help="Send each prompt to several providers at once and compare their latency "
+             "(default: [compare] providers, or all configured providers)"
+    )
+    return parser.parse_args(argv)
+
+def startup_profile() -> int:
+    """
+    Print the import-time profile of each entry point.
+    
+    Returns:
+        Exit code (0 if all entry points are within budget, 1 otherwise)
+    """
+    from .utils.startup import STARTUP_BUDGETS, format_report, profile_imports
+    
+    profiles = [profile_imports(module) for module in STARTUP_BUDGETS]
+    print(format_report(profiles))
+    return 1 if any(profile.over_budget for profile in profiles) else 0
+
+def main(argv: Optional[List[str]] = None) -> Optional[int]:
     """
     Main entry point.
     
+    Args:
+        argv: Argument list, defaults to ``sys.argv[1:]``
+        
     Returns:
         Exit code (0 for success, non-zero for error)
     """
+    args = parse_args(argv)
+    if args.startup_profile:
+        return startup_profile()
+    
     try:
+        setup_logger_from_config("tj.scripts", get_config().get_section("logging"))
+        profiler.configure(get_config().get_section("profiling"))
+        if args.profile:
+            profiler.start(args.profile)
+        else:
+            start_from_env()
         logger.info("Starting OpenAI API demo...")
-        asyncio.run(chat_example())
+        if args.compare is not None:
+            asyncio.run(compare_example(args.compare))
+        else:
+            asyncio.run(chat_example(args.provider))
         logger.info("Demo completed successfully.")
         return 0
     except KeyboardInterrupt:
@@ -180,4 +459,4 @@ def main() -> Optional[int]:
         return 1
 
 if __name__ == "__main__":
-    sys.exit(main() or 0) 
\ No newline at end of file
+    sys.exit(main() or 0)
\ No newline at end of file
@@ -6,59 +6,262 @@ Email: tangj1984@gmail.com
 Date: 2024-03-21
 """
 
+import hashlib
 from typing import List, Dict, Any, Optional, Literal
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field
+
+from ..utils import json_codec
+from ..utils.profiling import profiled
+
+Role = Literal["system", "user", "assistant", "function", "tool"]
+
+DEFAULT_SYSTEM_PROMPT = "You are a helpful AI assistant."
+
+def cached_prompt_tokens(usage: Dict[str, Any]) -> int:
+    """
+    Get the number of prompt tokens served from the provider's prompt cache.
+    
+    Args:
+        usage: ``usage`` object of an API response
+        
+    Returns:
+        Cached prompt tokens, 0 if not reported
+    """
+    details = usage.get("prompt_tokens_details") or {}
+    # OpenAI reports prompt_tokens_details.cached_tokens, DeepSeek-style APIs prompt_cache_hit_tokens
+    return details.get("cached_tokens") or usage.get("prompt_cache_hit_tokens") or 0
+
+def _digest(messages: List[Dict[str, Any]]) -> str:
+    """
+    Get a digest of the serialized messages.
+    
+    Args:
+        messages: List of message dictionaries
+        
+    Returns:
+        Hex digest
+    """
+    return hashlib.sha1(json_codec.dumps(messages)).hexdigest()
 
 @dataclass
 class Message:
     """Chat message data structure"""
-    role: Literal["system", "user", "assistant", "function"]
+    role: Role
     content: str
     name: Optional[str] = None
     function_call: Optional[Dict[str, Any]] = None
+    tool_calls: Optional[List[Dict[str, Any]]] = None
+    tool_call_id: Optional[str] = None
+
+@dataclass
+class PrefixStats:
+    """Prompt-prefix reuse statistics of a chat session"""
+    requests: int = 0
+    prefix_hits: int = 0
+    prefix_misses: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    last_length: int = 0
+    last_digest: str = ""
+    
+    @property
+    def prefix_hit_ratio(self) -> float:
+        """Share of requests that extended the previous request's messages unchanged."""
+        checked = self.prefix_hits + self.prefix_misses
+        return self.prefix_hits / checked if checked else 0.0
+    
+    @property
+    def cached_ratio(self) -> float:
+        """Share of prompt tokens the provider served from its prompt cache."""
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get a summary of the statistics.
+        
+        Returns:
+            Dictionary of counters and ratios
+        """
+        return {
+            "requests": self.requests,
+            "prefix_hit_ratio": self.prefix_hit_ratio,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_ratio": self.cached_ratio,
+        }
 
 @dataclass
 class ChatSession:
-    """Chat session management"""
+    """Chat session management
+    
+    Requests are kept prefix-stable so that providers can reuse their prompt
+    cache: the system prompt is a fixed block in front of the history, the
+    history is append-only, and once it exceeds ``max_history`` messages the
+    oldest messages are dropped ``trim_chunk`` at a time, so the prefix only
+    changes once every ``trim_chunk`` messages rather than on every turn.
+    """
     messages: List[Message] = field(default_factory=list)
     temperature: float = 0.7
     max_tokens: int = 2000
+    system_prompt: Optional[str] = None
+    max_history: int = 0
+    trim_chunk: int = 16
+    prefix_stats: PrefixStats = field(default_factory=PrefixStats)
+    
+    @classmethod
+    def from_config(cls, settings: Dict[str, Any], **kwargs) -> "ChatSession":
+        """
+        Create a session from a ``[chat]`` configuration section.
+        
+        Args:
+            settings: Chat configuration section
+            **kwargs: Additional session fields (e.g. temperature, max_tokens)
+            
+        Returns:
+            Chat session instance
+        """
+        return cls(
+            system_prompt=settings.get("system_prompt", DEFAULT_SYSTEM_PROMPT),
+            max_history=settings.get("max_history", 0),
+            trim_chunk=settings.get("trim_chunk", 16),
+            **kwargs
+        )
     
     def add_message(
         self,
-        role: Literal["system", "user", "assistant", "function"],
+        role: Role,
         content: str,
         name: Optional[str] = None,
-        function_call: Optional[Dict[str, Any]] = None
+        function_call: Optional[Dict[str, Any]] = None,
+        tool_calls: Optional[List[Dict[str, Any]]] = None,
+        tool_call_id: Optional[str] = None
     ) -> None:
         """
         Add a message to the chat session.
         
         Args:
-            role: Message role (system, user, assistant, or function)
+            role: Message role (system, user, assistant, function, or tool)
             content: Message content
             name: Optional name for the message sender
             function_call: Optional function call data
+            tool_calls: Optional tool calls requested by the assistant
+            tool_call_id: Optional ID of the tool call a tool message answers
+        """
+        self.messages.append(Message(
+            role=role,
+            content=content,
+            name=name,
+            function_call=function_call,
+            tool_calls=tool_calls,
+            tool_call_id=tool_call_id
+        ))
+        if role == "user":
+            self._trim()
+    
+    def _trim(self) -> None:
+        """
+        Drop the oldest messages once the history exceeds ``max_history``.
+        
+        Messages are dropped in multiples of ``trim_chunk``, extended up to the
+        next user message so that no tool result is separated from its call.
+        The chunk is at most half of ``max_history``, so a trim never drops
+        the whole window. Called when a user message is added, so the window
+        always keeps it.
         """
-        self.messages.append(Message(role=role, content=content, name=name, function_call=function_call))
+        excess = len(self.messages) - self.max_history
+        if self.max_history <= 0 or excess <= 0:
+            return
+        chunk = max(min(self.trim_chunk, self.max_history // 2), 1)
+        drop = -(-excess // chunk) * chunk
+        while drop < len(self.messages) - 1 and self.messages[drop].role != "user":
+            drop += 1
+        del self.messages[:min(drop, len(self.messages) - 1)]
     
+    @profiled("ChatSession.get_messages")
     def get_messages(self) -> List[Dict[str, Any]]:
         """
         Get all messages in the session.
         
         Returns:
-            List of message dictionaries
+            List of message dictionaries, the system prompt first
         """
-        return [
+        system = [{"role": "system", "content": self.system_prompt}] if self.system_prompt else []
+        return system + [
             {
                 "role": msg.role,
                 "content": msg.content,
                 **({"name": msg.name} if msg.name else {}),
-                **({"function_call": msg.function_call} if msg.function_call else {})
+                **({"function_call": msg.function_call} if msg.function_call else {}),
+                **({"tool_calls": msg.tool_calls} if msg.tool_calls else {}),
+                **({"tool_call_id": msg.tool_call_id} if msg.tool_call_id else {})
             }
             for msg in self.messages
         ]
     
     def clear(self) -> None:
-        """Clear all messages from the session."""
-        self.messages.clear() 
\ No newline at end of file
+        """Clear all messages from the session, keeping the system prompt."""
+        self.messages.clear()
+    
+    def record_response(self, response: Dict[str, Any]) -> None:
+        """
+        Update the prefix statistics after a response to ``get_messages()``.
+        
+        Call before adding the assistant reply, so that the session still
+        holds the messages that were sent.
+        
+        Args:
+            response: API response dictionary
+        """
+        if "semantic_cache" in response:
+            return  # Answered locally, nothing was sent
+        stats = self.prefix_stats
+        messages = self.get_messages()
+        if stats.last_length:
+            if len(messages) >= stats.last_length and _digest(messages[:stats.last_length]) == stats.last_digest:
+                stats.prefix_hits += 1
+            else:
+                stats.prefix_misses += 1
+        stats.last_length = len(messages)
+        stats.last_digest = _digest(messages)
+        stats.requests += 1
+        usage = response.get("usage") or {}
+        stats.prompt_tokens += usage.get("prompt_tokens", 0)
+        stats.cached_tokens += cached_prompt_tokens(usage)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Convert the session to a serializable dictionary.
+        
+        Returns:
+            Session dictionary
+        """
+        return {
+            "messages": [asdict(msg) for msg in self.messages],
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "system_prompt": self.system_prompt,
+            "max_history": self.max_history,
+            "trim_chunk": self.trim_chunk,
+            "prefix_stats": asdict(self.prefix_stats)
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ChatSession":
+        """
+        Create a session from a dictionary produced by ``to_dict``.
+        
+        Args:
+            data: Session dictionary
+            
+        Returns:
+            Chat session instance
+        """
+        return cls(
+            messages=[Message(**msg) for msg in data.get("messages", [])],
+            temperature=data.get("temperature", 0.7),
+            max_tokens=data.get("max_tokens", 2000),
+            system_prompt=data.get("system_prompt"),
+            max_history=data.get("max_history", 0),
+            trim_chunk=data.get("trim_chunk", 16),
+            prefix_stats=PrefixStats(**data.get("prefix_stats", {}))
+        )
\ No newline at end of file
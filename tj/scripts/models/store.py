@@ -0,0 +1,575 @@
+"""
+Shared chat session storage.
+
+Sessions are stored outside the worker process so that any worker can serve
+any turn of a conversation. Each store also provides a per-session lock
+that serializes turns of the same conversation across workers. The lock is a
+lease renewed while it is held; a turn that lost its lease cannot save.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Optional, Protocol, Tuple, Union
+
+from .chat import ChatSession
+from ..utils import json_codec
+
+logger = logging.getLogger(__name__)
+
+# Release a lock only if it is still held by the owner (KEYS[1]: lock, ARGV[1]: owner)
+_UNLOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# Extend a lock only if it is still held by the owner (ARGV[2]: lease in milliseconds)
+_RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+class SessionStoreError(Exception):
+    """Session store error base class"""
+    pass
+
+class SessionLockTimeout(SessionStoreError):
+    """Session lock could not be acquired in time"""
+    pass
+
+class SessionLockLost(SessionStoreError):
+    """Session lock expired and may be held by another worker"""
+    pass
+
+class _LocalLock:
+    """In-process session lock with a count of coroutines using it"""
+
+    def __init__(self) -> None:
+        """Initialize an unlocked lock."""
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+class _Lease:
+    """Shared lock held by this worker"""
+
+    def __init__(self, owner: str) -> None:
+        """
+        Initialize the lease.
+
+        Args:
+            owner: Unique lock owner token
+        """
+        self.owner = owner
+        self.lost = False
+
+class SessionStore(ABC):
+    """Base session store class"""
+
+    def __init__(self, lock_ttl: float = 120.0, lock_timeout: float = 30.0, poll_interval: float = 0.05) -> None:
+        """
+        Initialize the store.
+
+        Args:
+            lock_ttl: Seconds after which a lock held by a crashed worker expires
+            lock_timeout: Seconds to wait for a session lock
+            poll_interval: Seconds between attempts to take a lock held elsewhere
+        """
+        self.lock_ttl = lock_ttl
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        # In-process locks keep turns from the same worker off the shared lock
+        self._local_locks: Dict[str, _LocalLock] = {}
+        self._leases: Dict[str, _Lease] = {}
+
+    @abstractmethod
+    async def load(self, session_id: str) -> Optional[ChatSession]:
+        """
+        Load a session.
+
+        Args:
+            session_id: Session identifier
+
+        Returns:
+            Chat session, or ``None`` if it does not exist
+        """
+        pass
+
+    async def save(self, session_id: str, session: ChatSession) -> None:
+        """
+        Save a session.
+
+        Args:
+            session_id: Session identifier
+            session: Chat session
+
+        Raises:
+            SessionLockLost: If the session is locked by this worker but the lease was lost
+        """
+        lease = self._leases.get(session_id)
+        if lease is not None and lease.lost:
+            raise SessionLockLost(f"Lost the lock of session {session_id}, not saving")
+        await self._save(session_id, session)
+
+    @abstractmethod
+    async def _save(self, session_id: str, session: ChatSession) -> None:
+        """
+        Write a session.
+
+        Args:
+            session_id: Session identifier
+            session: Chat session
+        """
+        pass
+
+    @abstractmethod
+    async def delete(self, session_id: str) -> None:
+        """
+        Delete a session.
+
+        Args:
+            session_id: Session identifier
+        """
+        pass
+
+    @abstractmethod
+    async def _try_lock(self, session_id: str, owner: str) -> bool:
+        """
+        Try once to take the shared lock of a session.
+
+        Args:
+            session_id: Session identifier
+            owner: Unique lock owner token
+
+        Returns:
+            Whether the lock was taken
+        """
+        pass
+
+    @abstractmethod
+    async def _renew(self, session_id: str, owner: str) -> bool:
+        """
+        Extend the lease of the shared lock of a session if still held by the owner.
+
+        Args:
+            session_id: Session identifier
+            owner: Lock owner token
+
+        Returns:
+            Whether the owner still holds the lock
+        """
+        pass
+
+    @abstractmethod
+    async def _unlock(self, session_id: str, owner: str) -> None:
+        """
+        Release the shared lock of a session if still held by the owner.
+
+        Args:
+            session_id: Session identifier
+            owner: Lock owner token
+        """
+        pass
+
+    async def _keep_lease(self, session_id: str, lease: _Lease) -> None:
+        """
+        Renew a lease every third of ``lock_ttl`` until cancelled or lost.
+
+        Args:
+            session_id: Session identifier
+            lease: Lease held by this worker
+        """
+        while True:
+            await asyncio.sleep(self.lock_ttl / 3)
+            try:
+                renewed = await self._renew(session_id, lease.owner)
+            except Exception as e:
+                # The lease survives a failed renewal until it expires; try again next time
+                logger.warning(f"Failed to renew the lock of session {session_id}: {e}")
+                continue
+            if not renewed:
+                lease.lost = True
+                logger.warning(f"Lost the lock of session {session_id}")
+                return
+
+    @asynccontextmanager
+    async def lock(self, session_id: str) -> AsyncIterator[None]:
+        """
+        Hold the lock of a session for the duration of the context.
+
+        Args:
+            session_id: Session identifier
+
+        Yields:
+            None once the lock is held
+
+        Raises:
+            SessionLockTimeout: If the lock is not acquired within ``lock_timeout``
+        """
+        local_lock = self._local_locks.setdefault(session_id, _LocalLock())
+        local_lock.users += 1
+        try:
+            async with local_lock.lock:
+                owner = uuid.uuid4().hex
+                deadline = time.monotonic() + self.lock_timeout
+                while not await self._try_lock(session_id, owner):
+                    if time.monotonic() >= deadline:
+                        raise SessionLockTimeout(f"Timed out waiting for session {session_id}")
+                    await asyncio.sleep(self.poll_interval)
+                lease = self._leases[session_id] = _Lease(owner)
+                # Long turns (e.g. several tool rounds) keep the lock beyond lock_ttl
+                renewal = asyncio.create_task(self._keep_lease(session_id, lease))
+                try:
+                    yield
+                finally:
+                    renewal.cancel()
+                    await asyncio.gather(renewal, return_exceptions=True)
+                    del self._leases[session_id]
+                    await self._unlock(session_id, owner)
+        finally:
+            local_lock.users -= 1
+            if not local_lock.users:
+                del self._local_locks[session_id]
+
+class MemorySessionStore(SessionStore):
+    """In-process session store for single-worker deployments"""
+
+    def __init__(self, **kwargs: Any) -> None:
+        """
+        Initialize the store.
+
+        Args:
+            **kwargs: Lock settings passed to ``SessionStore``
+        """
+        super().__init__(**kwargs)
+        self._sessions: Dict[str, ChatSession] = {}
+
+    async def load(self, session_id: str) -> Optional[ChatSession]:
+        """Load a session."""
+        return self._sessions.get(session_id)
+
+    async def _save(self, session_id: str, session: ChatSession) -> None:
+        """Write a session."""
+        self._sessions[session_id] = session
+
+    async def delete(self, session_id: str) -> None:
+        """Delete a session."""
+        self._sessions.pop(session_id, None)
+
+    async def _try_lock(self, session_id: str, owner: str) -> bool:
+        """The in-process lock is sufficient within a single worker."""
+        return True
+
+    async def _renew(self, session_id: str, owner: str) -> bool:
+        """The in-process lock does not expire."""
+        return True
+
+    async def _unlock(self, session_id: str, owner: str) -> None:
+        """Nothing to release beyond the in-process lock."""
+        pass
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite session store shared by the workers of a single node"""
+
+    def __init__(self, path: Union[str, Path] = "sessions.db", ttl: float = 86400, **kwargs: Any) -> None:
+        """
+        Initialize the store.
+
+        The database runs in WAL mode so that readers in one worker do not block
+        the writer in another. Queries run in a worker thread to keep the event
+        loop responsive.
+
+        Args:
+            path: Database file path
+            ttl: Seconds an idle session is kept, 0 to keep sessions forever
+            **kwargs: Lock settings passed to ``SessionStore``
+        """
+        super().__init__(**kwargs)
+        self.path = Path(path)
+        self.ttl = ttl
+        self._next_purge = 0.0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=self.lock_timeout, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data BLOB NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS session_locks (id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+
+    def _execute(self, sql: str, params: Tuple[Any, ...] = ()) -> Tuple[Optional[Tuple[Any, ...]], int]:
+        """
+        Run one statement.
+
+        Args:
+            sql: SQL statement
+            params: Statement parameters
+
+        Returns:
+            Tuple of the first result row and the number of modified rows
+        """
+        with self._db_lock:
+            cursor = self._db.execute(sql, params)
+            return cursor.fetchone(), cursor.rowcount
+
+    async def load(self, session_id: str) -> Optional[ChatSession]:
+        """Load a session unless it has expired."""
+        oldest = time.time() - self.ttl if self.ttl else 0.0
+        row, _ = await asyncio.to_thread(
+            self._execute, "SELECT data FROM sessions WHERE id = ? AND updated >= ?", (session_id, oldest)
+        )
+        return ChatSession.from_dict(json_codec.loads(row[0])) if row else None
+
+    async def _save(self, session_id: str, session: ChatSession) -> None:
+        """Write a session, purging expired sessions at most once per tenth of the TTL."""
+        now = time.time()
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO sessions (id, data, updated) VALUES (?, ?, ?)",
+            (session_id, json_codec.dumps(session.to_dict()), now)
+        )
+        if self.ttl and now >= self._next_purge:
+            self._next_purge = now + self.ttl / 10
+            await asyncio.to_thread(self._execute, "DELETE FROM sessions WHERE updated < ?", (now - self.ttl,))
+
+    async def delete(self, session_id: str) -> None:
+        """Delete a session."""
+        await asyncio.to_thread(self._execute, "DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def _try_lock_sync(self, session_id: str, owner: str) -> bool:
+        """
+        Take the lock row unless another owner holds an unexpired lease.
+
+        Args:
+            session_id: Session identifier
+            owner: Unique lock owner token
+
+        Returns:
+            Whether the lock was taken
+        """
+        now = time.time()
+        with self._db_lock:
+            cursor = self._db.execute(
+                "INSERT INTO session_locks (id, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE session_locks.expires < ?",
+                (session_id, owner, now + self.lock_ttl, now)
+            )
+            return cursor.rowcount == 1
+
+    async def _try_lock(self, session_id: str, owner: str) -> bool:
+        """Try once to take the shared lock of a session."""
+        return await asyncio.to_thread(self._try_lock_sync, session_id, owner)
+
+    async def _renew(self, session_id: str, owner: str) -> bool:
+        """Extend the lease of the shared lock of a session if still held by the owner."""
+        _, count = await asyncio.to_thread(
+            self._execute,
+            "UPDATE session_locks SET expires = ? WHERE id = ? AND owner = ?",
+            (time.time() + self.lock_ttl, session_id, owner)
+        )
+        return count == 1
+
+    async def _unlock(self, session_id: str, owner: str) -> None:
+        """Release the shared lock of a session if still held by the owner."""
+        await asyncio.to_thread(
+            self._execute, "DELETE FROM session_locks WHERE id = ? AND owner = ?", (session_id, owner)
+        )
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._db_lock:
+            self._db.close()
+
+class KeyValueClient(Protocol):
+    """Subset of the ``redis.asyncio.Redis`` API used by ``NetworkSessionStore``"""
+
+    async def get(self, name: str) -> Optional[bytes]: ...
+
+    async def set(self, name: str, value: Union[bytes, str], px: Optional[int] = None, nx: bool = False) -> Optional[bool]: ...
+
+    async def delete(self, *names: str) -> int: ...
+
+    async def eval(self, script: str, numkeys: int, *keys_and_args: Union[bytes, str, int]) -> Any: ...
+
+class LocalKeyValueClient:
+    """In-process stand-in for a network key-value store, for tests and local runs"""
+
+    def __init__(self) -> None:
+        """Initialize an empty store."""
+        self._data: Dict[str, Tuple[bytes, Optional[float]]] = {}
+
+    def _live(self, name: str) -> Optional[bytes]:
+        """
+        Get a value unless it has expired.
+
+        Args:
+            name: Key
+
+        Returns:
+            Stored value, or ``None``
+        """
+        item = self._data.get(name)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            del self._data[name]
+            return None
+        return value
+
+    async def get(self, name: str) -> Optional[bytes]:
+        """Get a value."""
+        return self._live(name)
+
+    async def set(self, name: str, value: Union[bytes, str], px: Optional[int] = None, nx: bool = False) -> Optional[bool]:
+        """Set a value, optionally with a millisecond TTL and only if absent."""
+        if nx and self._live(name) is not None:
+            return None
+        data = value.encode("utf-8") if isinstance(value, str) else value
+        self._data[name] = (data, time.monotonic() + px / 1000 if px else None)
+        return True
+
+    async def delete(self, *names: str) -> int:
+        """Delete keys."""
+        return sum(self._data.pop(name, None) is not None for name in names)
+
+    async def eval(self, script: str, numkeys: int, *keys_and_args: Union[bytes, str, int]) -> Any:
+        """
+        Run one of the lock scripts of ``NetworkSessionStore``.
+
+        Each script runs without awaiting, so it is atomic like a Lua script in Redis.
+
+        Args:
+            script: ``_UNLOCK_SCRIPT`` or ``_RENEW_SCRIPT``
+            numkeys: Number of keys (1)
+            *keys_and_args: Lock key, owner and, for renewal, the lease in milliseconds
+
+        Returns:
+            1 if the owner held the lock, 0 otherwise
+
+        Raises:
+            ValueError: If the script is not one of the lock scripts
+        """
+        name, owner, *args = keys_and_args
+        value = self._live(str(name))
+        if value is None or value.decode("utf-8") != owner:
+            return 0
+        if script == _UNLOCK_SCRIPT:
+            del self._data[str(name)]
+        elif script == _RENEW_SCRIPT:
+            self._data[str(name)] = (value, time.monotonic() + int(args[0]) / 1000)
+        else:
+            raise ValueError("LocalKeyValueClient only runs the session lock scripts")
+        return 1
+
+class NetworkSessionStore(SessionStore):
+    """Session store on a network key-value store (e.g. Redis) shared by all nodes"""
+
+    def __init__(
+        self,
+        client: KeyValueClient,
+        prefix: str = "tj:session:",
+        ttl: float = 86400,
+        **kwargs: Any
+    ) -> None:
+        """
+        Initialize the store.
+
+        Args:
+            client: Key-value client such as ``redis.asyncio.Redis``
+            prefix: Key prefix
+            ttl: Seconds an idle session is kept, 0 to keep sessions forever
+            **kwargs: Lock settings passed to ``SessionStore``
+        """
+        super().__init__(**kwargs)
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    async def load(self, session_id: str) -> Optional[ChatSession]:
+        """Load a session."""
+        data = await self.client.get(f"{self.prefix}{session_id}")
+        return ChatSession.from_dict(json_codec.loads(data)) if data else None
+
+    async def _save(self, session_id: str, session: ChatSession) -> None:
+        """Write a session."""
+        await self.client.set(
+            f"{self.prefix}{session_id}",
+            json_codec.dumps(session.to_dict()),
+            # Redis rejects a zero expiry, so 0 means no expiry as in SQLite
+            px=int(self.ttl * 1000) if self.ttl else None
+        )
+
+    async def delete(self, session_id: str) -> None:
+        """Delete a session."""
+        await self.client.delete(f"{self.prefix}{session_id}")
+
+    async def _try_lock(self, session_id: str, owner: str) -> bool:
+        """Try once to take the shared lock of a session."""
+        return bool(await self.client.set(
+            f"{self.prefix}lock:{session_id}", owner, px=int(self.lock_ttl * 1000), nx=True
+        ))
+
+    async def _renew(self, session_id: str, owner: str) -> bool:
+        """Extend the lease of the shared lock of a session if still held by the owner."""
+        return bool(await self.client.eval(
+            _RENEW_SCRIPT, 1, f"{self.prefix}lock:{session_id}", owner, int(self.lock_ttl * 1000)
+        ))
+
+    async def _unlock(self, session_id: str, owner: str) -> None:
+        """Release the shared lock of a session if still held by the owner."""
+        # Compare and delete atomically: the lease may have expired and been taken by another worker
+        await self.client.eval(_UNLOCK_SCRIPT, 1, f"{self.prefix}lock:{session_id}", owner)
+
+def create_session_store(settings: Dict[str, Any]) -> SessionStore:
+    """
+    Create a session store from a ``[session_store]`` configuration section.
+
+    Args:
+        settings: Session store configuration section
+
+    Returns:
+        Session store instance
+
+    Raises:
+        SessionStoreError: If the backend is unknown or unavailable
+    """
+    backend = settings.get("backend", "memory")
+    lock_settings = {
+        "lock_ttl": settings.get("lock_ttl", 120.0),
+        "lock_timeout": settings.get("lock_timeout", 30.0),
+    }
+    if backend == "memory":
+        return MemorySessionStore(**lock_settings)
+    if backend == "sqlite":
+        return SQLiteSessionStore(settings.get("path", "sessions.db"), ttl=settings.get("ttl", 86400), **lock_settings)
+    if backend == "redis":
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise SessionStoreError('The redis session store requires redis: pip install -e ".[redis]"')
+        return NetworkSessionStore(
+            redis.asyncio.from_url(settings.get("url", "redis://localhost:6379/0")),
+            ttl=settings.get("ttl", 86400),
+            **lock_settings
+        )
+    if backend == "local":
+        return NetworkSessionStore(LocalKeyValueClient(), ttl=settings.get("ttl", 86400), **lock_settings)
+    raise SessionStoreError(f"Unknown session store backend: {backend}")
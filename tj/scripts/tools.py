@@ -0,0 +1,408 @@
+"""
+Function/tool calling support.
+
+Register Python callables with the ``tool`` decorator (or a custom
+``ToolRegistry``) and let a ``ToolEngine`` run the tool calls requested by
+the model, all calls of one assistant turn concurrently. The CLI and UI
+import the modules listed in ``[tools] modules`` so their tools register.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import functools
+import importlib
+import inspect
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from .config import ConfigError
+from .models.chat import ChatSession
+from .utils import json_codec
+
+if TYPE_CHECKING:
+    from .api.base import BaseAPIClient
+
+logger = logging.getLogger(__name__)
+
+# JSON schema types for annotated tool parameters
+_JSON_TYPES: Dict[Any, str] = {
+    str: "string",
+    int: "integer",
+    float: "number",
+    bool: "boolean",
+    list: "array",
+    dict: "object",
+}
+
+@dataclass
+class Tool:
+    """Registered tool"""
+    name: str
+    func: Callable[..., Any]
+    description: str
+    parameters: Dict[str, Any]
+    timeout: Optional[float] = None
+
+    @property
+    def is_async(self) -> bool:
+        """Whether the tool is a coroutine function."""
+        return inspect.iscoroutinefunction(self.func)
+
+    def spec(self) -> Dict[str, Any]:
+        """
+        Get the tool definition sent to the API.
+
+        Returns:
+            Tool definition dictionary
+        """
+        return {
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "description": self.description,
+                "parameters": self.parameters,
+            },
+        }
+
+def _schema_from_signature(func: Callable[..., Any]) -> Dict[str, Any]:
+    """
+    Build a JSON schema for the parameters of a callable.
+
+    Args:
+        func: Callable to inspect
+
+    Returns:
+        JSON schema of the keyword arguments
+    """
+    properties: Dict[str, Any] = {}
+    required: List[str] = []
+    try:
+        signature = inspect.signature(func, eval_str=True)
+    except NameError:
+        signature = inspect.signature(func)
+    for name, param in signature.parameters.items():
+        if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+            continue
+        json_type = _JSON_TYPES.get(param.annotation)
+        properties[name] = {"type": json_type} if json_type else {}
+        if param.default is param.empty:
+            required.append(name)
+    return {"type": "object", "properties": properties, "required": required}
+
+class ToolRegistry:
+    """Registry of callables the model may invoke"""
+
+    def __init__(self) -> None:
+        """Initialize an empty registry."""
+        self._tools: Dict[str, Tool] = {}
+
+    def __len__(self) -> int:
+        """Number of registered tools."""
+        return len(self._tools)
+
+    def __contains__(self, name: str) -> bool:
+        """Whether a tool is registered under a name."""
+        return name in self._tools
+
+    def register(
+        self,
+        func: Optional[Callable[..., Any]] = None,
+        *,
+        name: Optional[str] = None,
+        description: Optional[str] = None,
+        parameters: Optional[Dict[str, Any]] = None,
+        timeout: Optional[float] = None
+    ) -> Any:
+        """
+        Register a sync or async callable as a tool.
+
+        Can be used directly or as a decorator, with or without arguments.
+
+        Args:
+            func: Callable to register
+            name: Tool name, defaults to the function name
+            description: Tool description, defaults to the first docstring line
+            parameters: JSON schema of the arguments, derived from the signature by default
+            timeout: Per-tool timeout in seconds, defaults to the engine timeout
+
+        Returns:
+            The callable itself, or a decorator when ``func`` is omitted
+        """
+        def decorator(target: Callable[..., Any]) -> Callable[..., Any]:
+            doc = inspect.getdoc(target) or ""
+            tool = Tool(
+                name=name or target.__name__,
+                func=target,
+                description=description or (doc.splitlines()[0] if doc else ""),
+                parameters=parameters or _schema_from_signature(target),
+                timeout=timeout,
+            )
+            self._tools[tool.name] = tool
+            return target
+
+        return decorator(func) if func is not None else decorator
+
+    def get(self, name: str) -> Optional[Tool]:
+        """
+        Get a registered tool.
+
+        Args:
+            name: Tool name
+
+        Returns:
+            Tool, or ``None`` if not registered
+        """
+        return self._tools.get(name)
+
+    def specs(self) -> List[Dict[str, Any]]:
+        """
+        Get the definitions of all registered tools.
+
+        Returns:
+            List of tool definition dictionaries
+        """
+        return [tool.spec() for tool in self._tools.values()]
+
+# Answer shown when the model still asks for tools after the last round
+ROUND_LIMIT_MESSAGE = (
+    "Sorry, I could not finish this request: the tools were called "
+    "the maximum number of times without reaching an answer."
+)
+
+# Default registry used by the CLI and UI entry points
+registry = ToolRegistry()
+tool = registry.register
+
+def load_modules(modules: List[str]) -> None:
+    """
+    Import the modules whose ``tool`` decorators register tools.
+
+    Args:
+        modules: Dotted module names from ``[tools] modules``
+
+    Raises:
+        ConfigError: If a module cannot be imported
+    """
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            # Any error raised while importing a tool module is a configuration problem
+            raise ConfigError(f"Cannot import tool module {name}: {e}")
+    if modules:
+        logger.info(f"Loaded {len(registry)} tools from {', '.join(modules)}")
+
+class ToolEngine:
+    """Execute model-requested tool calls and re-invoke the model"""
+
+    def __init__(
+        self,
+        registry: ToolRegistry,
+        timeout: float = 30.0,
+        max_workers: int = 8,
+        max_rounds: int = 5
+    ) -> None:
+        """
+        Initialize the tool engine.
+
+        Python threads cannot be interrupted, so a blocking tool that times out
+        keeps its thread until it returns. Once every thread is held by such a
+        tool, further blocking tool calls fail at once instead of queueing.
+
+        Args:
+            registry: Registered tools
+            timeout: Default per-tool timeout in seconds
+            max_workers: Threads available to blocking (sync) tools
+            max_rounds: Maximum tool-calling rounds per user turn
+        """
+        self.registry = registry
+        self.timeout = timeout
+        self.max_rounds = max_rounds
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        # Threads still running a blocking tool that already timed out
+        self._abandoned = 0
+        self._abandoned_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, registry: ToolRegistry, settings: Dict[str, Any]) -> "ToolEngine":
+        """
+        Create an engine from a ``[tools]`` configuration section.
+
+        Args:
+            registry: Registered tools
+            settings: Tools configuration section
+
+        Returns:
+            Tool engine instance
+        """
+        return cls(
+            registry,
+            timeout=settings.get("timeout", 30.0),
+            max_workers=settings.get("max_workers", 8),
+            max_rounds=settings.get("max_rounds", 5)
+        )
+
+    def close(self) -> None:
+        """Shut down the thread pool used by blocking tools."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, future: Future) -> None:
+        """
+        Count a timed-out blocking tool as finished.
+
+        Args:
+            future: Future of the tool call
+        """
+        with self._abandoned_lock:
+            self._abandoned -= 1
+
+    async def _run_blocking(self, tool: Tool, kwargs: Dict[str, Any], timeout: float) -> Any:
+        """
+        Run a blocking tool in the thread pool.
+
+        Args:
+            tool: Tool to run
+            kwargs: Keyword arguments
+            timeout: Timeout in seconds
+
+        Returns:
+            Tool result
+
+        Raises:
+            asyncio.TimeoutError: If the tool does not finish in time
+            RuntimeError: If every thread is held by a timed-out tool
+        """
+        if self._abandoned >= self.max_workers:
+            raise RuntimeError("all tool threads are held by timed-out tools")
+        future = self._executor.submit(functools.partial(tool.func, **kwargs))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            if not future.cancel():
+                with self._abandoned_lock:
+                    self._abandoned += 1
+                future.add_done_callback(self._release)
+            raise
+
+    async def execute(self, name: str, arguments: Optional[str]) -> str:
+        """
+        Run one tool call.
+
+        Failures are reported back to the model as a JSON error object rather
+        than raised, so one failing tool does not abort the turn.
+
+        Args:
+            name: Tool name
+            arguments: JSON encoded keyword arguments
+
+        Returns:
+            Tool result as text
+        """
+        tool = self.registry.get(name)
+        if tool is None:
+            return json_codec.dumps({"error": f"Unknown tool: {name}"}).decode("utf-8")
+
+        timeout = tool.timeout or self.timeout
+        try:
+            kwargs = json_codec.loads(arguments) if arguments else {}
+            if tool.is_async:
+                result = await asyncio.wait_for(tool.func(**kwargs), timeout)
+            else:
+                result = await self._run_blocking(tool, kwargs, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Tool {name} timed out after {timeout}s")
+            return json_codec.dumps({"error": f"Tool {name} timed out after {timeout}s"}).decode("utf-8")
+        except Exception as e:
+            logger.warning(f"Tool {name} failed: {e}")
+            return json_codec.dumps({"error": f"Tool {name} failed: {e}"}).decode("utf-8")
+
+        if isinstance(result, str):
+            return result
+        return json_codec.dumps(result, default=str).decode("utf-8")
+
+    async def run(
+        self,
+        client: "BaseAPIClient",
+        session: ChatSession,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Get the model's answer to the session, running requested tools.
+
+        Each round, all tool calls of the assistant turn run concurrently and
+        their results are appended to the session before the model is called
+        again. The final assistant message is returned, not added to the session.
+
+        Args:
+            client: API client
+            session: Chat session ending with the user turn
+            **kwargs: Additional arguments to pass to the API
+
+        Returns:
+            API response dictionary of the final (non tool-calling) turn; if
+            the model still asks for tools after ``max_rounds``, its content
+            falls back to ``ROUND_LIMIT_MESSAGE``
+        """
+        if not len(self.registry):
+            response = await client.chat_completion(
+                messages=session.get_messages(),
+                temperature=session.temperature,
+                max_tokens=session.max_tokens,
+                **kwargs
+            )
+            session.record_response(response)
+            return response
+
+        for round_number in range(self.max_rounds + 1):
+            # Force a plain answer once the round limit is reached
+            tool_choice = "none" if round_number == self.max_rounds else "auto"
+            response = await client.chat_completion(
+                messages=session.get_messages(),
+                temperature=session.temperature,
+                max_tokens=session.max_tokens,
+                tools=self.registry.specs(),
+                tool_choice=tool_choice,
+                **kwargs
+            )
+            session.record_response(response)
+            message = response["choices"][0]["message"]
+            tool_calls = message.get("tool_calls")
+            function_call = message.get("function_call")
+
+            if tool_calls:
+                session.add_message(
+                    role="assistant",
+                    content=message.get("content") or "",
+                    tool_calls=tool_calls
+                )
+                results = await asyncio.gather(*(
+                    self.execute(call["function"]["name"], call["function"].get("arguments"))
+                    for call in tool_calls
+                ))
+                for call, result in zip(tool_calls, results):
+                    session.add_message(role="tool", content=result, tool_call_id=call["id"])
+            elif function_call:
+                # Legacy single function call
+                session.add_message(
+                    role="assistant",
+                    content=message.get("content") or "",
+                    function_call=function_call
+                )
+                result = await self.execute(function_call["name"], function_call.get("arguments"))
+                session.add_message(role="function", content=result, name=function_call["name"])
+            else:
+                return response
+
+        # The model kept asking for tools although tool_choice was "none"
+        logger.warning(f"Tool calling stopped after {self.max_rounds} rounds without an answer")
+        message = response["choices"][0]["message"]
+        if not message.get("content"):
+            message["content"] = ROUND_LIMIT_MESSAGE
+        return response
@@ -6,24 +6,30 @@ Email: tangj1984@gmail.com
 Date: 2024-03-21
 """
 
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import uuid
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, List, Optional, Tuple
 
-import gradio as gr
 from .models.chat import ChatSession
-from .config import config
-from .utils.logger import setup_logger
-from .api.openai import OpenAIClient
-
-# Set up logging
-logger = setup_logger(
-    "tj.scripts",
-    level=config.get("logging", "level", "INFO"),
-    format=config.get("logging", "format", "%(asctime)s - %(name)s - %(levelname)s - %(message)s"),
-    file=config.get("logging", "file", "app.log"),
-    max_size=config.get("logging", "max_size", 10 * 1024 * 1024),  # 10MB
-    backup_count=config.get("logging", "backup_count", 5)
-)
+from .models.store import MemorySessionStore, SessionStore, create_session_store
+from .config import Changes, get_config, ConfigError
+from .utils.admission import AdmissionController, Overloaded
+from .utils.logger import setup_logger_from_config, log_content
+from .utils.profiling import profiled, profiler, start_from_env
+from .utils.usage import BudgetExceeded, UsageTracker, attribute
+
+if TYPE_CHECKING:
+    # gradio and aiohttp are imported lazily so that importing this module stays cheap
+    import gradio as gr
+    from .api.openai import OpenAIClient
+    from .tools import ToolEngine
+
+# Handlers are attached in main() once the configuration has been loaded
+logger = logging.getLogger("tj.scripts")
 
 # 获取资源目录路径
 RESOURCE_DIR = Path(__file__).parent.parent / "resources"
@@ -36,14 +42,50 @@ AVATAR_DIR.mkdir(parents=True, exist_ok=True)
 USER_AVATAR = str(AVATAR_DIR / "user.png")
 ASSISTANT_AVATAR = str(AVATAR_DIR / "assistant.png")
 
+def _user_of(request: Optional["gr.Request"]) -> str:
+    """Identify the user of a request for usage accounting.
+
+    Args:
+        request: The Gradio request
+
+    Returns:
+        The login name; without authentication the client address if
+        ``[usage] identity`` is ``"client"``, otherwise the browser session
+    """
+    if request is None:
+        return ""
+    if request.username:
+        return request.username
+    # 反向代理或 NAT 后所有访客共享同一地址，默认按浏览器会话区分
+    if get_config().get("usage", "identity", "session") == "client" and request.client:
+        return request.client.host
+    return request.session_hash or ""
+
 class ChatUI:
     """Chat UI class for managing the Gradio interface."""
 
-    def __init__(self) -> None:
-        """Initialize the chat UI."""
+    def __init__(
+        self,
+        admission: Optional[AdmissionController] = None,
+        store: Optional[SessionStore] = None
+    ) -> None:
+        """Initialize the chat UI.
+
+        Args:
+            admission: Admission controller bounding concurrent and queued messages
+            store: Session store holding the conversations, in-process by default
+        """
         try:
-            self.chat_session: Optional[ChatSession] = None
-            self.client: Optional[OpenAIClient] = None
+            self.admission = admission or AdmissionController()
+            self.store = store or MemorySessionStore()
+            self.api_config: Dict[str, Any] = {}
+            self.client: Optional["OpenAIClient"] = None
+            self.tool_engine: Optional["ToolEngine"] = None
+            # 多模型对比使用的客户端，每个服务商一个
+            self.compare_clients: Dict[str, "OpenAIClient"] = {}
+            self._watch_task: Optional[asyncio.Task] = None
+            # 按会话、用户和服务商统计 token 用量
+            self.usage: Optional[UsageTracker] = None
             self.history: List[Tuple[str, str]] = []  # 修改为元组列表
             self.is_initialized = False
             logger.info("Chat UI initialized successfully")
@@ -56,27 +98,44 @@ class ChatUI:
         if self.is_initialized:
             return
 
+        from .api.openai import OpenAIClient
+
         try:
             # 获取 API 配置
-            api_config = config.get_section("api").get("siliconflow", {})
+            provider = get_config().get("chat", "provider", "siliconflow")
+            api_config = get_config().get_section("api").get(provider, {})
             if not api_config:
-                raise ValueError("SiliconFlow API configuration not found")
-            
-            # 创建 OpenAI 客户端
-            self.client = OpenAIClient(api_config)
+                raise ValueError(f"API configuration not found: {provider}")
             
-            # 创建聊天会话
-            self.chat_session = ChatSession(
-                temperature=api_config.get("temperature", 0.7),
-                max_tokens=api_config.get("max_tokens", 2000)
-            )
-            
-            # 添加系统消息
-            self.chat_session.add_message(
-                role="system",
-                content="You are a helpful AI assistant."
-            )
+            # 创建 OpenAI 客户端并预热连接池
+            self.client = OpenAIClient(api_config, provider)
+            await self.client.prewarm()
+
+            # 统计 token 用量并定期写入文件，超出预算的用户降低优先级或拒绝请求
+            usage_config = get_config().get_section("usage")
+            if usage_config.get("enabled", False):
+                self.usage = UsageTracker.from_config(usage_config)
+                self.client.usage = self.usage
+
+            # 启用语义缓存，对语义相近的问题直接返回缓存的回答
+            cache_config = get_config().get_section("semantic_cache")
+            if cache_config.get("enabled", False):
+                self.client.enable_semantic_cache(cache_config)
+
+            # 模型请求调用工具时并发执行已注册的工具
+            from .tools import ToolEngine, load_modules, registry
+            load_modules(get_config().get("tools", "modules", []))
+            if len(registry):
+                self.tool_engine = ToolEngine.from_config(registry, get_config().get_section("tools"))
             
+            self.api_config = api_config
+
+            # 配置文件变更时热加载，无需重启进程、不丢失会话和缓存
+            reload_config = get_config().get_section("hot_reload")
+            if reload_config.get("enabled", False) and self._watch_task is None:
+                get_config().subscribe(self.apply_config)
+                self._watch_task = asyncio.create_task(get_config().watch(reload_config.get("interval", 2.0)))
+
             # 添加欢迎消息
             welcome_message = (
                 "Welcome to the AI Chat! I'm here to help you with any questions or tasks you have.\n\n"
@@ -98,13 +157,60 @@ class ChatUI:
             self.is_initialized = False
             raise
 
+    async def apply_config(self, changes: Changes) -> None:
+        """Apply a reloaded configuration to the API clients and admission control.
+
+        Args:
+            changes: Changed settings by dotted key
+        """
+        config = get_config()
+        grace = config.get("hot_reload", "grace", 30.0)
+        api_settings = config.get_section("api")
+
+        provider = config.get("chat", "provider", "siliconflow")
+        api_config = api_settings.get(provider)
+        if not api_config:
+            logger.warning(f"API configuration not found: {provider}, keeping the current client settings")
+        elif self.client is not None and api_config != self.client.config:
+            await self.client.update_config(api_config, grace)
+            self.client.provider = provider
+            self.api_config = api_config
+
+        for name, client in list(self.compare_clients.items()):
+            if name not in api_settings:
+                del self.compare_clients[name]
+                await client.close(grace)
+            elif api_settings[name] != client.config:
+                await client.update_config(api_settings[name], grace)
+
+        ui_config = config.get_section("ui")
+        self.admission.max_queue = ui_config.get("max_queue", 32)
+        self.admission.max_wait = ui_config.get("max_wait", 10.0)
+        if self.usage is not None:
+            self.usage.configure(config.get_section("usage"))
+
+    def _new_session(self) -> ChatSession:
+        """Create a chat session with the configured system prompt.
+
+        Returns:
+            New chat session
+        """
+        return ChatSession.from_config(
+            get_config().get_section("chat"),
+            temperature=self.api_config.get("temperature", 0.7),
+            max_tokens=self.api_config.get("max_tokens", 2000)
+        )
+
+    @profiled("ChatUI.send_message")
     async def send_message(
         self,
         message: str,
         history: List[Tuple[str, str]],  # 修改为元组列表
         temperature: float = 0.7,
         max_tokens: int = 2000,
-    ) -> Tuple[List[Tuple[str, str]], str]:  # 修改为元组列表
+        session_id: str = "",
+        user: str = "",
+    ) -> Tuple[List[Tuple[str, str]], str, str]:  # 修改为元组列表
         """Send a message and get the response.
 
         Args:
@@ -112,86 +218,203 @@ class ChatUI:
             history: The chat history as list of (user_message, assistant_message) tuples
             temperature: The temperature for response generation
             max_tokens: The maximum number of tokens to generate
+            session_id: The conversation ID kept by the browser, empty for a new conversation
+            user: The user the token usage is accounted to
 
         Returns:
             Tuple containing:
             - The updated chat history as list of (user_message, assistant_message) tuples
             - Empty string to clear input
+            - The conversation ID
         """
         if not message.strip():
-            return history, ""
+            return history, "", session_id
 
+        session_id = session_id or uuid.uuid4().hex
         try:
             if not self.is_initialized:
                 await self.initialize_chat()
 
-            if not self.chat_session or not self.client:
-                raise ValueError("Chat session or client not initialized")
-
-            # 更新聊天参数
-            self.chat_session.temperature = temperature
-            self.chat_session.max_tokens = max_tokens
-
-            # 添加用户消息
-            self.chat_session.add_message(
-                role="user",
-                content=message
-            )
-
-            # 发送请求
-            response = await self.client.chat_completion(
-                messages=self.chat_session.get_messages(),
-                temperature=temperature,
-                max_tokens=max_tokens,
-                stream=False
-            )
+            if not self.client:
+                raise ValueError("Client not initialized")
+
+            # 本轮请求的用量计入该会话和用户
+            with attribute(session_id, user or session_id):
+                # 排队过长时直接拒绝，避免所有请求一起超时
+                async with self.admission.admit():
+                    # 同一会话的各轮消息串行处理，会话保存在共享存储中，任意进程均可处理
+                    async with self.store.lock(session_id):
+                        chat_session = await self.store.load(session_id) or self._new_session()
+
+                        # 更新聊天参数
+                        chat_session.temperature = temperature
+                        chat_session.max_tokens = max_tokens
+
+                        # 添加用户消息
+                        chat_session.add_message(
+                            role="user",
+                            content=message
+                        )
 
-            # 获取助手回复
-            assistant_message = response["choices"][0]["message"]["content"]
+                        # 发送请求
+                        if self.tool_engine is not None:
+                            response = await self.tool_engine.run(self.client, chat_session)
+                        else:
+                            response = await self.client.chat_completion(
+                                messages=chat_session.get_messages(),
+                                temperature=temperature,
+                                max_tokens=max_tokens,
+                                stream=False
+                            )
+                            chat_session.record_response(response)
+
+                        # 获取助手回复
+                        assistant_message = response["choices"][0]["message"]["content"]
+
+                        # 添加助手回复
+                        chat_session.add_message(
+                            role="assistant",
+                            content=assistant_message
+                        )
 
-            # 添加助手回复
-            self.chat_session.add_message(
-                role="assistant",
-                content=assistant_message
-            )
+                        await self.store.save(session_id, chat_session)
 
             # 更新历史记录
             history.append((message, assistant_message))
 
             # 记录日志
-            logger.info(f"User: {message}")
-            logger.info(f"Assistant: {assistant_message}")
-
-            return history, ""
+            log_content(logger, "User", message)
+            log_content(logger, "Assistant", assistant_message)
+
+            return history, "", session_id
+        except Overloaded as e:
+            logger.warning(f"Rejected message, estimated wait {self.admission.estimated_wait():.1f}s")
+            history.append((message, str(e)))
+            return history, "", session_id
+        except BudgetExceeded as e:
+            logger.warning(f"Rejected message of {e.user}, token budget used up")
+            history.append((message, str(e)))
+            return history, "", session_id
         except Exception as e:
             error_msg = f"Error: {str(e)}"
             logger.error(f"Error sending message: {e}")
             history.append((message, error_msg))  # 使用元组而不是字典
-            return history, ""
+            return history, "", session_id
 
-    def clear_history(self) -> List[Tuple[str, str]]:  # 修改为元组列表
+    @profiled("ChatUI.clear_history")
+    async def clear_history(self, session_id: str = "") -> List[Tuple[str, str]]:  # 修改为元组列表
         """Clear the chat history.
 
+        Args:
+            session_id: The conversation ID kept by the browser
+
         Returns:
             Empty chat history as list of (user_message, assistant_message) tuples
         """
-        if self.chat_session:
-            self.chat_session.clear()
-            # 重新添加系统消息
-            self.chat_session.add_message(
-                role="system",
-                content="You are a helpful AI assistant."
-            )
+        if session_id:
+            # 删除会话后，下一条消息会以仅含系统消息的新会话开始
+            async with self.store.lock(session_id):
+                await self.store.delete(session_id)
         self.history = []
         logger.info("Chat history cleared")
         return []
 
-    def create_ui(self) -> gr.Blocks:
+    async def get_metrics(self, session_id: str = "") -> Dict[str, Any]:
+        """Get queue-depth, wait-time and prompt-cache metrics.
+
+        Args:
+            session_id: The conversation ID kept by the browser
+
+        Returns:
+            Admission metrics, plus API scheduler metrics when request scheduling
+            is enabled, prompt-cache statistics of the current conversation and
+            token usage when usage accounting is enabled
+        """
+        metrics: Dict[str, Any] = {"admission": self.admission.metrics()}
+        if self.client is not None and self.client.scheduler is not None:
+            metrics["scheduler"] = self.client.scheduler.metrics()
+        chat_session = await self.store.load(session_id) if session_id else None
+        if chat_session is not None:
+            metrics["prompt_cache"] = chat_session.prefix_stats.snapshot()
+        if self.usage is not None:
+            metrics["usage"] = self.usage.metrics(session=session_id)
+        metrics["profiler"] = profiler.status()
+        return metrics
+
+    async def start_profiling(self, seconds: float, session_id: str = "") -> Dict[str, Any]:
+        """Open a profiling window in this worker.
+
+        Args:
+            seconds: Window length in seconds
+            session_id: The conversation ID kept by the browser
+
+        Returns:
+            Metrics including the profiler state
+        """
+        if not profiler.start(seconds):
+            logger.info("Profiling already in progress")
+        return await self.get_metrics(session_id)
+
+    @profiled("ChatUI.compare_models")
+    async def compare_models(self, prompt: str, providers: List[str], user: str = "") -> AsyncIterator[List[str]]:
+        """Stream the answers of several providers to the same prompt side by side.
+
+        Args:
+            prompt: The prompt sent to every provider
+            providers: Names of the compared providers
+            user: The user the token usage is accounted to
+
+        Yields:
+            Markdown of every configured provider's pane, with TTFT, total latency
+            and tokens/sec next to each answer
+        """
+        from .compare import compare, create_clients
+
+        names = list(get_config().get_section("api"))
+        panes = {name: "" for name in names}
+        if not prompt.strip() or not providers:
+            yield list(panes.values())
+            return
+
+        try:
+            missing = [name for name in providers if name not in self.compare_clients]
+            if missing:
+                clients = create_clients(get_config().get_section("api"), missing)
+                for client in clients.values():
+                    client.usage = self.usage
+                # 预先建立连接，避免首 token 时间包含建连耗时
+                await asyncio.gather(*(client.prewarm() for client in clients.values()))
+                self.compare_clients.update(clients)
+
+            chat_session = ChatSession.from_config(get_config().get_section("chat"))
+            chat_session.add_message(role="user", content=prompt)
+            clients = {name: self.compare_clients[name] for name in providers}
+
+            # 一次对比同时占用多个请求，同样受准入控制约束
+            async with self.admission.admit():
+                async for results in compare(clients, chat_session.get_messages(), user or None):
+                    for result in results:
+                        answer = f"Error: {result.error}" if result.error else result.content
+                        panes[result.provider] = (
+                            f"**{result.provider}** · `{result.model}`\n\n"
+                            f"*{result.summary()}*\n\n{answer}"
+                        )
+                    yield list(panes.values())
+            log_content(logger, "User", prompt)
+        except Exception as e:
+            logger.error(f"Error comparing models: {e}")
+            for name in providers:
+                panes[name] = str(e) if isinstance(e, (Overloaded, BudgetExceeded)) else f"Error: {e}"
+            yield list(panes.values())
+
+    def create_ui(self) -> "gr.Blocks":
         """Create the Gradio UI interface.
 
         Returns:
             The Gradio interface
         """
+        import gradio as gr
+
         with gr.Blocks(title="OpenAI API Chat Demo", theme=gr.themes.Soft()) as interface:
             gr.Markdown(
                 """
@@ -227,6 +450,8 @@ class ChatUI:
                             max_lines=5,
                         )
                         submit_btn = gr.Button("Send", variant="primary")
+                    # 会话 ID 保存在浏览器端，随每个请求发送，使任意进程都能处理该会话
+                    session_id = gr.Textbox(visible=False)
 
                 with gr.Column(scale=1):
                     with gr.Accordion("Parameters", open=False):
@@ -249,39 +474,189 @@ class ChatUI:
                     with gr.Row():
                         clear_btn = gr.Button("Clear History", variant="secondary")
                         retry_btn = gr.Button("Retry Last Message", variant="secondary")
+                    with gr.Accordion("Status", open=False):
+                        metrics = gr.JSON(label="Metrics")
+                        refresh_btn = gr.Button("Refresh", variant="secondary")
+                        # 管理操作：对当前进程采样分析，结果写入 [profiling] output_dir
+                        if get_config().get("profiling", "allow_ui", False):
+                            profile_seconds = gr.Number(value=30, label="Profile Seconds", precision=0)
+                            profile_btn = gr.Button("Start Profiling", variant="secondary")
+                            profile_btn.click(self.start_profiling, [profile_seconds, session_id], [metrics])
+
+            # 同一提示词并行发送给多个服务商，对比回答和延迟
+            providers = list(get_config().get_section("api"))
+            with gr.Accordion("Compare Models", open=False):
+                with gr.Row():
+                    compare_txt = gr.Textbox(
+                        show_label=False,
+                        placeholder="Prompt sent to every selected provider...",
+                        container=False,
+                        lines=2,
+                        scale=4,
+                    )
+                    compare_btn = gr.Button("Compare", variant="primary", scale=1)
+                compare_providers = gr.CheckboxGroup(
+                    providers,
+                    value=get_config().get("compare", "providers") or providers,
+                    label="Providers",
+                )
+                with gr.Row():
+                    compare_panes = [gr.Markdown() for _ in providers]
+
+            # 以登录用户名（未启用认证时为客户端地址）区分用户，用于用量统计和预算
+            async def send(
+                message: str,
+                history: List[Tuple[str, str]],
+                temperature: float,
+                max_tokens: int,
+                session_id: str,
+                request: gr.Request
+            ) -> Tuple[List[Tuple[str, str]], str, str]:
+                return await self.send_message(
+                    message, history, temperature, max_tokens, session_id, _user_of(request)
+                )
+
+            async def compare_as_user(
+                prompt: str,
+                providers: List[str],
+                request: gr.Request
+            ) -> AsyncIterator[List[str]]:
+                async for panes in self.compare_models(prompt, providers, _user_of(request)):
+                    yield panes
 
             # Event handlers
             submit_btn.click(
-                self.send_message,
-                [txt, chatbot, temperature, max_tokens],
-                [chatbot, txt],
+                send,
+                [txt, chatbot, temperature, max_tokens, session_id],
+                [chatbot, txt, session_id],
             )
 
-            clear_btn.click(self.clear_history, None, [chatbot])
+            clear_btn.click(self.clear_history, [session_id], [chatbot])
+
+            refresh_btn.click(self.get_metrics, [session_id], [metrics])
+
+            compare_btn.click(compare_as_user, [compare_txt, compare_providers], compare_panes)
+
+            # 页面加载时初始化会话，提前建立到 API 的连接
+            interface.load(self.initialize_chat, None, None)
 
             # Enter key submission (Shift+Enter for new line)
             txt.submit(
-                self.send_message,
-                [txt, chatbot, temperature, max_tokens],
-                [chatbot, txt],
+                send,
+                [txt, chatbot, temperature, max_tokens, session_id],
+                [chatbot, txt, session_id],
             )
 
         return interface
 
-def main() -> None:
-    """Main entry point for the UI application."""
+def serve(host: str, port: int, worker: Optional[int] = None, profile: Optional[float] = None) -> None:
+    """Run one UI worker until the server stops.
+
+    Args:
+        host: Address to bind
+        port: Port to bind
+        worker: Worker index in multi-worker mode, ``None`` for a single worker
+        profile: Seconds to profile from startup, ``None`` to follow ``TJ_PROFILE``
+    """
+    config = get_config()
+    logging_config = dict(config.get_section("logging"))
+    if worker is not None and logging_config.get("file"):
+        # 多进程写同一个滚动日志文件并不安全，每个进程使用单独的日志文件
+        log_file = Path(logging_config["file"])
+        logging_config["file"] = str(log_file.with_name(f"{log_file.stem}.{worker}{log_file.suffix}"))
+    setup_logger_from_config("tj.scripts", logging_config)
+    profiler.configure(config.get_section("profiling"))
+    if profile:
+        profiler.start(profile)
+    else:
+        start_from_env()
+
+    admission = AdmissionController.from_config(config.get_section("ui"))
+    store = create_session_store(config.get_section("session_store"))
+    chat_ui = ChatUI(admission, store)
+    interface = chat_ui.create_ui()
+    # 不限制 Gradio 的并发：每个请求都立即进入处理函数，由准入控制负责排队和拒绝，
+    # 否则超出的请求会在 Gradio 队列中无限等待，永远不会被拒绝（max_queue 热加载后同样生效）
+    interface.queue(default_concurrency_limit=None)
+    logger.info(f"Starting UI worker on {host}:{port}")
+    interface.launch(
+        server_name=host,
+        server_port=port,
+        share=False,
+        favicon_path="🤖",  # 使用 emoji 作为网站图标
+    )
+    # 服务停止后持久化语义缓存和尚未写入的用量
+    if chat_ui.client is not None and chat_ui.client.semantic_cache is not None:
+        chat_ui.client.semantic_cache.save()
+    if chat_ui.usage is not None:
+        chat_ui.usage.flush()
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line arguments.
+
+    Args:
+        argv: Argument list, defaults to ``sys.argv[1:]``
+
+    Returns:
+        Parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="OpenAI API chat web UI")
+    parser.add_argument("--host", help="Address to bind (default: [ui] host)")
+    parser.add_argument("--port", type=int, help="Port of the first worker (default: [ui] port)")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: [ui] workers)")
+    parser.add_argument(
+        "--profile",
+        type=float,
+        metavar="SECONDS",
+        help="Profile each worker for SECONDS from startup (also: TJ_PROFILE=SECONDS)"
+    )
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Main entry point for the UI application.
+
+    With more than one worker, worker ``i`` listens on ``port + i`` and all
+    workers share the configured session store, so a conversation can move
+    between workers. The load balancer still needs session affinity: Gradio's
+    queue protocol (``/queue/join`` followed by the ``/queue/data`` event
+    stream) must reach the same worker.
+
+    Args:
+        argv: Argument list, defaults to ``sys.argv[1:]``
+    """
     try:
-        chat_ui = ChatUI()
-        interface = chat_ui.create_ui()
-        interface.launch(
-            server_name="127.0.0.1",
-            server_port=7860,
-            share=False,
-            favicon_path="🤖",  # 使用 emoji 作为网站图标
-        )
+        args = parse_args(argv)
+        config = get_config()
+        ui_config = config.get_section("ui")
+        host = args.host or ui_config.get("host", "127.0.0.1")
+        port = args.port or ui_config.get("port", 7860)
+        workers = args.workers or ui_config.get("workers", 1)
+
+        if workers <= 1:
+            serve(host, port, profile=args.profile)
+            return
+
+        # 进程内存储无法在进程间共享
+        if config.get("session_store", "backend", "memory") in ("memory", "local"):
+            raise ConfigError(
+                "Multi-worker mode requires a shared session store, "
+                "set [session_store] backend to \"sqlite\" or \"redis\""
+            )
+        processes = [
+            multiprocessing.Process(target=serve, args=(host, port + i, i, args.profile), name=f"ui-worker-{i}")
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
     except Exception as e:
         logger.error(f"Failed to start UI: {e}")
         raise
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,144 @@
+"""
+Admission control and load shedding.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict
+
+from .metrics import LatencyStats
+
+class Overloaded(Exception):
+    """Request rejected because the estimated wait is too long"""
+
+    def __init__(self, retry_after: float) -> None:
+        """
+        Initialize the error.
+
+        Args:
+            retry_after: Suggested seconds before retrying
+        """
+        self.retry_after = retry_after
+        super().__init__(
+            f"The service is busy right now, please retry in {retry_after:.0f} s."
+        )
+
+class AdmissionController:
+    """Bound concurrency and queue depth, rejecting early instead of queuing forever"""
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        max_queue: int = 32,
+        max_wait: float = 10.0,
+        initial_service_time: float = 2.0,
+        smoothing: float = 0.2
+    ) -> None:
+        """
+        Initialize the controller.
+
+        Args:
+            max_concurrency: Maximum requests processed at once
+            max_queue: Maximum requests waiting for a slot
+            max_wait: Reject requests whose estimated wait exceeds this many seconds
+            initial_service_time: Service time estimate (seconds) before any request completes
+            smoothing: Weight of the latest service time in the moving average
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.smoothing = smoothing
+        self.service_time = initial_service_time
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_stats = LatencyStats()
+        self.service_stats = LatencyStats()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._active = 0
+        self._queued = 0
+
+    @classmethod
+    def from_config(cls, settings: Dict[str, Any]) -> "AdmissionController":
+        """
+        Create a controller from a ``[ui]`` configuration section.
+
+        Args:
+            settings: UI configuration section
+
+        Returns:
+            Admission controller instance
+        """
+        return cls(
+            max_concurrency=settings.get("max_concurrency", 4),
+            max_queue=settings.get("max_queue", 32),
+            max_wait=settings.get("max_wait", 10.0)
+        )
+
+    def estimated_wait(self) -> float:
+        """
+        Estimate how long a new request would wait for a slot.
+
+        Returns:
+            Estimated wait in seconds
+        """
+        if self._active < self.max_concurrency and not self._queued:
+            return 0.0
+        return (self._queued + 1) * self.service_time / self.max_concurrency
+
+    @asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        """
+        Hold a processing slot for the duration of the context.
+
+        Yields:
+            None once the request has been admitted
+
+        Raises:
+            Overloaded: If the queue is full or the estimated wait is too long
+        """
+        estimate = self.estimated_wait()
+        if self._queued >= self.max_queue or estimate > self.max_wait:
+            self.rejected += 1
+            raise Overloaded(retry_after=max(1.0, math.ceil(estimate)))
+
+        enqueued = time.monotonic()
+        self._queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._queued -= 1
+        started = time.monotonic()
+        self.wait_stats.observe(started - enqueued)
+        self.admitted += 1
+        self._active += 1
+        try:
+            yield
+        finally:
+            self._active -= 1
+            self._semaphore.release()
+            elapsed = time.monotonic() - started
+            self.service_stats.observe(elapsed)
+            self.service_time += self.smoothing * (elapsed - self.service_time)
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Get queue-depth and wait-time metrics.
+
+        Returns:
+            Dictionary of admission counters and latency statistics (seconds)
+        """
+        return {
+            "active": self._active,
+            "queued": self._queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "estimated_wait": self.estimated_wait(),
+            "wait": self.wait_stats.snapshot(),
+            "service": self.service_stats.snapshot(),
+        }
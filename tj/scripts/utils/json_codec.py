@@ -0,0 +1,59 @@
+"""
+JSON encoding and decoding with an optional fast backend.
+
+Uses ``orjson`` when it is installed and falls back to the standard
+library ``json`` module otherwise. Both backends produce compact UTF-8
+encoded bytes, so callers can hand the result straight to the network or
+to a file opened in binary mode.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import json
+from typing import Any, Callable, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+# Name of the active backend, "orjson" or "json"
+BACKEND = "orjson" if orjson is not None else "json"
+
+JSONInput = Union[bytes, bytearray, memoryview, str]
+
+def dumps(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """
+    Encode an object as compact UTF-8 JSON.
+
+    Args:
+        obj: Object to encode
+        default: Optional callable converting unsupported objects
+
+    Returns:
+        Encoded JSON bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=default)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default).encode("utf-8")
+
+def loads(data: JSONInput) -> Any:
+    """
+    Decode JSON from bytes or text.
+
+    Args:
+        data: Encoded JSON
+
+    Returns:
+        Decoded object
+
+    Raises:
+        ValueError: If the data is not valid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
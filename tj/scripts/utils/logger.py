@@ -6,10 +6,261 @@ Email: tangj1984@gmail.com
 Date: 2024-03-21
 """
 
+import atexit
+import copy
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
-from typing import Optional, Union
+from typing import Any, Dict, List, Optional
+
+from . import json_codec
+
+# Attributes every LogRecord carries; anything else was passed via ``extra``
+_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+# Background listeners keyed by logger name, stopped on re-setup and at exit
+_listeners: Dict[str, "_QueueListener"] = {}
+
+# Renders tracebacks of queued records before they leave the caller thread
+_exception_formatter = logging.Formatter()
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as single-line JSON objects"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """
+        Format a log record as JSON.
+
+        Args:
+            record: Log record to format
+
+        Returns:
+            JSON encoded log line
+        """
+        # Message-body records carry the body as a field of its own
+        content = getattr(record, "content", None)
+        data: Dict[str, Any] = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "name": record.name,
+            "message": content if content is not None else record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and key != "content" and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc_info"] = record.exc_text
+        return json_codec.dumps(data, default=str).decode("utf-8")
+
+class ContentFilter(logging.Filter):
+    """Sample and truncate message-body log records"""
+
+    def __init__(self, max_length: int = 0, sample_rate: float = 1.0) -> None:
+        """
+        Initialize the content filter.
+
+        Args:
+            max_length: Maximum logged content length, 0 for unlimited
+            sample_rate: Fraction of content records to keep (0.0 to 1.0)
+        """
+        super().__init__()
+        self.max_length = max_length
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """
+        Drop or truncate records logged through ``log_content``.
+
+        Args:
+            record: Log record to filter
+
+        Returns:
+            Whether the record should be emitted
+        """
+        content = getattr(record, "content", None)
+        if content is None:
+            return True
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        if self.max_length and len(content) > self.max_length:
+            content = f"{content[:self.max_length]}... [{len(content)} chars]"
+            record.content = content
+            record.args = (getattr(record, "role", ""), content)
+        return True
+
+class _DroppingQueueHandler(QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue: "queue.Queue[Optional[logging.LogRecord]]") -> None:
+        """
+        Initialize the queue handler.
+
+        Args:
+            log_queue: Queue shared with the background listener
+        """
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.unreported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Make a record safe to hand to the background thread.
+
+        Unlike ``QueueHandler.prepare`` the record is not formatted here, so
+        formatters on the listener side still see the traceback as
+        ``exc_text`` instead of folded into the message.
+
+        Args:
+            record: Log record to prepare
+
+        Returns:
+            Copy of the record with its message merged and traceback rendered
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def drop_report(self, name: str) -> Optional[logging.LogRecord]:
+        """
+        Build a warning about records dropped since the last report.
+
+        Args:
+            name: Logger name for the warning
+
+        Returns:
+            Warning record, or None if nothing was dropped
+        """
+        if not self.unreported:
+            return None
+        return logging.makeLogRecord({
+            "name": name,
+            "levelno": logging.WARNING,
+            "levelname": logging.getLevelName(logging.WARNING),
+            "msg": f"Dropped {self.unreported} log records because the queue was full "
+                   f"({self.dropped} in total)",
+        })
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """
+        Enqueue a record without blocking the caller.
+
+        Once the queue has room again, a warning reporting the records
+        dropped in the meantime is queued after the record.
+
+        Args:
+            record: Prepared log record
+        """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.unreported += 1
+            return
+        report = self.drop_report(record.name)
+        if report is not None:
+            try:
+                self.queue.put_nowait(report)
+                self.unreported = 0
+            except queue.Full:
+                pass
+
+class _QueueListener(QueueListener):
+    """Queue listener that can be stopped while its queue is full"""
+
+    # Same stop marker as ``QueueListener``, declared for type checkers
+    _sentinel = None
+
+    # Longest wait for the listener thread to make room for the stop sentinel
+    stop_timeout = 5.0
+
+    def __init__(
+        self,
+        log_queue: "queue.Queue[Optional[logging.LogRecord]]",
+        *handlers: logging.Handler,
+        respect_handler_level: bool = False
+    ) -> None:
+        """
+        Initialize the listener.
+
+        Args:
+            log_queue: Bounded queue filled by ``_DroppingQueueHandler``
+            *handlers: Handlers writing the records
+            respect_handler_level: Skip records below a handler's level
+        """
+        super().__init__(log_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.log_queue = log_queue
+
+    def enqueue_sentinel(self) -> None:
+        """Queue the stop sentinel, making room in a full queue if needed."""
+        # The listener thread keeps consuming, so a full queue frees up shortly
+        try:
+            self.log_queue.put(self._sentinel, timeout=self.stop_timeout)
+            return
+        except queue.Full:
+            pass
+        # A handler is stuck: discard the oldest pending records instead
+        while True:
+            try:
+                self.log_queue.put_nowait(self._sentinel)
+                return
+            except queue.Full:
+                try:
+                    self.log_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+def log_content(
+    logger: logging.Logger,
+    role: str,
+    content: str,
+    level: int = logging.INFO
+) -> None:
+    """
+    Log a chat message body, subject to the logger's content filter.
+
+    Args:
+        logger: Logger instance
+        role: Message role label (e.g. "User", "Assistant")
+        content: Message content
+        level: Logging level
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s: %s", role, content, extra={"role": role, "content": content})
+
+def shutdown_logger(name: str) -> None:
+    """
+    Stop the background listener of a logger and flush pending records.
+
+    Args:
+        name: Logger name
+    """
+    listener = _listeners.pop(name, None)
+    if listener is not None:
+        listener.stop()
+        # Records dropped after the last report would otherwise go unnoticed
+        for queue_handler in logging.getLogger(name).handlers:
+            if isinstance(queue_handler, _DroppingQueueHandler):
+                report = queue_handler.drop_report(name)
+                if report is not None:
+                    listener.handle(report)
+                    queue_handler.unreported = 0
+        for handler in listener.handlers:
+            handler.close()
+
+def _shutdown_all() -> None:
+    """Stop all background listeners."""
+    for name in list(_listeners):
+        shutdown_logger(name)
+
+atexit.register(_shutdown_all)
 
 def setup_logger(
     name: str,
@@ -17,11 +268,20 @@ def setup_logger(
     format: str = "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     file: Optional[str] = None,
     max_size: int = 10 * 1024 * 1024,  # 10MB
-    backup_count: int = 5
+    backup_count: int = 5,
+    async_mode: bool = False,
+    queue_size: int = 10000,
+    json_format: bool = False,
+    max_content_length: int = 0,
+    content_sample_rate: float = 1.0
 ) -> logging.Logger:
     """
     Set up a logger with console and optional file handlers.
-    
+
+    In async mode the caller only enqueues records; formatting, console
+    output and file writes/rotation happen on a background thread. Records
+    are dropped rather than blocking when the queue is full.
+
     Args:
         name: Logger name
         level: Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
@@ -29,24 +289,37 @@ def setup_logger(
         file: Optional log file path
         max_size: Maximum size of log file in bytes
         backup_count: Number of backup log files to keep
-        
+        async_mode: Hand records off to a background writer thread
+        queue_size: Maximum number of pending records in async mode
+        json_format: Emit structured JSON lines instead of ``format``
+        max_content_length: Truncate logged message bodies to this length, 0 for unlimited
+        content_sample_rate: Fraction of message-body records to keep (0.0 to 1.0)
+
     Returns:
         Configured logger instance
     """
     logger = logging.getLogger(name)
     logger.setLevel(getattr(logging, level.upper()))
-    
+
     # Remove existing handlers to avoid duplicates
+    shutdown_logger(name)
     logger.handlers.clear()
-    
+    logger.filters.clear()
+
+    # Sample and truncate message bodies before any formatting happens
+    if max_content_length or content_sample_rate < 1.0:
+        logger.addFilter(ContentFilter(max_content_length, content_sample_rate))
+
     # Create formatter
-    formatter = logging.Formatter(format)
-    
+    formatter: logging.Formatter = JsonFormatter() if json_format else logging.Formatter(format)
+
+    handlers: List[logging.Handler] = []
+
     # Add console handler
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
-    
+    handlers.append(console_handler)
+
     # Add file handler if file path is specified
     if file:
         log_file = Path(file)
@@ -58,6 +331,41 @@ def setup_logger(
             encoding='utf-8'
         )
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    if async_mode:
+        log_queue: "queue.Queue[Optional[logging.LogRecord]]" = queue.Queue(maxsize=queue_size)
+        logger.addHandler(_DroppingQueueHandler(log_queue))
+        listener = _QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        _listeners[name] = listener
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+
+    return logger
+
+def setup_logger_from_config(name: str, settings: Dict[str, Any]) -> logging.Logger:
+    """
+    Set up a logger from a ``[logging]`` configuration section.
     
-    return logger 
\ No newline at end of file
+    Args:
+        name: Logger name
+        settings: Logging configuration section
+        
+    Returns:
+        Configured logger instance
+    """
+    return setup_logger(
+        name,
+        level=settings.get("level", "INFO"),
+        format=settings.get("format", "%(asctime)s - %(name)s - %(levelname)s - %(message)s"),
+        file=settings.get("file", "app.log"),
+        max_size=settings.get("max_size", 10 * 1024 * 1024),  # 10MB
+        backup_count=settings.get("backup_count", 5),
+        async_mode=settings.get("async", False),
+        queue_size=settings.get("queue_size", 10000),
+        json_format=settings.get("json", False),
+        max_content_length=settings.get("max_content_length", 0),
+        content_sample_rate=settings.get("content_sample_rate", 1.0)
+    )
\ No newline at end of file
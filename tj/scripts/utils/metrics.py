@@ -0,0 +1,68 @@
+"""
+Lightweight in-process metrics.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+from collections import deque
+from typing import Deque, Dict
+
+class LatencyStats:
+    """Running latency statistics with percentiles over a recent window"""
+
+    def __init__(self, window: int = 1024) -> None:
+        """
+        Initialize the statistics.
+
+        Args:
+            window: Number of most recent observations used for percentiles
+        """
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float) -> None:
+        """
+        Record one observation.
+
+        Args:
+            seconds: Observed duration in seconds
+        """
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self._recent.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        """
+        Get a percentile of the recent observations.
+
+        Args:
+            q: Percentile (0 to 100)
+
+        Returns:
+            Duration in seconds, 0.0 without observations
+        """
+        if not self._recent:
+            return 0.0
+        ordered = sorted(self._recent)
+        index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def snapshot(self) -> Dict[str, float]:
+        """
+        Get a summary of the statistics.
+
+        Returns:
+            Dictionary with count, mean, p50, p95 and max (seconds)
+        """
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": self.max,
+        }
@@ -0,0 +1,379 @@
+"""
+On-demand profiling of the request hot path.
+
+Functions decorated with ``profiled`` are hooks: while a profiling window is
+open, their calls are timed, and a background thread samples the call stacks
+of the threads while they run a hook. Samples of an event loop waiting in its
+selector are counted as idle rather than profiled, so the tables show CPU time.
+Allocations are tracked with ``tracemalloc``.
+When the window closes, the sampled stacks are written in collapsed format
+(one ``frame;frame;frame count`` line per stack, readable by flamegraph.pl and
+speedscope) next to a text summary of the top functions, hooks and
+allocation sites.
+
+A window is opened with ``profiler.start(seconds)``, from the ``--profile``
+command line flag, the ``TJ_PROFILE`` environment variable or the web UI.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import contextlib
+import functools
+import inspect
+import logging
+import os
+import selectors
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+from .metrics import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# Environment variable opening a profiling window of that many seconds at startup
+PROFILE_ENV = "TJ_PROFILE"
+
+def _frame_label(frame: Any) -> str:
+    """
+    Describe a stack frame.
+
+    Args:
+        frame: Stack frame
+
+    Returns:
+        ``qualified name (file:line)`` of the frame's function
+    """
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class Profiler:
+    """Sampling CPU profiler and allocation tracker with a bounded window"""
+
+    def __init__(
+        self,
+        output_dir: str = "profiles",
+        interval: float = 0.005,
+        top_n: int = 20,
+        allocations: bool = True,
+        trace_frames: int = 10,
+        max_duration: float = 300.0
+    ) -> None:
+        """
+        Initialize the profiler.
+
+        Args:
+            output_dir: Directory the profiles are written to
+            interval: Seconds between stack samples
+            top_n: Number of entries in each summary table
+            allocations: Whether to track allocations with tracemalloc
+            trace_frames: Frames stored per traced allocation
+            max_duration: Upper bound of a profiling window in seconds
+        """
+        self.output_dir = output_dir
+        self.interval = interval
+        self.top_n = top_n
+        self.allocations = allocations
+        self.trace_frames = trace_frames
+        self.max_duration = max_duration
+        self.active = False
+        self.last_report: Optional[Path] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # Hooks running per thread; only threads running a hook are sampled
+        self._depth: Dict[int, int] = {}
+        self._idle = 0
+        self._stacks: Counter = Counter()
+        self._hooks: Dict[str, LatencyStats] = {}
+        self._started = 0.0
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._owns_tracemalloc = False
+
+    def configure(self, settings: Dict[str, Any]) -> None:
+        """
+        Apply a ``[profiling]`` configuration section.
+
+        Args:
+            settings: Profiling configuration section
+        """
+        self.output_dir = settings.get("output_dir", self.output_dir)
+        self.interval = settings.get("interval", self.interval)
+        self.top_n = settings.get("top_n", self.top_n)
+        self.allocations = settings.get("allocations", self.allocations)
+        self.trace_frames = settings.get("trace_frames", self.trace_frames)
+        self.max_duration = settings.get("max_duration", self.max_duration)
+
+    def start(self, duration: float) -> bool:
+        """
+        Open a profiling window; the report is written when it closes.
+
+        Args:
+            duration: Window length in seconds, capped at ``max_duration``
+
+        Returns:
+            False if a window is already open
+        """
+        with self._lock:
+            if self.active:
+                return False
+            self.active = True
+        duration = min(duration, self.max_duration)
+        self._depth.clear()
+        self._idle = 0
+        self._stacks.clear()
+        self._hooks = {}
+        self._stop.clear()
+        if self.allocations:
+            self._owns_tracemalloc = not tracemalloc.is_tracing()
+            if self._owns_tracemalloc:
+                tracemalloc.start(self.trace_frames)
+            self._snapshot = tracemalloc.take_snapshot()
+        self._started = time.monotonic()
+        threading.Thread(
+            target=self._sample,
+            args=(self._started + duration,),
+            name="profiler",
+            daemon=True
+        ).start()
+        logger.info(f"Profiling for {duration:.0f}s")
+        return True
+
+    def stop(self) -> None:
+        """Close the open profiling window early."""
+        self._stop.set()
+
+    def enter(self) -> None:
+        """Mark the current thread as running a hook."""
+        ident = threading.get_ident()
+        self._depth[ident] = self._depth.get(ident, 0) + 1
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        Record one hook call made during the window, started with ``enter``.
+
+        Args:
+            name: Hook name
+            seconds: Call duration in seconds
+        """
+        ident = threading.get_ident()
+        depth = self._depth.get(ident, 0) - 1
+        if depth > 0:
+            self._depth[ident] = depth
+        else:
+            self._depth.pop(ident, None)
+        stats = self._hooks.get(name)
+        if stats is None:
+            # Hooks started in the window may finish while the report is written
+            with self._lock:
+                stats = self._hooks.setdefault(name, LatencyStats())
+        stats.observe(seconds)
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Get the profiler state.
+
+        Returns:
+            Dictionary with whether a window is open and the last report path
+        """
+        return {
+            "active": self.active,
+            "last_report": str(self.last_report) if self.last_report else None,
+        }
+
+    def _sample(self, deadline: float) -> None:
+        """
+        Sample the stacks of the hooked threads until the window closes.
+
+        Args:
+            deadline: Monotonic time at which the window closes
+        """
+        try:
+            while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+                frames = sys._current_frames()
+                for ident in list(self._depth):
+                    frame = frames.get(ident)
+                    if frame is not None and frame.f_code.co_filename == selectors.__file__:
+                        # An event loop waiting for I/O while its hooks are suspended
+                        self._idle += 1
+                        continue
+                    stack: List[str] = []
+                    while frame is not None:
+                        stack.append(_frame_label(frame))
+                        frame = frame.f_back
+                    if stack:
+                        self._stacks[tuple(reversed(stack))] += 1
+            self._write()
+        except Exception as e:
+            logger.error(f"Failed to write profile: {e}", exc_info=True)
+        finally:
+            if self._owns_tracemalloc:
+                tracemalloc.stop()
+            self._snapshot = None
+            self.active = False
+
+    def _allocation_lines(self) -> List[str]:
+        """
+        Summarize the allocations made during the window.
+
+        Returns:
+            Report lines of the allocation sites that grew the most
+        """
+        if self._snapshot is None or not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        lines = [f"Top {self.top_n} allocation sites (growth during the window):"]
+        for stat in snapshot.compare_to(self._snapshot, "lineno")[:self.top_n]:
+            frame = stat.traceback[0]
+            lines.append(
+                f"  {stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8d} blocks  "
+                f"{frame.filename}:{frame.lineno}"
+            )
+        return lines
+
+    def _write(self) -> None:
+        """Write the collapsed stacks and the summary of the closed window."""
+        elapsed = time.monotonic() - self._started
+        output_dir = Path(self.output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        stem = f"profile-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}"
+
+        with open(output_dir / f"{stem}.collapsed", "w", encoding="utf-8") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        total = sum(self._stacks.values())
+        own: Counter = Counter()
+        inclusive: Counter = Counter()
+        for stack, count in self._stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                inclusive[label] += count
+
+        def table(title: str, counts: Counter) -> List[str]:
+            rows = [f"Top {self.top_n} functions by {title}:"]
+            for label, count in counts.most_common(self.top_n):
+                rows.append(f"  {count / total:7.1%} {count:8d}  {label}")
+            return rows
+
+        lines = [
+            f"Profile of pid {os.getpid()}: {elapsed:.1f}s, {total} samples every {self.interval * 1000:.0f}ms "
+            f"({self._idle} idle samples in the event loop selector skipped)",
+            ""
+        ]
+        with self._lock:
+            hooks = dict(self._hooks)
+        lines.append("Hooks (seconds):")
+        for name, stats in sorted(hooks.items()):
+            snap = stats.snapshot()
+            lines.append(
+                f"  {name:<40} calls {snap['count']:6d}  mean {snap['mean']:.4f}  "
+                f"p95 {snap['p95']:.4f}  max {snap['max']:.4f}"
+            )
+        if total:
+            lines += [""] + table("own samples", own) + [""] + table("inclusive samples", inclusive)
+        allocation_lines = self._allocation_lines()
+        if allocation_lines:
+            lines += [""] + allocation_lines
+
+        report = output_dir / f"{stem}.txt"
+        report.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        self.last_report = report
+        logger.info(f"Profile written to {report} and {stem}.collapsed")
+
+# Default profiler used by the hooks
+profiler = Profiler()
+
+def start_from_env(settings: Optional[Dict[str, Any]] = None) -> bool:
+    """
+    Open a profiling window if ``TJ_PROFILE`` is set to a number of seconds.
+
+    Args:
+        settings: Optional ``[profiling]`` configuration section
+
+    Returns:
+        True if a window was opened
+    """
+    value = os.environ.get(PROFILE_ENV)
+    if not value:
+        return False
+    try:
+        duration = float(value)
+    except ValueError:
+        logger.warning(f"Ignoring {PROFILE_ENV}={value!r}, expected a number of seconds")
+        return False
+    if settings:
+        profiler.configure(settings)
+    return profiler.start(duration)
+
+def profiled(name: Optional[str] = None) -> Callable[[F], F]:
+    """
+    Mark a sync function, coroutine function or async generator as a hook.
+
+    Outside a profiling window the hook costs one attribute check per call.
+
+    Args:
+        name: Hook name, defaults to the function's qualified name
+
+    Returns:
+        Decorator
+    """
+    def decorator(func: F) -> F:
+        hook = name or func.__qualname__
+
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def async_gen_wrapper(*args: Any, **kwargs: Any) -> Any:
+                # aclosing runs the generator's cleanup as soon as the consumer stops early
+                if not profiler.active:
+                    async with contextlib.aclosing(func(*args, **kwargs)) as items:
+                        async for item in items:
+                            yield item
+                    return
+                profiler.enter()
+                started = time.perf_counter()
+                try:
+                    async with contextlib.aclosing(func(*args, **kwargs)) as items:
+                        async for item in items:
+                            yield item
+                finally:
+                    profiler.observe(hook, time.perf_counter() - started)
+            return async_gen_wrapper  # type: ignore[return-value]
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                if not profiler.active:
+                    return await func(*args, **kwargs)
+                profiler.enter()
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    profiler.observe(hook, time.perf_counter() - started)
+            return async_wrapper  # type: ignore[return-value]
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not profiler.active:
+                return func(*args, **kwargs)
+            profiler.enter()
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.observe(hook, time.perf_counter() - started)
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
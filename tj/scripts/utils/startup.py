@@ -0,0 +1,123 @@
+"""
+Startup-time diagnostics.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import subprocess
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+# Import-time budget in milliseconds for each entry point module
+STARTUP_BUDGETS: Dict[str, float] = {
+    "tj.scripts.main": 100.0,
+    "tj.scripts.ui": 150.0,
+}
+
+@dataclass
+class ImportProfile:
+    """Import-time profile of one entry point module"""
+    module: str
+    budget_ms: float
+    total_ms: float = 0.0
+    # (module name, self time ms, cumulative time ms) per imported module
+    imports: List[Tuple[str, float, float]] = field(default_factory=list)
+
+    @property
+    def over_budget(self) -> bool:
+        """Whether the total import time exceeds the budget."""
+        return self.total_ms > self.budget_ms
+
+    def top(self, n: int = 10) -> List[Tuple[str, float, float]]:
+        """
+        Get the imports with the highest self time.
+
+        Args:
+            n: Number of entries to return
+
+        Returns:
+            List of (module name, self time ms, cumulative time ms) tuples
+        """
+        return sorted(self.imports, key=lambda item: item[1], reverse=True)[:n]
+
+def profile_imports(module: str, budget_ms: Optional[float] = None) -> ImportProfile:
+    """
+    Measure the import time of a module in a fresh interpreter.
+
+    Uses ``python -X importtime`` so that nothing already imported by the
+    current process skews the measurement.
+
+    Args:
+        module: Dotted module name to import
+        budget_ms: Budget in milliseconds, defaults to ``STARTUP_BUDGETS``
+
+    Returns:
+        Import-time profile
+
+    Raises:
+        RuntimeError: If the module cannot be imported
+    """
+    if budget_ms is None:
+        budget_ms = STARTUP_BUDGETS.get(module, 100.0)
+
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print((time.perf_counter() - start) * 1000)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to import {module}: {result.stderr.strip().splitlines()[-1:]}")
+
+    profile = ImportProfile(module=module, budget_ms=budget_ms, total_ms=float(result.stdout))
+    pending: List[Tuple[str, float, float]] = []
+    for line in result.stderr.splitlines():
+        # Format: "import time: <self us> | <cumulative us> | <indented name>"
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(parts[0]), int(parts[1])
+        except ValueError:
+            continue  # Header line
+        name = parts[2].rstrip()
+        pending.append((name.strip(), self_us / 1000, cumulative_us / 1000))
+        # A top-level line closes a block; keep only the block of the entry point,
+        # which excludes interpreter startup imports such as site and encodings
+        if not name.startswith("  "):
+            top_level = name.strip()
+            if module == top_level or module.startswith(f"{top_level}."):
+                profile.imports.extend(pending)
+            pending = []
+    return profile
+
+def format_report(profiles: List[ImportProfile], top: int = 10) -> str:
+    """
+    Format import-time profiles as a human readable report.
+
+    Args:
+        profiles: Import-time profiles
+        top: Number of slowest imports to list per profile
+
+    Returns:
+        Report text
+    """
+    lines = ["=== Startup Profile ==="]
+    for profile in profiles:
+        status = "OVER BUDGET" if profile.over_budget else "ok"
+        lines.append(
+            f"\n{profile.module}: {profile.total_ms:.1f} ms "
+            f"(budget {profile.budget_ms:.0f} ms, {status})"
+        )
+        lines.append(f"  {'self ms':>9} {'cumul ms':>9}  module")
+        for name, self_ms, cumulative_ms in profile.top(top):
+            lines.append(f"  {self_ms:9.1f} {cumulative_ms:9.1f}  {name}")
+    return "\n".join(lines)
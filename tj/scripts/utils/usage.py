@@ -0,0 +1,413 @@
+"""
+Token usage accounting and per-user budgets.
+
+Every response's ``usage`` is added to in-memory totals per provider, user
+and session, and the increments are appended to a JSONL file every
+``flush_interval`` seconds (one line per flush, tagged with the process id,
+so several workers can share the file).
+
+Each user's tokens are also counted in two sliding windows:
+
+- a one-minute throughput window: above ``demote_ratio`` of
+  ``user_tokens_per_minute`` the user's requests are scheduled as
+  ``background``, above the limit as ``bulk``, so a heavy user yields to
+  everyone else before the shared provider quota runs out;
+- a ``budget_window`` token budget: above ``user_token_budget`` requests are
+  rejected with ``BudgetExceeded`` until the window has room again.
+
+Requests are attributed to the session and user set with ``attribute()``.
+Totals and windows are kept per process.
+
+Author: tj-scripts
+Email: tangj1984@gmail.com
+Date: 2024-03-21
+"""
+
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, Optional, Tuple
+
+from . import json_codec
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most latency sensitive first (see api.scheduler)
+_PRIORITIES = ("interactive", "background", "bulk")
+
+# Seconds covered by the throughput window
+_RATE_WINDOW = 60.0
+
+_session: ContextVar[Optional[str]] = ContextVar("usage_session", default=None)
+_user: ContextVar[Optional[str]] = ContextVar("usage_user", default=None)
+
+class BudgetExceeded(Exception):
+    """Request rejected because the user has used up their token budget"""
+
+    def __init__(self, user: str, retry_after: float) -> None:
+        """
+        Initialize the error.
+
+        Args:
+            user: User whose budget is used up
+            retry_after: Seconds until the budget window has room again
+        """
+        self.user = user
+        self.retry_after = retry_after
+        super().__init__(
+            f"You have used up your token budget, please retry in {retry_after / 60:.0f} min."
+        )
+
+@contextmanager
+def attribute(session: Optional[str] = None, user: Optional[str] = None) -> Iterator[None]:
+    """
+    Attribute the requests made within the context to a session and user.
+
+    Args:
+        session: Session identifier
+        user: User identifier
+
+    Yields:
+        None
+    """
+    session_token = _session.set(session)
+    user_token = _user.set(user)
+    try:
+        yield
+    finally:
+        _session.reset(session_token)
+        _user.reset(user_token)
+
+def current_user() -> Optional[str]:
+    """
+    Get the user the current requests are attributed to.
+
+    Returns:
+        User identifier, ``None`` outside ``attribute()``
+    """
+    return _user.get()
+
+@dataclass
+class UsageTotals:
+    """Token counts of a provider, user or session"""
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        """Prompt plus completion tokens."""
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, prompt: int, completion: int, cached: int) -> None:
+        """
+        Count one response.
+
+        Args:
+            prompt: Prompt tokens
+            completion: Completion tokens
+            cached: Prompt tokens served from the provider's prompt cache
+        """
+        self.requests += 1
+        self.prompt_tokens += prompt
+        self.completion_tokens += completion
+        self.cached_tokens += cached
+
+    def snapshot(self) -> Dict[str, int]:
+        """
+        Get the counts.
+
+        Returns:
+            Dictionary of the counts and the total
+        """
+        return {**asdict(self), "total_tokens": self.total_tokens}
+
+class _Window:
+    """Tokens used within a sliding time window"""
+
+    def __init__(self, span: float) -> None:
+        """
+        Initialize the window.
+
+        Args:
+            span: Window length in seconds
+        """
+        self.span = span
+        self.tokens = 0
+        self._events: Deque[Tuple[float, int]] = deque()
+
+    def add(self, now: float, tokens: int) -> None:
+        """
+        Count tokens used at ``now``.
+
+        Args:
+            now: Monotonic time
+            tokens: Tokens used
+        """
+        self._events.append((now, tokens))
+        self.tokens += tokens
+
+    def expire(self, now: float) -> int:
+        """
+        Drop the tokens that left the window.
+
+        Args:
+            now: Monotonic time
+
+        Returns:
+            Tokens still in the window
+        """
+        while self._events and self._events[0][0] <= now - self.span:
+            self.tokens -= self._events.popleft()[1]
+        return self.tokens
+
+    def retry_after(self, now: float) -> float:
+        """
+        Get the seconds until the oldest tokens leave the window.
+
+        Args:
+            now: Monotonic time
+
+        Returns:
+            Seconds
+        """
+        return self._events[0][0] + self.span - now if self._events else 0.0
+
+class UsageTracker:
+    """In-memory usage accumulator with periodic flushing and per-user budgets"""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        flush_interval: float = 60.0,
+        user_tokens_per_minute: int = 0,
+        demote_ratio: float = 0.8,
+        user_token_budget: int = 0,
+        budget_window: float = 3600.0,
+        max_tracked: int = 10000
+    ) -> None:
+        """
+        Initialize the tracker.
+
+        Args:
+            path: JSONL file the increments are appended to, ``None`` to keep them in memory only
+            flush_interval: Seconds between flushes
+            user_tokens_per_minute: Throughput above which a user's requests are demoted, 0 for no limit
+            demote_ratio: Fraction of ``user_tokens_per_minute`` above which requests run as background
+            user_token_budget: Tokens per user per ``budget_window`` before requests are rejected, 0 for no limit
+            budget_window: Budget window in seconds
+            max_tracked: Users and sessions kept in memory; the least recently active are dropped
+        """
+        self.path = Path(path) if path else None
+        self.flush_interval = flush_interval
+        self.user_tokens_per_minute = user_tokens_per_minute
+        self.demote_ratio = demote_ratio
+        self.user_token_budget = user_token_budget
+        self.budget_window = budget_window
+        self.max_tracked = max_tracked
+        self.demoted = 0
+        self.rejected = 0
+        self._totals: Dict[str, "OrderedDict[str, UsageTotals]"] = {
+            "providers": OrderedDict(), "users": OrderedDict(), "sessions": OrderedDict()
+        }
+        self._pending: Dict[str, Dict[str, UsageTotals]] = {scope: {} for scope in self._totals}
+        self._rates: Dict[str, _Window] = {}
+        self._budgets: Dict[str, _Window] = {}
+        self._last_flush = time.monotonic()
+
+    @classmethod
+    def from_config(cls, settings: Dict[str, Any]) -> "UsageTracker":
+        """
+        Create a tracker from a ``[usage]`` configuration section.
+
+        Args:
+            settings: Usage configuration section
+
+        Returns:
+            Usage tracker instance
+        """
+        tracker = cls()
+        tracker.configure(settings)
+        return tracker
+
+    def configure(self, settings: Dict[str, Any]) -> None:
+        """
+        Apply a ``[usage]`` configuration section, keeping the counts.
+
+        Args:
+            settings: Usage configuration section
+        """
+        path = settings.get("path", "usage.jsonl")
+        self.path = Path(path) if path else None
+        self.flush_interval = settings.get("flush_interval", 60.0)
+        self.user_tokens_per_minute = settings.get("user_tokens_per_minute", 0)
+        self.demote_ratio = settings.get("demote_ratio", 0.8)
+        self.user_token_budget = settings.get("user_token_budget", 0)
+        self.budget_window = settings.get("budget_window", 3600.0)
+        # Windows keep their timestamps, so a new length applies to the tokens already counted
+        for window in self._budgets.values():
+            window.span = self.budget_window
+
+    def _count(self, scope: str, key: str, prompt: int, completion: int, cached: int) -> None:
+        """
+        Add one response to the totals and pending increments of ``key``.
+
+        Args:
+            scope: ``providers``, ``users`` or ``sessions``
+            key: Provider, user or session
+            prompt: Prompt tokens
+            completion: Completion tokens
+            cached: Cached prompt tokens
+        """
+        totals = self._totals[scope]
+        entry = totals.get(key)
+        if entry is None:
+            entry = totals[key] = UsageTotals()
+            if len(totals) > self.max_tracked:
+                totals.popitem(last=False)
+        else:
+            totals.move_to_end(key)
+        entry.add(prompt, completion, cached)
+        if self.path is None:
+            return
+        pending = self._pending[scope].get(key)
+        if pending is None:
+            pending = self._pending[scope][key] = UsageTotals()
+        pending.add(prompt, completion, cached)
+
+    def record(self, usage: Optional[Dict[str, Any]], provider: str, user: Optional[str] = None) -> None:
+        """
+        Account the ``usage`` of one response.
+
+        Args:
+            usage: ``usage`` object of the response
+            provider: Provider that answered
+            user: User the request belongs to, defaults to the attributed user
+        """
+        if not usage:
+            return
+        # Deferred to keep the utilities independent of the models at import time
+        from ..models.chat import cached_prompt_tokens
+
+        prompt = usage.get("prompt_tokens") or 0
+        completion = usage.get("completion_tokens") or 0
+        cached = cached_prompt_tokens(usage)
+        user = user or _user.get()
+        session = _session.get()
+
+        self._count("providers", provider, prompt, completion, cached)
+        if user:
+            self._count("users", user, prompt, completion, cached)
+            now = time.monotonic()
+            self._rates.setdefault(user, _Window(_RATE_WINDOW)).add(now, prompt + completion)
+            if self.user_token_budget:
+                self._budgets.setdefault(user, _Window(self.budget_window)).add(now, prompt + completion)
+        if session:
+            self._count("sessions", session, prompt, completion, cached)
+
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def check(self, user: Optional[str]) -> None:
+        """
+        Reject a request of a user who has used up their budget.
+
+        Args:
+            user: User the request belongs to
+
+        Raises:
+            BudgetExceeded: If the user's tokens in the budget window exceed ``user_token_budget``
+        """
+        window = self._budgets.get(user) if user and self.user_token_budget else None
+        if window is None:
+            return
+        now = time.monotonic()
+        if window.expire(now) >= self.user_token_budget:
+            self.rejected += 1
+            raise BudgetExceeded(user, window.retry_after(now))
+
+    def priority_for(self, priority: str, user: Optional[str]) -> str:
+        """
+        Lower the priority of a user above their throughput budget.
+
+        Args:
+            priority: Requested priority class
+            user: User the request belongs to
+
+        Returns:
+            The requested class, or a lower one for a heavy user
+        """
+        window = self._rates.get(user) if user and self.user_tokens_per_minute else None
+        if window is None or priority not in _PRIORITIES:
+            return priority
+        rate = window.expire(time.monotonic())
+        if rate >= self.user_tokens_per_minute:
+            demoted = "bulk"
+        elif rate >= self.demote_ratio * self.user_tokens_per_minute:
+            demoted = "background"
+        else:
+            return priority
+        if _PRIORITIES.index(demoted) <= _PRIORITIES.index(priority):
+            return priority
+        self.demoted += 1
+        logger.debug(f"Demoting {user} to {demoted}: {rate} tokens in the last minute")
+        return demoted
+
+    def flush(self) -> None:
+        """Append the increments since the last flush to the usage file."""
+        self._last_flush = now = time.monotonic()
+        # Forget idle users so that the windows do not grow with every visitor
+        for windows in (self._rates, self._budgets):
+            for user in [user for user, window in windows.items() if not window.expire(now)]:
+                del windows[user]
+
+        if self.path is None or not any(self._pending.values()):
+            return
+        record: Dict[str, Any] = {"time": time.time(), "pid": os.getpid()}
+        for scope, pending in self._pending.items():
+            record[scope] = {key: asdict(totals) for key, totals in pending.items()}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # One append per flush keeps lines from several workers intact
+            with open(self.path, "ab") as f:
+                f.write(json_codec.dumps(record) + b"\n")
+        except OSError as e:
+            logger.warning(f"Failed to write usage to {self.path}: {e}")
+            return
+        self._pending = {scope: {} for scope in self._totals}
+
+    def metrics(self, session: Optional[str] = None, user: Optional[str] = None, top_n: int = 5) -> Dict[str, Any]:
+        """
+        Get the usage totals and the heaviest users.
+
+        Args:
+            session: Session whose totals to include
+            user: User whose totals to include
+            top_n: Number of heaviest users to include
+
+        Returns:
+            Dictionary of totals per provider, the given session and user, and the
+            users with the most tokens in the last minute
+        """
+        now = time.monotonic()
+        rates = {name: window.expire(now) for name, window in self._rates.items()}
+        metrics: Dict[str, Any] = {
+            "providers": {name: totals.snapshot() for name, totals in self._totals["providers"].items()},
+            "top_users": dict(sorted(rates.items(), key=lambda item: -item[1])[:top_n]),
+            "demoted": self.demoted,
+            "rejected": self.rejected,
+        }
+        if session and session in self._totals["sessions"]:
+            metrics["session"] = self._totals["sessions"][session].snapshot()
+        if user and user in self._totals["users"]:
+            metrics["user"] = {
+                **self._totals["users"][user].snapshot(),
+                "tokens_last_minute": rates.get(user, 0),
+            }
+        return metrics